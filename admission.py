@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+接入调度
+有活跃会话时，新客户端按到达顺序排队，逐个弹出决策对话框；
+决策结果通过 concurrent.futures.Future 通知等待的线程或协程，不再轮询。
+排队期间不向客户端发送任何数据（RFB握手保持未开始），
+当前会话一结束，队首客户端立即接入，无需重新连接。
+"""
+
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from proxy_metrics import LatencyRecorder
+from status_bus import EVENT_QUEUE
+
+# 调度结果
+ALLOW_NEW = "allow_new"        # 断开当前会话，让新客户端接入
+KEEP_CURRENT = "keep_current"  # 保留当前会话
+ADMIT = "admit"                # 会话已空闲，直接接入
+REFUSE = "refuse"              # 拒绝
+
+# 排队状态
+PENDING = "pending"  # 等待决策
+HELD = "held"        # 已被拒绝接管，保持连接等待当前会话结束
+
+
+def client_alive(sock):
+    """检查排队中的客户端是否仍然连接（RFB客户端在收到版本串前不会发送数据）
+
+    TLS连接（ssl.SSLSocket）的recv不支持标志，越过TLS层直接探测底层TCP连接。
+    """
+    try:
+        blocking = sock.getblocking()
+        sock.setblocking(False)
+        try:
+            if isinstance(sock, socket.socket):
+                data = socket.socket.recv(sock, 1, socket.MSG_PEEK)
+            else:
+                data = sock.recv(1, socket.MSG_PEEK)
+        finally:
+            sock.setblocking(blocking)
+    except (BlockingIOError, InterruptedError):
+        return True
+    except OSError:
+        return False
+    return bool(data)
+
+
+class AdmissionRequest:
+    """一个排队中的客户端"""
+
+    __slots__ = ('sock', 'addr', 'seq', 'state', 'enqueued', 'queued', 'future',
+                 'timer')
+
+    def __init__(self, sock, addr, seq):
+        self.sock = sock
+        self.addr = addr
+        self.seq = seq
+        self.state = PENDING
+        self.enqueued = time.perf_counter()
+        # 是否真正排过队（会话空闲时提交即接入）
+        self.queued = False
+        # 结果为 ALLOW_NEW / ADMIT / REFUSE
+        self.future = Future()
+        self.timer = None
+
+
+class AdmissionScheduler:
+    """单个桌面的接入调度器，先到先服务"""
+
+    def __init__(self, proxy, queue_wait=0, max_queue=16, decision_timeout=5):
+        self.proxy = proxy
+        self.logger = proxy.logger
+        # 被拒绝接管后继续等待会话结束的秒数，0为立即拒绝
+        self.queue_wait = queue_wait
+        self.max_queue = max_queue
+        self.decision_timeout = decision_timeout
+
+        self.lock = threading.RLock()
+        self.queue = deque()
+        self.current = None   # 正在显示决策对话框的请求
+        self.reserved = None  # 已获准接入、正在建立会话的请求
+        self.seq = 0
+
+        # 统计
+        self.wait_latency = LatencyRecorder()
+        self.max_depth = 0
+        self.outcomes = {'direct': 0, ALLOW_NEW: 0, ADMIT: 0, REFUSE: 0}
+
+    def busy(self):
+        """是否有客户端排队或正在接入，此时新客户端也必须排队"""
+        return bool(self.queue) or self.reserved is not None
+
+    def submit(self, sock, addr):
+        """客户端提交接入请求，返回AdmissionRequest；队列已满时返回None
+
+        会话空闲且无人排队时请求立即以ADMIT完成，否则排队等待决策。
+        """
+        with self.lock:
+            if len(self.queue) >= self.max_queue:
+                return None
+            self.seq += 1
+            request = AdmissionRequest(sock, addr, self.seq)
+            request.queued = self.busy() or self.proxy.active_session is not None
+            if request.queued:
+                self.logger.info(f"有活跃会话，客户端 {addr} 进入等待队列，前面还有 {len(self.queue)} 人")
+            self.queue.append(request)
+            self.max_depth = max(self.max_depth, len(self.queue))
+            self._pump()
+        return request
+
+    def decide(self, decision, request=None, close_dialog=False):
+        """决策对话框的结果（由GUI或超时计时器调用）"""
+        with self.lock:
+            current = self.current
+            if current is None or (request is not None and request is not current):
+                return
+            self.current = None
+            if close_dialog:
+                # 先关闭对话框，再弹出下一个
+                self._close_dialog()
+            if current.timer:
+                current.timer.cancel()
+                current.timer = None
+            if decision == ALLOW_NEW:
+                self._resolve(current, ALLOW_NEW)
+            elif self.queue_wait > 0:
+                current.state = HELD
+                current.timer = threading.Timer(self.queue_wait, self._expire,
+                                                args=(current,))
+                current.timer.daemon = True
+                current.timer.start()
+                self.logger.info(f"客户端 {current.addr} 保持连接，最多等待 {self.queue_wait} 秒")
+            else:
+                self._resolve(current, REFUSE)
+            self._pump()
+
+    def release(self, request):
+        """请求处理结束：获准接入的客户端已完成会话建立（无论成功与否），
+        或等待中的客户端被取消"""
+        with self.lock:
+            if self.reserved is request:
+                self.reserved = None
+            if request in self.queue:
+                self.queue.remove(request)
+                if request.timer:
+                    request.timer.cancel()
+                    request.timer = None
+                if request is self.current:
+                    self.current = None
+                    self._close_dialog()
+            self._pump()
+
+    def on_session_end(self):
+        """活跃会话结束，队首客户端可以接入"""
+        with self.lock:
+            self._pump()
+
+    def close(self):
+        """服务器停止：拒绝所有排队的客户端"""
+        with self.lock:
+            for request in list(self.queue):
+                self._resolve(request, REFUSE)
+            if self.current is not None:
+                self.current = None
+                self._close_dialog()
+            self._publish_depth()
+
+    def _expire(self, request):
+        """保持连接的客户端等待超时"""
+        with self.lock:
+            if request.state == HELD and request in self.queue:
+                self.logger.info(f"客户端 {request.addr} 等待 {self.queue_wait} 秒后会话仍未结束")
+                self._resolve(request, REFUSE)
+                self._publish_depth()
+
+    def _resolve(self, request, result):
+        # 调用方持有self.lock
+        try:
+            self.queue.remove(request)
+        except ValueError:
+            pass
+        if request.timer:
+            request.timer.cancel()
+            request.timer = None
+        if result in (ALLOW_NEW, ADMIT):
+            self.reserved = request
+        if request.queued:
+            self.outcomes[result] += 1
+            self.wait_latency.record(time.perf_counter() - request.enqueued)
+        else:
+            self.outcomes['direct'] += 1
+        if not request.future.done():
+            request.future.set_result(result)
+
+    def _pump(self):
+        """推进队列并发布队列长度（调用方持有self.lock）"""
+        while self.queue and self.reserved is None:
+            head = self.queue[0]
+            if not client_alive(head.sock):
+                self.logger.info(f"排队客户端 {head.addr} 已断开")
+                if head is self.current:
+                    self.current = None
+                    self._close_dialog()
+                self._resolve(head, REFUSE)
+                continue
+
+            if self.proxy.active_session is None:
+                # 会话空闲：队首直接接入，关闭可能正在显示的对话框
+                if head is self.current:
+                    self.current = None
+                    self._close_dialog()
+                if head.queued:
+                    self.logger.info(f"会话已空闲，排队客户端 {head.addr} 直接接入")
+                self._resolve(head, ADMIT)
+                break
+
+            if self.current is not None:
+                break
+            pending = next((r for r in self.queue if r.state == PENDING), None)
+            if pending is None:
+                break
+            if not client_alive(pending.sock):
+                self.logger.info(f"排队客户端 {pending.addr} 已断开")
+                self._resolve(pending, REFUSE)
+                continue
+
+            self.current = pending
+            if self.proxy.idle_handover(pending.addr):
+                # 当前会话长时间没有输入，不弹出对话框直接交给新客户端
+                self.decide(ALLOW_NEW, pending)
+                continue
+            if not self.proxy.root:
+                # 无GUI模式，按配置的默认决策处理（默认保留当前会话）
+                self.decide(self.proxy.headless_decision, pending)
+                continue
+            pending.timer = threading.Timer(self.decision_timeout,
+                                            self._decision_timeout, args=(pending,))
+            pending.timer.daemon = True
+            pending.timer.start()
+            waiting = len(self.queue) - 1
+            self.proxy.root.after(0, lambda addr=pending.addr:
+                                  self.proxy.show_decision_dialog(addr, waiting))
+            break
+        self._publish_depth()
+
+    def _publish_depth(self):
+        # 调用方持有self.lock
+        self.proxy.status.publish(EVENT_QUEUE, queue_depth=len(self.queue))
+
+    def _decision_timeout(self, request):
+        # 超时，默认允许新用户
+        self.decide(ALLOW_NEW, request, close_dialog=True)
+
+    def _close_dialog(self):
+        root = self.proxy.root
+        if root:
+            try:
+                root.after(0, self.proxy.close_decision_dialog)
+            except RuntimeError:
+                # Tk主循环已退出
+                pass
+
+    def get_stats(self):
+        """队列统计"""
+        wait = self.wait_latency.snapshot()
+        return {
+            'depth': len(self.queue),
+            'max_depth': self.max_depth,
+            'wait_p50_ms': wait['p50_ms'],
+            'wait_p99_ms': wait['p99_ms'],
+            'outcomes': dict(self.outcomes),
+        }
@@ -0,0 +1,532 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+asyncio转发引擎
+在单个事件循环中完成接受连接、用户决策等待和双向数据转发，
+不再为每个连接和每个转发方向各启动一个线程。
+一个引擎可以同时服务多个桌面（多桌面模式），每个桌面的会话策略相互独立。
+"""
+
+import asyncio
+import socket
+import threading
+import time
+
+import liveness
+import refusal
+import relay
+from admission import ADMIT, ALLOW_NEW
+from proxy_logging import dedup
+from session import SEND_STALL_SECONDS
+
+
+class AsyncioEngine:
+    """基于asyncio的代理引擎，会话语义与线程模式保持一致"""
+
+    def __init__(self, proxies, stats_interval=0, log_stats=None):
+        self.proxies = list(proxies)
+        self.stats_interval = stats_interval
+        self.log_stats = log_stats
+        self.loop = None
+        self.loop_thread_id = None
+        self.main_task = None
+        self.stop_requested = False
+        # 每个桌面当前的接受连接任务，监听端口变化时替换
+        self.accept_tasks = {}
+
+    def run(self):
+        """运行事件循环，直到服务器停止"""
+        try:
+            asyncio.run(self.serve())
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.loop = None
+
+    def stop(self):
+        """请求停止事件循环（可从任意线程调用）"""
+        self.stop_requested = True
+        loop = self.loop
+        if loop is None:
+            return
+        try:
+            loop.call_soon_threadsafe(self._cancel_main)
+        except RuntimeError:
+            # 事件循环已经关闭
+            pass
+
+    def _cancel_main(self):
+        if self.main_task and not self.main_task.done():
+            self.main_task.cancel()
+
+    def in_loop_thread(self):
+        """当前是否在事件循环线程中"""
+        return threading.get_ident() == self.loop_thread_id
+
+    async def serve(self):
+        """为每个桌面创建监听套接字并运行接受循环"""
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.main_task = asyncio.current_task()
+
+        for proxy in self.proxies:
+            proxy.engine = self
+            try:
+                server_socket = proxy.create_listen_socket()
+            except Exception as e:
+                proxy.logger.error(f"启动服务器失败: {e}")
+                continue
+            server_socket.setblocking(False)
+            proxy.server_socket = server_socket
+            proxy.is_running = True
+            proxy.logger.info(f"简化VNC代理服务器(asyncio引擎)启动在端口 {proxy.proxy_port}")
+            proxy.start_backend_pool()
+            proxy.start_websocket()
+            self.accept_tasks[proxy] = self.loop.create_task(
+                self.accept_loop(proxy, server_socket))
+
+        if not self.accept_tasks:
+            return
+
+        stats_task = None
+        if self.stats_interval > 0 and self.log_stats:
+            stats_task = self.loop.create_task(self.report_stats())
+
+        try:
+            # 被替换的接受任务结束后继续等待新任务
+            while self.accept_tasks:
+                await asyncio.wait(list(self.accept_tasks.values()),
+                                   return_when=asyncio.FIRST_COMPLETED)
+                for proxy, task in list(self.accept_tasks.items()):
+                    if task.done():
+                        del self.accept_tasks[proxy]
+        finally:
+            for task in self.accept_tasks.values():
+                task.cancel()
+            if stats_task:
+                stats_task.cancel()
+            for proxy in self.proxies:
+                try:
+                    proxy.server_socket.close()
+                except (AttributeError, OSError):
+                    pass
+                if proxy.active_session:
+                    self._close_session(proxy.active_session)
+
+    def replace_listener(self, proxy, server_socket):
+        """替换一个桌面的监听套接字（监听端口变化时由重新加载配置的线程调用）"""
+        server_socket.setblocking(False)
+        try:
+            self.loop.call_soon_threadsafe(self._replace_listener, proxy, server_socket)
+        except (AttributeError, RuntimeError):
+            # 事件循环已经停止
+            server_socket.close()
+
+    def _replace_listener(self, proxy, server_socket):
+        old_socket, proxy.server_socket = proxy.server_socket, server_socket
+        old_task = self.accept_tasks.get(proxy)
+        self.accept_tasks[proxy] = self.loop.create_task(
+            self.accept_loop(proxy, server_socket))
+        if old_task:
+            old_task.cancel()
+        # 等取消的sock_accept移除读事件后再关闭旧套接字
+        self.loop.call_soon(old_socket.close)
+
+    async def accept_loop(self, proxy, server_socket):
+        """单个桌面的接受连接循环"""
+        while proxy.is_running and not self.stop_requested:
+            try:
+                client_socket, client_addr = await self.loop.sock_accept(server_socket)
+            except OSError as e:
+                if proxy.is_running:
+                    proxy.logger.error(f"接受连接错误: {e}")
+                # 避免在持续出错时占满事件循环
+                await asyncio.sleep(0.1)
+                continue
+
+            # 超出速率限制的连接直接关闭，不创建任务
+            if not proxy.accept_allowed(client_socket, client_addr):
+                continue
+            proxy.logger.info(f"新客户端连接: {client_addr}",
+                              extra=dedup('connect', client_addr[0]))
+            client_socket.setblocking(False)
+            self.loop.create_task(
+                self.handle_new_client(proxy, client_socket, client_addr))
+
+    async def report_stats(self):
+        """定期输出运行统计"""
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            self.log_stats()
+
+    async def handle_new_client(self, proxy, client_socket, client_addr):
+        """处理新客户端连接"""
+        client_ip = client_addr[0]
+        logger = proxy.logger
+
+        if proxy.tls:
+            # 事件循环的sock_*接口不支持ssl.SSLSocket，TLS握手和之后的会话交给线程模式处理
+            client_socket.setblocking(True)
+            threading.Thread(target=proxy.handle_tls_client,
+                             args=(client_socket, client_addr), daemon=True).start()
+            return
+
+        if proxy.shared_view or proxy.keep_backend:
+            # 由代理终结握手的会话由线程管理（按消息边界转发），交给线程模式处理
+            client_socket.setblocking(True)
+            threading.Thread(target=proxy.handle_new_client,
+                             args=(client_socket, client_addr), daemon=True).start()
+            return
+
+        try:
+            # 检查冷却期
+            if proxy.is_in_grace_period(client_ip):
+                logger.info(f"客户端 {client_addr} 在冷却期内，拒绝连接",
+                            extra=dedup('cooldown', client_ip))
+                await self.send_refuse_and_close(proxy, client_socket,
+                                                 "服务器正被其他用户使用，请稍后再试。")
+                return
+
+            # 没有活跃会话时直接接入，否则排队等待决策或当前会话结束
+            request = proxy.admission.submit(client_socket, client_addr)
+            if request is None:
+                logger.info(f"等待队列已满，拒绝客户端 {client_addr}",
+                            extra=dedup('queue_full', client_ip))
+                await self.send_refuse_and_close(proxy, client_socket,
+                                                 "服务器正被其他用户使用，请稍后再试。")
+                return
+
+            try:
+                decision = await asyncio.wrap_future(request.future)
+                if decision == ALLOW_NEW:
+                    proxy.disconnect_current_session()
+                if decision in (ALLOW_NEW, ADMIT):
+                    await self.create_new_session(proxy, client_socket, client_addr)
+                    return
+            finally:
+                proxy.admission.release(request)
+
+            proxy.rejected_ips[client_ip] = time.time()
+            logger.info(f"新用户 {client_addr} 被拒绝，加入1分钟冷却列表")
+            await self.send_refuse_and_close(proxy, client_socket, "服务器正被其他用户使用，请稍后再试。")
+
+        except Exception as e:
+            logger.error(f"处理客户端 {client_addr} 时出错: {e}")
+            try:
+                client_socket.close()
+            except OSError:
+                pass
+
+    async def create_new_session(self, proxy, client_socket, client_addr):
+        """创建新的VNC会话"""
+        started = time.perf_counter()
+        # 预热连接池的取用不阻塞；池为空时在事件循环中建立连接
+        conn = proxy.backend_pool.checkout() if proxy.backend_pool else None
+        if conn:
+            vnc_socket = conn.sock
+            vnc_socket.setblocking(False)
+        else:
+            vnc_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            vnc_socket.setblocking(False)
+        try:
+            if conn is None:
+                await self.loop.sock_connect(vnc_socket,
+                                             (proxy.vnc_host, proxy.vnc_port))
+            proxy.backend_connect_latency.record(time.perf_counter() - started)
+            # 预热连接已读取服务器版本串，先转交给客户端
+            if conn and conn.greeting:
+                await self.loop.sock_sendall(client_socket, conn.greeting)
+        except Exception as e:
+            proxy.logger.error(f"创建VNC会话失败: {e}")
+            vnc_socket.close()
+            await self.send_refuse_and_close(proxy, client_socket, "无法连接到VNC服务器，请稍后再试。")
+            return
+
+        session = proxy.new_session(client_socket, vnc_socket, client_addr)
+        proxy.active_session = session
+        proxy.logger.for_session(session).info(f"为客户端 {client_addr} 创建新VNC会话")
+
+        # 事件循环中只能使用缓冲区路径
+        session.relay_path = relay.PATH_BUFFER
+        recording = proxy.start_recording(session)
+        stream_filter = proxy.create_client_filter(session)
+        if stream_filter:
+            proxy.relay_path_counts[relay.PATH_FILTER] += 1
+            proxy.relay_path_counts[relay.PATH_BUFFER] += 1
+        else:
+            proxy.relay_path_counts[relay.PATH_BUFFER] += 2
+
+        session.tasks = [
+            self.loop.create_task(self.forward_data(
+                proxy, session, client_socket, vnc_socket, session.upstream,
+                "客户端->VNC", stream_filter, recording.c2s if recording else None)),
+            self.loop.create_task(self.forward_data(
+                proxy, session, vnc_socket, client_socket, session.downstream,
+                "VNC->客户端", tap=recording.s2c if recording else None)),
+        ]
+
+    async def forward_data(self, proxy, session, src, dst, stats, direction,
+                           stream_filter=None, tap=None):
+        """单方向转发数据，stream_filter为客户端方向的RFB过滤器，tap为录制回调"""
+        loop = self.loop
+        relay_buffer = relay.RelayBuffer()
+        latency = proxy.relay_latency
+        perf_counter = time.perf_counter
+        logger = proxy.logger.for_session(session)
+        try:
+            if stream_filter is not None and stream_filter.coalescer is not None:
+                if not await self.forward_coalescing(session, src, dst, stats,
+                                                     stream_filter, tap, latency):
+                    logger.info(f"数据转发结束: {direction}")
+                    return
+                stream_filter = None
+            while session.active:
+                deadline = (stream_filter.deadline() if stream_filter is not None
+                            else None)
+                if deadline is None:
+                    n = await loop.sock_recv_into(src, relay_buffer.view)
+                else:
+                    # 节流中的更新请求到期时单独发出
+                    try:
+                        n = await asyncio.wait_for(
+                            loop.sock_recv_into(src, relay_buffer.view),
+                            max(0.0, deadline - time.monotonic()))
+                    except asyncio.TimeoutError:
+                        data = stream_filter.flush()
+                        if data:
+                            await loop.sock_sendall(dst, data)
+                            stream_filter.written()
+                        continue
+                if not n:
+                    logger.info(f"数据转发结束: {direction}")
+                    break
+                stats.bytes += n
+                stats.chunks += 1
+                data = relay_buffer.view[:n]
+                if tap is not None:
+                    tap(data)
+                if stream_filter is not None:
+                    data = stream_filter.feed(data)
+                    if stream_filter.passthrough:
+                        stream_filter = None
+                    if not data:
+                        continue
+                started = perf_counter()
+                await loop.sock_sendall(dst, data)
+                elapsed = perf_counter() - started
+                if stream_filter is not None:
+                    stream_filter.written()
+                latency.record(elapsed)
+                if elapsed > SEND_STALL_SECONDS:
+                    stats.stalls += 1
+                relay_buffer.adapt(n)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if liveness.is_peer_timeout(e):
+                proxy.note_peer_timeout(session, direction, e)
+            else:
+                logger.info(f"数据转发异常: {direction} - {e}")
+        finally:
+            # 只有当前会话结束时才清理
+            proxy.cleanup_session(session)
+
+    async def forward_coalescing(self, session, src, dst, stats, stream_filter, tap,
+                                 latency):
+        """合并指针移动的客户端方向转发
+
+        服务器方向不可写（写不完，或未发送数据超过 TCP_NOTSENT_LOWAT）时，由后台任务写出剩余数据
+        并等待重新可写，期间继续读取客户端数据，消息暂存在过滤器中合并，可写后再取出。
+        过滤器转为透传时返回True，客户端关闭连接时返回False。
+        """
+        loop = self.loop
+        relay_buffer = relay.RelayBuffer()
+        check = relay.WritableCheck(dst)
+        perf_counter = time.perf_counter
+        receiving = None
+        sending = None  # 写出剩余数据并等待可写的任务
+        started = None  # 正在计时的一次写出的开始时间
+
+        def sent():
+            nonlocal started
+            if started is None:
+                return
+            elapsed = perf_counter() - started
+            started = None
+            stream_filter.written()
+            latency.record(elapsed)
+            if elapsed > SEND_STALL_SECONDS:
+                stats.stalls += 1
+
+        def send(data):
+            """写出数据，写不完或写完后不可写时返回后台任务"""
+            nonlocal started
+            started = perf_counter()
+            try:
+                n = dst.send(data)
+            except (BlockingIOError, InterruptedError):
+                n = 0
+            if n == len(data) and check.writable():
+                sent()
+                return None
+            return loop.create_task(self.drain(dst, memoryview(data)[n:]))
+
+        try:
+            while session.active:
+                if receiving is None:
+                    receiving = loop.create_task(
+                        loop.sock_recv_into(src, relay_buffer.view))
+                deadline = stream_filter.deadline()
+                timeout = (max(0.0, deadline - time.monotonic()) if deadline is not None
+                           else None)
+                waiting = (receiving,) if sending is None else (receiving, sending)
+                await asyncio.wait(waiting, timeout=timeout,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if sending is not None and sending.done():
+                    sending.result()
+                    sending = None
+                    sent()
+                    stream_filter.congested = False
+                if receiving.done():
+                    n = receiving.result()
+                    receiving = None
+                    if not n:
+                        return False
+                    stats.bytes += n
+                    stats.chunks += 1
+                    if tap is not None:
+                        tap(relay_buffer.view[:n])
+                    stream_filter.congested = (sending is not None
+                                               or not check.writable())
+                    data = stream_filter.feed(relay_buffer.view[:n])
+                    relay_buffer.adapt(n)
+                else:
+                    data = stream_filter.flush()
+                if data:
+                    if sending is not None:
+                        # 握手阶段和转为透传时的输出不暂存，等之前的数据写完再写
+                        await sending
+                        sent()
+                    sending = send(data)
+                elif sending is None and stream_filter.holding:
+                    sending = loop.create_task(self.drain(dst, b""))
+                stream_filter.congested = sending is not None
+                if stream_filter.passthrough:
+                    if sending is not None:
+                        await sending
+                        sent()
+                        sending = None
+                    return True
+            return True
+        finally:
+            for task in (receiving, sending):
+                if task is not None and not task.done():
+                    task.cancel()
+            check.close()
+
+    async def drain(self, sock, data):
+        """写出数据并等待套接字重新可写；事件循环不支持 add_writer（Windows的Proactor）时写完即返回"""
+        loop = self.loop
+        if data:
+            await loop.sock_sendall(sock, data)
+        writable = loop.create_future()
+        try:
+            loop.add_writer(sock.fileno(),
+                            lambda: writable.done() or writable.set_result(None))
+        except NotImplementedError:
+            return
+        try:
+            await writable
+        finally:
+            loop.remove_writer(sock.fileno())
+
+    def close_session(self, session):
+        """关闭会话（可从任意线程调用）"""
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            close_sockets(session)
+            return
+        if self.in_loop_thread():
+            self._close_session(session)
+            return
+        try:
+            loop.call_soon_threadsafe(self._close_session, session)
+        except RuntimeError:
+            close_sockets(session)
+
+    def _close_session(self, session):
+        current = asyncio.current_task()
+        pending = [task for task in session.tasks
+                   if task is not current and not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            # 等转发任务退出、套接字从事件循环注销后再关闭
+            self.loop.create_task(self._close_after(pending, session))
+        else:
+            close_sockets(session)
+
+    async def _close_after(self, tasks, session):
+        await asyncio.gather(*tasks, return_exceptions=True)
+        close_sockets(session)
+
+    async def send_refuse_and_close(self, proxy, client_socket, message):
+        """发送RFB拒绝消息并关闭连接，流程与线程模式的拒绝引擎相同（见refusal模块）"""
+        loop = self.loop
+        proxy.counters['refused'] += 1
+        timeout = proxy.refuse_timeout
+        version = None
+        try:
+            await loop.sock_sendall(client_socket, refusal.SERVER_VERSION)
+            try:
+                data = await asyncio.wait_for(recv_exact(loop, client_socket, 12),
+                                              timeout)
+            except asyncio.TimeoutError:
+                result = refusal.RESULT_TIMEOUT
+            else:
+                if data is None:
+                    result = refusal.RESULT_CLOSED
+                else:
+                    version = refusal.client_version(data)
+                    await loop.sock_sendall(client_socket,
+                                            refusal.refusal_payload(message, version))
+                    client_socket.shutdown(socket.SHUT_WR)
+                    try:
+                        await asyncio.wait_for(drain_until_eof(loop, client_socket),
+                                               refusal.LINGER_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        pass
+                    result = refusal.RESULT_REFUSED
+        except OSError as e:
+            result, version = refusal.RESULT_ERROR, e
+        finally:
+            try:
+                client_socket.close()
+            except OSError:
+                pass
+        refusal.log_result(proxy.logger, message, result, version, timeout)
+
+
+async def recv_exact(loop, sock, size):
+    """读取size字节，对方提前关闭时返回None"""
+    data = b""
+    while len(data) < size:
+        chunk = await loop.sock_recv(sock, size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+async def drain_until_eof(loop, sock):
+    """读取并丢弃数据，直到对方关闭连接"""
+    while await loop.sock_recv(sock, 4096):
+        pass
+
+def close_sockets(session):
+    """关闭会话两端的套接字"""
+    for key in ('client_socket', 'vnc_socket'):
+        try:
+            getattr(session, key).close()
+        except Exception:
+            pass
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+后端连接池
+预先建立到VNC服务器的TCP连接（可选地预先读取服务器的协议版本串），
+新会话直接取用，不必等待TCP连接和版本交换。
+后台线程定期检查空闲连接的健康状态，并在每次取用后补足连接数。
+"""
+
+import socket
+import threading
+import time
+from collections import deque
+
+from proxy_metrics import LatencyRecorder
+
+# RFB服务器版本串长度
+VERSION_LENGTH = 12
+
+
+class PooledConnection:
+    """池中的一条后端连接"""
+
+    __slots__ = ('sock', 'greeting', 'created')
+
+    def __init__(self, sock, greeting, created):
+        self.sock = sock
+        # 预先读取的服务器版本串，未预读时为None
+        self.greeting = greeting
+        self.created = created
+
+    def is_healthy(self):
+        """用MSG_PEEK检查连接是否仍然可用，不消耗数据"""
+        try:
+            self.sock.setblocking(False)
+            try:
+                data = self.sock.recv(VERSION_LENGTH + 1, socket.MSG_PEEK)
+            finally:
+                self.sock.setblocking(True)
+        except (BlockingIOError, InterruptedError):
+            # 没有数据可读：服务器仍在等待客户端
+            return True
+        except OSError:
+            return False
+        if not data:
+            # 对端已关闭
+            return False
+        # 已预读版本串时服务器不应再发数据；未预读时只能有版本串
+        return self.greeting is None and len(data) <= VERSION_LENGTH
+
+    def close(self):
+        """关闭连接"""
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class BackendPool:
+    """到一个VNC服务器的预热连接池"""
+
+    def __init__(self, host, port, size=2, max_idle=30.0, prefetch_version=False,
+                 logger=None, connect_timeout=5.0, check_interval=5.0):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.max_idle = max_idle
+        self.prefetch_version = prefetch_version
+        self.logger = logger
+        self.connect_timeout = connect_timeout
+        self.check_interval = (min(check_interval, max_idle / 2) if max_idle > 0
+                               else check_interval)
+
+        self.idle = deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = False
+
+        # 实际建立连接（TCP连接+可选版本预读）的耗时
+        self.connect_latency = LatencyRecorder()
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    def start(self):
+        """启动后台补充线程"""
+        if self.running:
+            return
+        self.running = True
+        threading.Thread(target=self.refill_loop, daemon=True).start()
+
+    def stop(self):
+        """停止补充并关闭全部空闲连接"""
+        self.running = False
+        self.wakeup.set()
+        with self.lock:
+            idle, self.idle = list(self.idle), deque()
+        for conn in idle:
+            conn.close()
+
+    def connect(self):
+        """建立一条新的后端连接，返回PooledConnection"""
+        started = time.perf_counter()
+        sock = socket.create_connection((self.host, self.port),
+                                        timeout=self.connect_timeout)
+        try:
+            greeting = None
+            if self.prefetch_version:
+                greeting = b''
+                while len(greeting) < VERSION_LENGTH:
+                    chunk = sock.recv(VERSION_LENGTH - len(greeting))
+                    if not chunk:
+                        raise ConnectionError("VNC服务器在发送版本串前关闭连接")
+                    greeting += chunk
+            sock.settimeout(None)
+        except Exception:
+            sock.close()
+            raise
+        self.connect_latency.record(time.perf_counter() - started)
+        return PooledConnection(sock, greeting, time.monotonic())
+
+    def checkout(self):
+        """取出一条健康的空闲连接，没有时返回None（不阻塞）"""
+        now = time.monotonic()
+        conn = None
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                # 取最新的连接，离空闲超时最远
+                candidate = self.idle.pop()
+            if now - candidate.created < self.max_idle and candidate.is_healthy():
+                conn = candidate
+                break
+            self.discarded += 1
+            candidate.close()
+        if conn:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.wakeup.set()
+        return conn
+
+    def acquire(self):
+        """取用池中连接，池为空时直接建立新连接"""
+        return self.checkout() or self.connect()
+
+    def prune(self):
+        """移除超时或已失效的空闲连接"""
+        # 先整体取出再检查，避免检查时连接被取走并开始转发
+        with self.lock:
+            idle, self.idle = list(self.idle), deque()
+        now = time.monotonic()
+        healthy = []
+        for conn in idle:
+            if now - conn.created < self.max_idle and conn.is_healthy():
+                healthy.append(conn)
+            else:
+                self.discarded += 1
+                conn.close()
+        with self.lock:
+            self.idle.extendleft(reversed(healthy))
+
+    def refill_loop(self):
+        """后台线程：健康检查并补足空闲连接"""
+        failures = 0
+        while self.running:
+            self.prune()
+            while self.running and len(self.idle) < self.size:
+                try:
+                    conn = self.connect()
+                except Exception as e:
+                    failures += 1
+                    if self.logger and failures == 1:
+                        self.logger.warning(f"预热后端连接失败: {e}")
+                    break
+                if failures and self.logger:
+                    self.logger.info("预热后端连接已恢复")
+                failures = 0
+                with self.lock:
+                    self.idle.append(conn)
+            self.wakeup.wait(self.check_interval)
+            self.wakeup.clear()
+        self.stop()
+
+    def get_stats(self):
+        """连接池统计"""
+        latency = self.connect_latency.snapshot()
+        return {
+            'idle': len(self.idle),
+            'hits': self.hits,
+            'misses': self.misses,
+            'discarded': self.discarded,
+            'connect_p50_ms': latency['p50_ms'],
+            'connect_p99_ms': latency['p99_ms'],
+        }
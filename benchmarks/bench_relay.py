@@ -0,0 +1,632 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+VNC代理转发基准测试
+在本机启动合成RFB服务器和以 --no-gui 模式运行的代理子进程，测量：
+- relay_throughput_mbps：经代理的帧缓冲区更新吞吐量（MB/s）
+- latency_p50_ms / latency_p99_ms：更新请求到收到更新的往返时间，added_* 为相对直连增加的部分
+- accepts_per_sec：顺序完成 连接 -> 握手 -> 断开 的速率
+- takeover_p50_ms / takeover_p99_ms：allow_new 决策下新客户端接管到完成握手并收到首个更新的时间
+  （--takeover-mode 选择代理的接管方式）
+- refusals_per_sec：有活跃会话时并发客户端收到拒绝消息的速率
+- input_p50_ms / input_p99_ms：客户端持续粘贴大段剪贴板、服务器处理较慢时，按键到达服务器的延迟
+  （--qos 模式），plain_input_* 为不启用 --qos 时的对照
+- pointer_lag_ms：客户端以高于服务器处理能力的速率移动指针时，最后一个位置到达服务器的滞后
+  （--coalesce-pointer），plain_pointer_lag_ms 为不合并时的对照
+- ws_throughput_mbps / ws_latency_p50_ms / ws_latency_p99_ms：经代理WebSocket端口（--ws-port）的
+  吞吐量和往返时间，ws_deflate_throughput_mbps 为协商permessage-deflate时的吞吐量
+- tls_full_handshake_p50_ms / tls_full_handshake_p99_ms /
+  tls_resumed_handshake_p50_ms / tls_resumed_handshake_p99_ms：
+  代理端口启用TLS（--tls-cert）时代理统计的完整握手和会话恢复耗时，
+  tls_throughput_mbps 为经TLS的吞吐量
+  （证书由openssl命令行临时生成）
+
+结果以JSON输出，--compare 与之前的结果比较，超过阈值的退化以非零状态退出：
+    python benchmarks/bench_relay.py --output baseline.json
+    python benchmarks/bench_relay.py --compare baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from fake_rfb import (MODE_REQUEST, MODE_STREAM, FakeRFBClient,  # noqa: E402
+                      FakeRFBServer, client_tls_context, read_refusal)
+from proxy_metrics import LatencyRecorder  # noqa: E402
+
+SCENARIOS = ['throughput', 'latency', 'accepts', 'takeover', 'refusal', 'input',
+             'pointer', 'websocket', 'tls']
+
+# 参与比较的指标：1为越大越好，-1为越小越好
+COMPARED_METRICS = {
+    'relay_throughput_mbps': 1,
+    'latency_p50_ms': -1,
+    'latency_p99_ms': -1,
+    'accepts_per_sec': 1,
+    'takeover_p50_ms': -1,
+    'takeover_p99_ms': -1,
+    'refusals_per_sec': 1,
+    'input_p50_ms': -1,
+    'input_p99_ms': -1,
+    'pointer_lag_ms': -1,
+    'ws_throughput_mbps': 1,
+    'ws_latency_p50_ms': -1,
+    'ws_latency_p99_ms': -1,
+    'tls_full_handshake_p50_ms': -1,
+    'tls_full_handshake_p99_ms': -1,
+    'tls_resumed_handshake_p50_ms': -1,
+    'tls_resumed_handshake_p99_ms': -1,
+    'tls_throughput_mbps': 1,
+}
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentiles_ms(samples):
+    """秒单位的采样 -> (p50, p99) 毫秒"""
+    recorder = LatencyRecorder(capacity=max(1, len(samples)))
+    for value in samples:
+        recorder.record(value)
+    p50 = recorder.percentile(50)
+    p99 = recorder.percentile(99)
+    return (round(p50 * 1000, 3) if p50 is not None else None,
+            round(p99 * 1000, 3) if p99 is not None else None)
+
+
+class ProxyProcess:
+    """以 --no-gui 模式运行的代理子进程，单桌面配置，关闭连接速率限制"""
+
+    def __init__(self, vnc_port, engine, headless_decision="keep_current", queue_wait=0,
+                 grace_period=0, extra_args=(), websocket=False):
+        self.vnc_port = vnc_port
+        self.proxy_port = free_port()
+        self.ws_port = free_port() if websocket else 0
+        self.metrics_port = free_port()
+        self.engine = engine
+        self.headless_decision = headless_decision
+        self.queue_wait = queue_wait
+        self.grace_period = grace_period
+        self.extra_args = list(extra_args)
+        self.workdir = None
+        self.process = None
+
+    def __enter__(self):
+        # 在临时目录中运行，日志文件不落在仓库里
+        self.workdir = tempfile.mkdtemp(prefix="vnc-bench-")
+        config = os.path.join(self.workdir, "desktops.json")
+        with open(config, 'w', encoding='utf-8') as f:
+            json.dump({'desktops': [{
+                'name': 'bench', 'proxy_port': self.proxy_port,
+                'vnc_port': self.vnc_port,
+                'grace_period': self.grace_period, 'queue_wait': self.queue_wait,
+                'headless_decision': self.headless_decision, 'ws_port': self.ws_port,
+            }]}, f)
+        command = [sys.executable, os.path.join(REPO_DIR, 'vnc_proxy.py'), '--no-gui',
+                   '--config', config, '--engine', self.engine,
+                   '--ip-rate', '0', '--subnet-rate', '0',
+                   '--metrics-port', str(self.metrics_port)] + self.extra_args
+        self.process = subprocess.Popen(command, cwd=self.workdir,
+                                        stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+        self.wait_ready()
+        return self
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def wait_ready(self, timeout=15):
+        """等待指标端点可用（代理随后立即开始监听）"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"代理进程已退出，返回码 {self.process.returncode}")
+            try:
+                self.stats()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError("等待代理启动超时")
+
+    def stats(self):
+        """代理的JSON统计快照"""
+        url = f"http://127.0.0.1:{self.metrics_port}/metrics.json"
+        with urllib.request.urlopen(url, timeout=2) as response:
+            return json.loads(response.read().decode('utf-8'))['bench']
+
+    def client(self):
+        return FakeRFBClient('127.0.0.1', self.proxy_port, connect_retry=5)
+
+
+def measure_throughput(port, duration, connect_retry=5, websocket=False, deflate=False,
+                       tls=None):
+    """持续读取推送的更新，返回MB/s"""
+    client = FakeRFBClient('127.0.0.1', port, connect_retry=connect_retry,
+                           websocket=websocket, deflate=deflate, tls=tls)
+    try:
+        client.request_update(incremental=False)
+        # 预热一条更新，排除握手和连接建立
+        client.read_update()
+        total = 0
+        started = time.perf_counter()
+        deadline = started + duration
+        while True:
+            size, _ = client.read_update()
+            total += size
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+        return round(total / (now - started) / 1e6, 2)
+    finally:
+        client.close()
+
+
+def measure_round_trips(port, samples, connect_retry=5, websocket=False):
+    """逐条发送更新请求，返回往返时间采样（秒）"""
+    client = FakeRFBClient('127.0.0.1', port, connect_retry=connect_retry,
+                           websocket=websocket)
+    perf_counter = time.perf_counter
+    try:
+        for _ in range(min(100, samples)):
+            client.request_update()
+            client.read_update()
+        results = []
+        for _ in range(samples):
+            started = perf_counter()
+            client.request_update()
+            client.read_update()
+            results.append(perf_counter() - started)
+        return results
+    finally:
+        client.close()
+
+
+def bench_throughput(args, results):
+    server = FakeRFBServer(update_bytes=args.stream_update_bytes,
+                           mode=MODE_STREAM).start()
+    try:
+        results['direct_throughput_mbps'] = measure_throughput(server.port,
+                                                               args.duration)
+        with ProxyProcess(server.port, args.engine) as proxy:
+            results['relay_throughput_mbps'] = measure_throughput(proxy.proxy_port,
+                                                                  args.duration)
+            results['relay_path_counts'] = proxy.stats()['relay_path_counts']
+    finally:
+        server.stop()
+
+
+def bench_latency(args, results):
+    server = FakeRFBServer(update_bytes=args.update_bytes, mode=MODE_REQUEST).start()
+    try:
+        direct_p50, direct_p99 = percentiles_ms(
+            measure_round_trips(server.port, args.latency_samples))
+        with ProxyProcess(server.port, args.engine) as proxy:
+            p50, p99 = percentiles_ms(
+                measure_round_trips(proxy.proxy_port, args.latency_samples))
+    finally:
+        server.stop()
+    results.update({
+        'latency_p50_ms': p50,
+        'latency_p99_ms': p99,
+        'direct_latency_p50_ms': direct_p50,
+        'direct_latency_p99_ms': direct_p99,
+        'added_latency_p50_ms': round(p50 - direct_p50, 3),
+        'added_latency_p99_ms': round(p99 - direct_p99, 3),
+    })
+
+
+def bench_accepts(args, results):
+    server = FakeRFBServer(update_bytes=args.update_bytes).start()
+    try:
+        # 上一个会话清理完成前到达的客户端排队等待，而不是被拒绝
+        with ProxyProcess(server.port, args.engine, queue_wait=10) as proxy:
+            proxy.client().close()
+            samples = []
+            started = time.perf_counter()
+            for _ in range(args.accepts):
+                connect_started = time.perf_counter()
+                client = proxy.client()
+                samples.append(time.perf_counter() - connect_started)
+                client.close()
+            elapsed = time.perf_counter() - started
+    finally:
+        server.stop()
+    results['accepts_per_sec'] = round(args.accepts / elapsed, 1)
+    results['accept_p50_ms'], results['accept_p99_ms'] = percentiles_ms(samples)
+
+
+def bench_takeover(args, results):
+    server = FakeRFBServer(update_bytes=args.update_bytes).start()
+    try:
+        with ProxyProcess(server.port, args.engine, headless_decision="allow_new",
+                          extra_args=['--takeover-mode', args.takeover_mode]) as proxy:
+            current = proxy.client()
+            samples = []
+            for _ in range(args.takeovers):
+                started = time.perf_counter()
+                newcomer = proxy.client()
+                newcomer.request_update(incremental=False)
+                newcomer.read_update()
+                samples.append(time.perf_counter() - started)
+                # 被接管的客户端应当被断开
+                current.sock.settimeout(5)
+                try:
+                    while current.sock.recv(65536):
+                        pass
+                except OSError:
+                    pass
+                current.close()
+                current = newcomer
+            current.close()
+            results['takeovers_completed'] = proxy.stats()['counters']['takeovers']
+            results['takeover_backend_connections'] = server.connections
+    finally:
+        server.stop()
+    results['takeover_p50_ms'], results['takeover_p99_ms'] = percentiles_ms(samples)
+
+
+def bench_refusal(args, results):
+    server = FakeRFBServer(update_bytes=args.update_bytes).start()
+    try:
+        with ProxyProcess(server.port, args.engine, grace_period=60) as proxy:
+            holder = proxy.client()
+            remaining = [args.refusals]
+            failures = [0]
+            lock = threading.Lock()
+
+            def worker():
+                while True:
+                    with lock:
+                        if remaining[0] <= 0:
+                            return
+                        remaining[0] -= 1
+                    try:
+                        if read_refusal('127.0.0.1', proxy.proxy_port) is None:
+                            raise RuntimeError("未收到拒绝消息")
+                    except Exception:
+                        with lock:
+                            failures[0] += 1
+
+            threads = [threading.Thread(target=worker, daemon=True)
+                       for _ in range(args.concurrency)]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            holder.close()
+    finally:
+        server.stop()
+    results['refusals_per_sec'] = round((args.refusals - failures[0]) / elapsed, 1)
+    results['refusal_failures'] = failures[0]
+
+
+def measure_input(proxy, args):
+    """一个线程持续发送剪贴板，同时按固定间隔发送按键，返回按键从发送到服务器收到的耗时"""
+    client = proxy.client()
+    server = proxy.server
+    send_lock = threading.Lock()
+    stop = threading.Event()
+    text = b"x" * args.cut_text_bytes
+
+    def paste():
+        while not stop.is_set():
+            with send_lock:
+                client.send_cut_text(text)
+            stop.wait(args.cut_text_interval)
+
+    paster = threading.Thread(target=paste, daemon=True)
+    paster.start()
+    sent = {}
+    try:
+        for key in range(args.keys):
+            # 从打算发送的时刻算起，客户端因背压等待发送也计入延迟
+            sent[key] = time.perf_counter()
+            with send_lock:
+                client.send_key(key)
+            time.sleep(args.key_interval)
+        deadline = time.monotonic() + 30
+        while len(server.key_times) < len(sent) and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        stop.set()
+        paster.join()
+        client.close()
+    arrived = server.key_times
+    latencies = [arrived[key] - sent[key] for key in sent if key in arrived]
+    return latencies, len(sent) - len(arrived)
+
+
+def bench_input(args, results):
+    qos_args = ['--qos', '--qos-bulk-rate', str(args.qos_bulk_rate)]
+    for label, extra_args in (('plain_', []), ('', qos_args)):
+        server = FakeRFBServer(update_bytes=args.update_bytes,
+                               read_rate=args.server_read_rate).start()
+        try:
+            with ProxyProcess(server.port, args.engine, extra_args=extra_args) as proxy:
+                proxy.server = server
+                samples, lost = measure_input(proxy, args)
+                if label == '':
+                    stats = proxy.stats()
+                    results['input_forward_p50_ms'] = stats.get('input_forward_p50_ms')
+                    results['input_forward_p99_ms'] = stats.get('input_forward_p99_ms')
+        finally:
+            server.stop()
+        (results[f'{label}input_p50_ms'],
+         results[f'{label}input_p99_ms']) = percentiles_ms(samples)
+        results[f'{label}input_lost'] = lost
+
+
+def measure_pointer(proxy, args):
+    """按批发送指针移动（x坐标递增），返回最后一个位置从发送到服务器收到的耗时和服务器收到的事件数"""
+    client = proxy.client()
+    server = proxy.server
+    batch = max(1, int(args.pointer_rate / 1000))
+    last = 0
+    try:
+        started = time.perf_counter()
+        for x in range(1, args.pointer_events + 1):
+            client.send_pointer(x % 65536, 100)
+            if x % batch == 0:
+                # 按 pointer_rate 的平均速率发送
+                delay = started + x / args.pointer_rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        last = args.pointer_events % 65536
+        sent = time.perf_counter()
+        deadline = time.monotonic() + 60
+        while last not in server.pointer_times and time.monotonic() < deadline:
+            time.sleep(0.005)
+        stats = proxy.stats()
+    finally:
+        client.close()
+    arrived = server.pointer_times.get(last)
+    lag = arrived - sent if arrived is not None else None
+    return lag, len(server.pointer_times), stats
+
+
+def bench_pointer(args, results):
+    for label, extra_args in (('plain_', []), ('', ['--coalesce-pointer'])):
+        server = FakeRFBServer(update_bytes=args.update_bytes,
+                               read_rate=args.pointer_read_rate, rcvbuf=4096).start()
+        try:
+            with ProxyProcess(server.port, args.engine, extra_args=extra_args) as proxy:
+                proxy.server = server
+                lag, delivered, stats = measure_pointer(proxy, args)
+        finally:
+            server.stop()
+        results[f'{label}pointer_lag_ms'] = (round(lag * 1000, 3) if lag is not None
+                                             else None)
+        results[f'{label}pointer_delivered'] = delivered
+        if label == '':
+            results['pointer_coalesced'] = stats['counters']['pointer_coalesced'] + (
+                stats['session']['pointer_coalesced'] if stats.get('session') else 0)
+
+
+def bench_websocket(args, results):
+    server = FakeRFBServer(update_bytes=args.stream_update_bytes,
+                           mode=MODE_STREAM).start()
+    try:
+        with ProxyProcess(server.port, args.engine, extra_args=['--ws-deflate', 'on'],
+                          websocket=True) as proxy:
+            results['ws_throughput_mbps'] = measure_throughput(
+                proxy.ws_port, args.duration, websocket=True)
+            results['ws_deflate_throughput_mbps'] = measure_throughput(
+                proxy.ws_port, args.duration, websocket=True, deflate=True)
+    finally:
+        server.stop()
+    server = FakeRFBServer(update_bytes=args.update_bytes, mode=MODE_REQUEST).start()
+    try:
+        with ProxyProcess(server.port, args.engine, websocket=True) as proxy:
+            p50, p99 = percentiles_ms(measure_round_trips(
+                proxy.ws_port, args.latency_samples, websocket=True))
+            results['ws_latency_p50_ms'] = p50
+            results['ws_latency_p99_ms'] = p99
+    finally:
+        server.stop()
+
+
+def make_certificate(directory):
+    """用openssl命令行生成自签名证书，返回 (证书, 私钥) 路径"""
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    command = ['openssl', 'req', '-x509', '-newkey', 'ec',
+               '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes', '-keyout', key,
+               '-out', cert, '-days', '1', '-subj', '/CN=vnc-bench']
+    try:
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise RuntimeError(f"生成测试证书失败（需要openssl命令行）: {e}")
+    return cert, key
+
+
+def bench_tls(args, results):
+    certdir = tempfile.mkdtemp(prefix="vnc-bench-tls-")
+    try:
+        cert, key = make_certificate(certdir)
+        tls_args = ['--tls-cert', cert, '--tls-key', key]
+        server = FakeRFBServer(update_bytes=args.update_bytes).start()
+        try:
+            # 每个客户端完成RFB握手后断开：完整握手与会话恢复各 --tls-handshakes 次，
+            # 耗时取代理的统计
+            with ProxyProcess(server.port, args.engine, queue_wait=10,
+                              extra_args=tls_args) as proxy:
+                context = client_tls_context()
+                session = None
+                for _ in range(args.tls_handshakes):
+                    client = FakeRFBClient('127.0.0.1', proxy.proxy_port,
+                                           connect_retry=5, tls=context)
+                    session = client.tls_socket.session
+                    client.close()
+                for _ in range(args.tls_handshakes):
+                    client = FakeRFBClient('127.0.0.1', proxy.proxy_port,
+                                           connect_retry=5, tls=context,
+                                           tls_session=session)
+                    # 与一般客户端相同，恢复后换用新签发的票据
+                    session = client.tls_socket.session
+                    client.close()
+                stats = proxy.stats()['tls']
+        finally:
+            server.stop()
+        results['tls_full_handshake_p50_ms'] = stats['full_p50_ms']
+        results['tls_full_handshake_p99_ms'] = stats['full_p99_ms']
+        results['tls_resumed_handshake_p50_ms'] = stats['resumed_p50_ms']
+        results['tls_resumed_handshake_p99_ms'] = stats['resumed_p99_ms']
+        results['tls_resumed'] = stats['resumed']
+        server = FakeRFBServer(update_bytes=args.stream_update_bytes,
+                               mode=MODE_STREAM).start()
+        try:
+            with ProxyProcess(server.port, args.engine, extra_args=tls_args) as proxy:
+                results['tls_throughput_mbps'] = measure_throughput(
+                    proxy.proxy_port, args.duration, tls=client_tls_context())
+        finally:
+            server.stop()
+    finally:
+        shutil.rmtree(certdir, ignore_errors=True)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """打印与基线的比较，返回退化的指标列表"""
+    regressions = []
+    print(f"{'指标':<26}{'基线':>12}{'本次':>12}{'变化':>10}")
+    for name, direction in COMPARED_METRICS.items():
+        old = baseline.get(name)
+        new = results.get(name)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        worse = -change * direction > threshold
+        if worse:
+            regressions.append(name)
+        print(f"{name:<26}{old:>12}{new:>12}{change:>+9.1f}%"
+              + ("  退化" if worse else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='VNC代理转发基准测试')
+    parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread',
+                        help='代理转发引擎')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"要运行的场景，逗号分隔（默认全部: {','.join(SCENARIOS)}）")
+    parser.add_argument('--duration', type=float, default=5, help='吞吐量测量秒数')
+    parser.add_argument('--stream-update-bytes', type=int, default=1 << 20,
+                        help='吞吐量场景每条更新的像素字节数')
+    parser.add_argument('--update-bytes', type=int, default=4096,
+                        help='其他场景每条更新的像素字节数')
+    parser.add_argument('--latency-samples', type=int, default=2000, help='往返延迟采样数')
+    parser.add_argument('--accepts', type=int, default=200, help='顺序接入的客户端数')
+    parser.add_argument('--takeovers', type=int, default=20, help='接管次数')
+    parser.add_argument('--takeover-mode', choices=['reconnect', 'keep_backend'],
+                        default='reconnect',
+                        help='接管场景中代理的 --takeover-mode')
+    parser.add_argument('--refusals', type=int, default=200, help='拒绝的客户端数')
+    parser.add_argument('--concurrency', type=int, default=16, help='拒绝场景的并发客户端数')
+    parser.add_argument('--keys', type=int, default=200, help='输入场景发送的按键数')
+    parser.add_argument('--key-interval', type=float, default=0.02, help='输入场景的按键间隔秒数')
+    parser.add_argument('--cut-text-bytes', type=int, default=256 * 1024,
+                        help='输入场景每次粘贴的剪贴板字节数')
+    parser.add_argument('--cut-text-interval', type=float, default=0.1,
+                        help='输入场景的粘贴间隔秒数')
+    parser.add_argument('--server-read-rate', type=float, default=1 << 20,
+                        help='输入场景中合成服务器每秒消费的客户端数据字节数')
+    parser.add_argument('--qos-bulk-rate', type=float, default=512,
+                        help='输入场景中代理的 --qos-bulk-rate（KB/秒）')
+    parser.add_argument('--pointer-events', type=int, default=30000,
+                        help='指针场景发送的指针移动数')
+    parser.add_argument('--pointer-rate', type=float, default=20000,
+                        help='指针场景每秒发送的指针移动数')
+    parser.add_argument('--pointer-read-rate', type=float, default=60000,
+                        help='指针场景中合成服务器每秒消费的客户端数据字节数')
+    parser.add_argument('--tls-handshakes', type=int, default=200,
+                        help='TLS场景中完整握手和会话恢复各自的次数')
+    parser.add_argument('--output', help='结果JSON文件（默认输出到标准输出）')
+    parser.add_argument('--compare', help='与之前的结果JSON比较')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='比较时视为退化的变化百分比（默认10）')
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"未知场景: {', '.join(sorted(unknown))}")
+
+    runners = {
+        'throughput': bench_throughput,
+        'latency': bench_latency,
+        'accepts': bench_accepts,
+        'takeover': bench_takeover,
+        'refusal': bench_refusal,
+        'input': bench_input,
+        'pointer': bench_pointer,
+        'websocket': bench_websocket,
+        'tls': bench_tls,
+    }
+    results = {}
+    for name in scenarios:
+        print(f"运行场景: {name}", file=sys.stderr)
+        runners[name](args, results)
+
+    report = {
+        'benchmark': 'vnc-proxy-relay',
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'engine': args.engine,
+        'parameters': {key: value for key, value in vars(args).items()
+                       if key not in ('output', 'compare', 'threshold')},
+        'results': results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline.get('results', {}), args.threshold)
+        if regressions:
+            print(f"性能退化: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+VNC代理启动时间基准测试
+每次测量都启动新的解释器进程（.pyc缓存已存在，第一次运行作为预热不计入），测量：
+- import_ms：python -X importtime 统计的 import vnc_proxy 累计耗时（中位数）
+- startup_to_listen_ms：启动 vnc_proxy.py --no-gui 到代理端口可以连接的时间（中位数）
+- modules_imported：导入vnc_proxy的进程中加载的模块数（含解释器启动）
+- gui_modules：无GUI路径上不应出现的模块（tkinter、pystray、PIL、http.server 等），出现时以非零状态退出
+- slowest_imports：vnc_proxy 直接导入的模块中累计耗时最长的几个
+
+结果以JSON输出，--compare 与之前的结果比较，超过阈值的退化以非零状态退出：
+    python benchmarks/bench_startup.py --output startup.json
+    python benchmarks/bench_startup.py --compare startup.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from bench_relay import free_port, git_revision  # noqa: E402
+
+# 无GUI启动时不应加载的模块（按模块名前缀匹配）
+GUI_MODULES = ('tkinter', '_tkinter', 'pystray', 'PIL', 'vnc_proxy_gui', 'http.server')
+
+# 参与比较的指标：均为越小越好
+COMPARED_METRICS = ('import_ms', 'startup_to_listen_ms')
+
+
+def parse_importtime(output):
+    """解析 -X importtime 的输出 -> [(缩进层级, 模块名, 自身us, 累计us)]"""
+    entries = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line.split(':', 1)[1].split('|', 2)
+        # 模块名前的缩进：一个空格后每层两个空格
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        entries.append((depth, name.strip(), int(self_us), int(cumulative_us)))
+    return entries
+
+
+def measure_import():
+    """在新进程中导入vnc_proxy，返回 (累计毫秒, 模块列表, 直接导入的模块耗时)"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             'import vnc_proxy'],
+                            cwd=REPO_DIR, capture_output=True, text=True, check=True)
+    entries = parse_importtime(result.stderr)
+    total = next(cumulative for depth, name, _, cumulative in entries
+                 if depth == 0 and name == 'vnc_proxy')
+    children = [(name, cumulative) for depth, name, _, cumulative in entries
+                if depth == 1]
+    return total / 1000, [name for _, name, _, _ in entries], children
+
+
+def measure_listen(timeout=15):
+    """启动无GUI代理，返回到代理端口可以连接为止的毫秒数"""
+    workdir = tempfile.mkdtemp(prefix="vnc-startup-")
+    port = free_port()
+    command = [sys.executable, os.path.join(REPO_DIR, 'vnc_proxy.py'), '--no-gui',
+               '--proxy-port', str(port), '--vnc-port', str(free_port()),
+               '--log-file', '']
+    started = time.perf_counter()
+    process = subprocess.Popen(command, cwd=workdir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"代理进程已退出，返回码 {process.returncode}")
+            try:
+                socket.create_connection(('127.0.0.1', port), 0.5).close()
+                return (time.perf_counter() - started) * 1000
+            except OSError:
+                time.sleep(0.002)
+        raise RuntimeError("等待代理开始监听超时")
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(results, baseline, threshold):
+    """打印与基线的比较，返回退化的指标列表"""
+    regressions = []
+    print(f"{'指标':<26}{'基线':>12}{'本次':>12}{'变化':>10}")
+    for name in COMPARED_METRICS:
+        old = baseline.get(name)
+        new = results.get(name)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        worse = change > threshold
+        if worse:
+            regressions.append(name)
+        print(f"{name:<26}{old:>12}{new:>12}{change:>+9.1f}%"
+              + ("  退化" if worse else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='VNC代理启动时间基准测试')
+    parser.add_argument('--runs', type=int, default=10, help='每项测量的次数（另有一次预热）')
+    parser.add_argument('--top', type=int, default=8, help='输出耗时最长的直接导入模块数')
+    parser.add_argument('--output', help='结果JSON文件（默认输出到标准输出）')
+    parser.add_argument('--compare', help='与之前的结果JSON比较')
+    parser.add_argument('--threshold', type=float, default=20,
+                        help='比较时视为退化的变化百分比（默认20，启动时间波动较大）')
+    args = parser.parse_args()
+
+    print("测量导入时间", file=sys.stderr)
+    measure_import()
+    imports = [measure_import() for _ in range(args.runs)]
+    modules = imports[-1][1]
+    children = sorted(imports[-1][2], key=lambda item: item[1], reverse=True)[:args.top]
+
+    print("测量启动到监听的时间", file=sys.stderr)
+    measure_listen()
+    listen = [measure_listen() for _ in range(args.runs)]
+
+    gui_modules = sorted({name for name in modules
+                          if any(name == prefix or name.startswith(prefix + '.')
+                                 for prefix in GUI_MODULES)})
+    results = {
+        'import_ms': round(statistics.median(total for total, _, _ in imports), 2),
+        'startup_to_listen_ms': round(statistics.median(listen), 2),
+        'modules_imported': len(modules),
+        'gui_modules': gui_modules,
+        'slowest_imports': {name: round(cumulative / 1000, 2)
+                            for name, cumulative in children},
+    }
+    report = {
+        'benchmark': 'vnc-proxy-startup',
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {'runs': args.runs},
+        'results': results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    failed = False
+    if gui_modules:
+        print(f"无GUI启动路径加载了GUI模块: {', '.join(gui_modules)}", file=sys.stderr)
+        failed = True
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline.get('results', {}), args.threshold)
+        if regressions:
+            print(f"启动时间退化: {', '.join(regressions)}", file=sys.stderr)
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
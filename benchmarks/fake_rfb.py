@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+基准测试用的合成RFB端点
+- FakeRFBServer：RFB 3.8无认证服务器，按请求回复或按固定速率推送Raw编码的FramebufferUpdate，
+  可按指定速率消费客户端数据（模拟处理较慢的服务器），并记录每个KeyEvent和PointerEvent的到达时间
+- FakeRFBClient：完成握手后发送更新请求、读取更新并取出服务器写入的时间戳，也可发送按键、指针和剪贴板；
+  websocket=True 时经代理的WebSocket端口连接（WebSocketClient，可请求permessage-deflate），
+  tls 为客户端TLS上下文时先完成TLS握手，可带上之前连接的会话（tls_session）以恢复会话
+更新的像素数据前8字节是服务器发送时的 perf_counter_ns，客户端与服务器在同一进程中，可直接计算单程延迟。
+"""
+
+import base64
+import os
+import socket
+import ssl
+import struct
+import sys
+import threading
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rfb  # noqa: E402
+from websocket_listener import DEFLATE_TAIL, OP_BINARY, OP_CLOSE, unmask  # noqa: E402
+
+MODE_REQUEST = "request"  # 每收到一个更新请求回复一次
+MODE_STREAM = "stream"    # 收到首个更新请求后持续推送
+
+U64 = struct.Struct('>Q')
+U32 = struct.Struct('>I')
+U16 = struct.Struct('>H')
+UPDATE_HEADER_SIZE = 4 + rfb.RECT_HEADER_STRUCT.size
+
+DEFAULT_PIXEL_FORMAT = rfb.PixelFormat(32, 24, 0, 1, 255, 255, 255, 16, 8, 0)
+
+
+def build_update(width, height, update_bytes):
+    """构造一条单矩形Raw编码的FramebufferUpdate，像素数据约为update_bytes字节"""
+    rect_width = max(2, min(width, update_bytes // 4))
+    rect_height = max(1, min(height, update_bytes // (rect_width * 4)))
+    message = bytearray(UPDATE_HEADER_SIZE + rect_width * rect_height * 4)
+    struct.pack_into('>BxH', message, 0, rfb.FRAMEBUFFER_UPDATE, 1)
+    rfb.RECT_HEADER_STRUCT.pack_into(message, 4, 0, 0, rect_width, rect_height,
+                                     rfb.ENCODING_RAW)
+    return message
+
+
+class StreamReader:
+    """客户端读取器，可以跳过不需要的像素数据而不复制"""
+
+    def __init__(self, sock, size=1 << 20):
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def _fill(self):
+        n = self.sock.recv_into(self.buffer)
+        if not n:
+            raise EOFError("连接已关闭")
+        self.start = 0
+        self.end = n
+
+    def read(self, n):
+        """读取n字节"""
+        out = bytearray()
+        while len(out) < n:
+            if self.start == self.end:
+                self._fill()
+            take = min(n - len(out), self.end - self.start)
+            out += self.view[self.start:self.start + take]
+            self.start += take
+        return bytes(out)
+
+    def skip(self, n):
+        """丢弃n字节"""
+        while n:
+            if self.start == self.end:
+                self._fill()
+            take = min(n, self.end - self.start)
+            self.start += take
+            n -= take
+
+
+class FakeRFBServer:
+    """合成VNC服务器，每个连接一个线程"""
+
+    def __init__(self, width=1280, height=720, update_bytes=65536, mode=MODE_REQUEST,
+                 rate=0, host='127.0.0.1', port=0, read_rate=0, rcvbuf=0):
+        self.server_init = rfb.ServerInit(width, height, DEFAULT_PIXEL_FORMAT, b"bench")
+        self.update = build_update(width, height, update_bytes)
+        self.mode = mode
+        # 推送模式下每秒的更新数，0为尽快发送
+        self.rate = rate
+        # 每秒消费的客户端数据字节数，0为不限制
+        self.read_rate = read_rate
+        # KeyEvent的键值 -> 到达时间（perf_counter）
+        self.key_times = {}
+        # PointerEvent的x坐标 -> 到达时间（perf_counter）
+        self.pointer_times = {}
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if rcvbuf:
+            # 接受的连接继承接收缓冲区大小，缩小内核中积压的客户端数据
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.listener.bind((host, port))
+        self.listener.listen(128)
+        self.host, self.port = self.listener.getsockname()
+        self.running = False
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.connections = 0
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.running = False
+        try:
+            self.listener.close()
+        except OSError:
+            pass
+        with self.lock:
+            clients = list(self.clients)
+        for sock in clients:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+                sock.close()
+            except OSError:
+                pass
+
+    def accept_loop(self):
+        while self.running:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                self.clients.add(sock)
+                self.connections += 1
+            threading.Thread(target=self.serve, args=(sock,), daemon=True).start()
+
+    def serve(self, sock):
+        update = bytearray(self.update)
+        streaming = threading.Event()
+        try:
+            reader = rfb.SocketReader(sock)
+            rfb.server_handshake(sock, reader, self.server_init)
+            while self.running:
+                message_type, message = rfb.read_client_message(reader)
+                if self.read_rate:
+                    time.sleep(len(message) / self.read_rate)
+                if message_type == rfb.KEY_EVENT:
+                    self.key_times[U32.unpack_from(message, 4)[0]] = time.perf_counter()
+                elif message_type == rfb.POINTER_EVENT:
+                    x = U16.unpack_from(message, 2)[0]
+                    self.pointer_times[x] = time.perf_counter()
+                if message_type != rfb.FRAMEBUFFER_UPDATE_REQUEST:
+                    continue
+                if self.mode == MODE_REQUEST:
+                    U64.pack_into(update, UPDATE_HEADER_SIZE, time.perf_counter_ns())
+                    sock.sendall(update)
+                elif not streaming.is_set():
+                    streaming.set()
+                    threading.Thread(target=self.stream, args=(sock, update),
+                                     daemon=True).start()
+        except (OSError, EOFError, rfb.RFBError):
+            pass
+        finally:
+            with self.lock:
+                self.clients.discard(sock)
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def stream(self, sock, update):
+        interval = 1.0 / self.rate if self.rate > 0 else 0
+        next_send = time.perf_counter()
+        try:
+            while self.running:
+                U64.pack_into(update, UPDATE_HEADER_SIZE, time.perf_counter_ns())
+                sock.sendall(update)
+                if interval:
+                    next_send += interval
+                    delay = next_send - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+        except OSError:
+            pass
+
+
+class WebSocketClient:
+    """客户端WebSocket连接的类套接字包装：发送加掩码的二进制帧，接收时去掉帧头并解压"""
+
+    def __init__(self, sock, host, port, deflate=False):
+        self.sock = sock
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        request = (f"GET / HTTP/1.1\r\nHost: {host}:{port}\r\nUpgrade: websocket\r\n"
+                   f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\n"
+                   f"Sec-WebSocket-Version: 13\r\nSec-WebSocket-Protocol: binary\r\n")
+        if deflate:
+            request += ("Sec-WebSocket-Extensions: permessage-deflate; "
+                        "client_max_window_bits\r\n")
+        sock.sendall((request + "\r\n").encode('ascii'))
+        response = b""
+        while b"\r\n\r\n" not in response:
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise EOFError("WebSocket握手时连接已关闭")
+            response += chunk
+        head, _, rest = response.partition(b"\r\n\r\n")
+        self.raw = bytearray(rest)
+        if not head.startswith(b"HTTP/1.1 101"):
+            raise ConnectionError(f"WebSocket握手失败: {head.splitlines()[0]!r}")
+        self.deflate = b"permessage-deflate" in head.lower()
+        self.decompressor = zlib.decompressobj(-15)
+        self.data = b""
+
+    def setsockopt(self, *args):
+        self.sock.setsockopt(*args)
+
+    def sendall(self, data):
+        length = len(data)
+        if length < 126:
+            header = struct.pack('>BB', 0x80 | OP_BINARY, 0x80 | length)
+        elif length < 65536:
+            header = struct.pack('>BBH', 0x80 | OP_BINARY, 0x80 | 126, length)
+        else:
+            header = struct.pack('>BBQ', 0x80 | OP_BINARY, 0x80 | 127, length)
+        mask = os.urandom(4)
+        self.sock.sendall(header + mask + unmask(data, mask))
+
+    def _read_frame(self):
+        """读取一个服务器帧，返回其中的数据；连接关闭时返回None"""
+        raw = self.raw
+        while True:
+            if len(raw) >= 2:
+                length = raw[1] & 0x7f
+                offset = 2
+                if length == 126:
+                    offset = 4
+                elif length == 127:
+                    offset = 10
+                if len(raw) >= offset:
+                    if offset == 4:
+                        length = U16.unpack_from(raw, 2)[0]
+                    elif offset == 10:
+                        length = U64.unpack_from(raw, 2)[0]
+                    if len(raw) >= offset + length:
+                        first = raw[0]
+                        payload = bytes(raw[offset:offset + length])
+                        del raw[:offset + length]
+                        if first & 0x0f == OP_CLOSE:
+                            return None
+                        if first & 0x40:
+                            payload = self.decompressor.decompress(
+                                payload + DEFLATE_TAIL)
+                        return payload
+            chunk = self.sock.recv(1 << 20)
+            if not chunk:
+                return None
+            raw += chunk
+
+    def recv_into(self, buffer):
+        while not self.data:
+            data = self._read_frame()
+            if data is None:
+                return 0
+            self.data = data
+        n = min(len(buffer), len(self.data))
+        buffer[:n] = self.data[:n]
+        self.data = self.data[n:]
+        return n
+
+    def close(self):
+        self.sock.close()
+
+
+def client_tls_context():
+    """不验证证书的客户端TLS上下文（测试用自签名证书）"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class FakeRFBClient:
+    """合成VNC客户端"""
+
+    def __init__(self, host, port, timeout=10, connect_retry=0, websocket=False,
+                 deflate=False, tls=None, tls_session=None):
+        deadline = time.monotonic() + connect_retry
+        while True:
+            try:
+                self.sock = socket.create_connection((host, port), timeout)
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.05)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # TLS连接，握手后 tls_socket.session 可用于下一次连接恢复会话
+        self.tls_socket = None
+        if tls is not None:
+            self.sock = self.tls_socket = tls.wrap_socket(self.sock,
+                                                          server_hostname=host,
+                                                          session=tls_session)
+        if websocket:
+            self.sock = WebSocketClient(self.sock, host, port, deflate)
+        self.reader = StreamReader(self.sock)
+        self.version, self.server_init = rfb.client_handshake(self.sock, self.reader)
+
+    def request_update(self, incremental=True):
+        init = self.server_init
+        self.sock.sendall(rfb.build_update_request(incremental, 0, 0, init.width,
+                                                   init.height))
+
+    def send_key(self, key, down=True):
+        self.sock.sendall(struct.pack('>BBxxI', rfb.KEY_EVENT, 1 if down else 0, key))
+
+    def send_pointer(self, x, y, buttons=0):
+        self.sock.sendall(struct.pack('>BBHH', rfb.POINTER_EVENT, buttons, x, y))
+
+    def send_cut_text(self, text):
+        self.sock.sendall(struct.pack('>BxxxI', rfb.CLIENT_CUT_TEXT, len(text)) + text)
+
+    def read_update(self):
+        """读取一条Raw编码的FramebufferUpdate，返回(字节数, 服务器发送时间戳ns)"""
+        reader = self.reader
+        header = reader.read(4)
+        if header[0] != rfb.FRAMEBUFFER_UPDATE:
+            raise rfb.RFBError(f"意外的服务器消息类型: {header[0]}")
+        count = struct.unpack_from('>H', header, 2)[0]
+        size = 4
+        stamp = None
+        for _ in range(count):
+            x, y, width, height, encoding = rfb.RECT_HEADER_STRUCT.unpack(
+                reader.read(rfb.RECT_HEADER_STRUCT.size))
+            if encoding != rfb.ENCODING_RAW:
+                raise rfb.RFBError(f"基准测试只支持Raw编码，收到 {encoding}")
+            length = width * height * 4
+            size += rfb.RECT_HEADER_STRUCT.size + length
+            if stamp is None and length >= U64.size:
+                stamp = U64.unpack(reader.read(U64.size))[0]
+                length -= U64.size
+            reader.skip(length)
+        return size, stamp
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+def read_refusal(host, port, timeout=10):
+    """连接并读取代理的RFB拒绝消息，返回失败原因；未被拒绝时返回None"""
+    sock = socket.create_connection((host, port), timeout)
+    try:
+        reader = StreamReader(sock)
+        reader.read(12)
+        sock.sendall(b"RFB 003.008\n")
+        if reader.read(1)[0] != 0:
+            return None
+        length = struct.unpack('>I', reader.read(4))[0]
+        return reader.read(length).decode('utf-8', 'replace')
+    finally:
+        sock.close()
@@ -47,8 +47,8 @@ def check_dependencies():
     
     return True
 
-def install_dependencies():
-    """安装依赖"""
+def install_dependencies(headless=False):
+    """安装依赖，无GUI版只需要PyInstaller"""
     print("\n安装项目依赖...")
     
     # 使用uv安装依赖
@@ -57,6 +57,8 @@ def install_dependencies():
         ("uv pip install pystray>=0.19.4", "安装pystray"),
         ("uv pip install pyinstaller>=5.0", "安装PyInstaller"),
     ]
+    if headless:
+        commands = commands[2:]
     
     for cmd, desc in commands:
         if not run_command(cmd, desc):
@@ -65,9 +67,27 @@ def install_dependencies():
     
     return True
 
-def create_spec_file():
+# 打包目标：GUI版（窗口+系统托盘）和无GUI版（服务器用，不含tkinter/pystray/PIL）
+GUI_TARGET = {
+    'name': 'VNC代理服务器',
+    'spec': 'vnc_proxy.spec',
+    'hiddenimports': ['vnc_proxy_gui', 'PIL._tkinter_finder', 'pystray._base',
+                      'pystray._win32'],
+    'excludes': [],
+    'console': False,  # 隐藏控制台窗口
+}
+HEADLESS_TARGET = {
+    'name': 'VNC代理服务器-headless',
+    'spec': 'vnc_proxy_headless.spec',
+    'hiddenimports': [],
+    # GUI代码在vnc_proxy_gui中按需导入，无GUI版直接排除
+    'excludes': ['vnc_proxy_gui', 'tkinter', '_tkinter', 'PIL', 'pystray'],
+    'console': True,
+}
+
+def create_spec_file(target=GUI_TARGET):
     """创建PyInstaller规格文件"""
-    spec_content = '''# -*- mode: python ; coding: utf-8 -*-
+    spec_content = f'''# -*- mode: python ; coding: utf-8 -*-
 
 block_cipher = None
 
@@ -76,15 +96,11 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[],
-    hiddenimports=[
-        'PIL._tkinter_finder',
-        'pystray._base',
-        'pystray._win32',
-    ],
+    hiddenimports={target['hiddenimports']!r},
     hookspath=[],
-    hooksconfig={},
+    hooksconfig={{}},
     runtime_hooks=[],
-    excludes=[],
+    excludes={target['excludes']!r},
     win_no_prefer_redirects=False,
     win_private_assemblies=False,
     cipher=block_cipher,
@@ -100,14 +116,14 @@ exe = EXE(
     a.zipfiles,
     a.datas,
     [],
-    name='VNC代理服务器',
+    name={target['name']!r},
     debug=False,
     bootloader_ignore_signals=False,
     strip=False,
     upx=True,
     upx_exclude=[],
     runtime_tmpdir=None,
-    console=False,  # 设置为False隐藏控制台窗口
+    console={target['console']!r},
     disable_windowed_traceback=False,
     argv_emulation=False,
     target_arch=None,
@@ -117,10 +133,10 @@ exe = EXE(
 )
 '''
     
-    with open('vnc_proxy.spec', 'w', encoding='utf-8') as f:
+    with open(target['spec'], 'w', encoding='utf-8') as f:
         f.write(spec_content)
     
-    print("✅ 创建PyInstaller规格文件: vnc_proxy.spec")
+    print(f"✅ 创建PyInstaller规格文件: {target['spec']}")
 
 def create_icon():
     """创建应用图标"""
@@ -155,7 +171,12 @@ def create_icon():
         print(f"⚠️  创建图标失败: {e}")
         return False
 
-def build_exe():
+def exe_path(target):
+    """打包输出的可执行文件路径"""
+    suffix = '.exe' if sys.platform == 'win32' else ''
+    return Path(f"dist/{target['name']}{suffix}")
+
+def build_exe(target=GUI_TARGET):
     """构建exe文件"""
     print("\n开始构建exe文件...")
     
@@ -169,16 +190,16 @@ def build_exe():
         print("清理build目录")
     
     # 使用PyInstaller构建
-    cmd = "pyinstaller --clean vnc_proxy.spec"
+    cmd = f"pyinstaller --clean {target['spec']}"
     if not run_command(cmd, "使用PyInstaller构建exe文件"):
         return False
     
     # 检查输出文件
-    exe_path = Path("dist/VNC代理服务器.exe")
-    if exe_path.exists():
-        size_mb = exe_path.stat().st_size / (1024 * 1024)
+    output = exe_path(target)
+    if output.exists():
+        size_mb = output.stat().st_size / (1024 * 1024)
         print(f"✅ 构建成功！")
-        print(f"   文件位置: {exe_path.absolute()}")
+        print(f"   文件位置: {output.absolute()}")
         print(f"   文件大小: {size_mb:.1f} MB")
         return True
     else:
@@ -187,7 +208,15 @@ def build_exe():
 
 def main():
     """主函数"""
-    print("VNC代理服务器 - 打包工具")
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='VNC代理服务器打包工具')
+    parser.add_argument('--headless', action='store_true',
+                        help='构建无GUI版（控制台程序，不含tkinter、pystray和PIL，始终以无GUI模式运行）')
+    args = parser.parse_args()
+    target = HEADLESS_TARGET if args.headless else GUI_TARGET
+    
+    print("VNC代理服务器 - 打包工具" + ("（无GUI版）" if args.headless else ""))
     print("=" * 50)
     
     try:
@@ -196,23 +225,27 @@ def main():
             return False
         
         # 安装依赖
-        if not install_dependencies():
+        if not install_dependencies(args.headless):
             return False
         
-        # 创建图标
-        create_icon()
+        # 创建图标（无GUI版不安装PIL，沿用已有的icon.ico）
+        if not args.headless:
+            create_icon()
         
         # 创建规格文件
-        create_spec_file()
+        create_spec_file(target)
         
         # 构建exe
-        if not build_exe():
+        if not build_exe(target):
             return False
         
         print("\n" + "=" * 50)
         print("🎉 打包完成！")
-        print("可执行文件位于: dist/VNC代理服务器.exe")
-        print("双击运行即可启动VNC代理服务器")
+        print(f"可执行文件位于: {exe_path(target)}")
+        if args.headless:
+            print("在服务器上运行: VNC代理服务器-headless --no-gui")
+        else:
+            print("双击运行即可启动VNC代理服务器")
         print("=" * 50)
         
         return True
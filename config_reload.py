@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+配置热重载
+收到 SIGHUP 或从托盘菜单/窗口按钮触发时重新读取配置文件（--config 或 --settings），
+按桌面名称把新设置应用到运行中的代理（SimpleVNCProxy.apply_settings），当前会话不中断：
+- 后端地址和预热连接池用于之后的新会话
+- 冷却期、决策超时、排队和连接速率限制立即生效
+- 监听端口只在变化时重新绑定，新端口绑定失败时继续使用旧端口
+- 增删桌面以及共享观看、接管方式等会话模式设置需要重启
+配置文件读取或校验失败时保持原有设置不变。
+"""
+
+import logging
+import signal
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigReloader:
+    """重新读取配置文件并应用到运行中的桌面"""
+
+    def __init__(self, load, proxies):
+        # load() 返回所有桌面的完整设置列表（vnc_proxy.load_desktops）
+        self.load = load
+        self.proxies = list(proxies)
+        self.lock = threading.Lock()
+        self.reloads = 0
+        self.failures = 0
+
+    def reload(self):
+        """重新加载配置，返回是否成功读取；同一时间只进行一次"""
+        with self.lock:
+            try:
+                desktops = self.load()
+            except (OSError, ValueError, KeyError) as e:
+                self.failures += 1
+                logger.error(f"重新加载配置失败，保持原有设置: {e}")
+                return False
+
+            self.reloads += 1
+            if len(self.proxies) == 1 and len(desktops) == 1:
+                # 单桌面模式没有名称可供匹配
+                matched = [(self.proxies[0], desktops[0])]
+            else:
+                by_name = {desktop['name']: desktop for desktop in desktops}
+                matched = [(proxy, by_name.pop(proxy.name)) for proxy in self.proxies
+                           if proxy.name in by_name]
+                found = {proxy for proxy, _ in matched}
+                missing = [proxy.name for proxy in self.proxies if proxy not in found]
+                if missing:
+                    logger.warning(f"配置中已没有桌面 {', '.join(missing)}，移除桌面需要重启")
+                if by_name:
+                    logger.warning(f"新增的桌面 {', '.join(by_name)} 需要重启才能启动")
+
+            changed = 0
+            for proxy, settings in matched:
+                try:
+                    if proxy.apply_settings(settings):
+                        changed += 1
+                except Exception as e:
+                    proxy.logger.error(f"应用新配置失败: {e}")
+            logger.info(f"配置已重新加载，{changed} 个桌面的设置有变化")
+            return True
+
+    def reload_async(self):
+        """在后台线程中重新加载（信号处理函数和GUI回调中使用，不阻塞调用方）"""
+        threading.Thread(target=self.reload, name="config-reload", daemon=True).start()
+
+    def install_signal(self):
+        """收到 SIGHUP 时重新加载，没有该信号的系统（Windows）只能从GUI触发"""
+        if not hasattr(signal, 'SIGHUP'):
+            return False
+        try:
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.reload_async())
+        except ValueError:
+            # 不在主线程中
+            return False
+        return True
+
+    def get_stats(self):
+        return {'reloads': self.reloads, 'failures': self.failures}
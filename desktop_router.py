@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多桌面路由
+一个进程按配置文件同时服务多个 代理端口 -> VNC服务器 映射，
+所有桌面共用一个接受连接/转发引擎，每个桌面各自执行单用户、冷却期和决策策略
+"""
+
+import json
+import logging
+import selectors
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# 桌面配置项及默认值
+DESKTOP_DEFAULTS = {
+    'vnc_host': '127.0.0.1',
+    'vnc_port': 5901,
+    'grace_period': 60,
+    'shared_view': False,
+}
+
+
+def load_desktop_config(path):
+    """读取多桌面配置文件，返回桌面配置列表
+
+    配置格式:
+    {
+        "desktops": [
+            {"name": "desk01", "proxy_port": 5900, "vnc_host": "127.0.0.1",
+             "vnc_port": 5901, "ws_port": 6080,
+             "tls_cert": "desk01.pem", "tls_key": "desk01.key"},
+            {"name": "desk02", "proxy_port": 5902, "vnc_port": 5903, "grace_period": 30,
+             "shared_view": true, "fb_cache_mb": 64, "reconnect_linger": 30},
+            {"name": "desk03", "proxy_port": 5904, "vnc_host": "10.0.0.13",
+             "pool_size": 2,
+             "encoding_policy": [{"match": "!lan", "prefer": ["zrle"],
+                                  "compression": 6}],
+             "record": false}
+        ]
+    }
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    desktops = []
+    names = set()
+    ports = set()
+    for index, entry in enumerate(config.get('desktops', [])):
+        if 'proxy_port' not in entry:
+            raise ValueError(f"第 {index + 1} 个桌面缺少 proxy_port")
+        desktop = dict(DESKTOP_DEFAULTS)
+        desktop.update(entry)
+        desktop['proxy_port'] = int(desktop['proxy_port'])
+        desktop['vnc_port'] = int(desktop['vnc_port'])
+        desktop.setdefault('name', f"desktop-{desktop['proxy_port']}")
+        if desktop['name'] in names:
+            raise ValueError(f"桌面名称重复: {desktop['name']}")
+        if desktop['proxy_port'] in ports:
+            raise ValueError(f"代理端口重复: {desktop['proxy_port']}")
+        names.add(desktop['name'])
+        ports.add(desktop['proxy_port'])
+        if desktop.get('ws_port'):
+            desktop['ws_port'] = int(desktop['ws_port'])
+            if desktop['ws_port'] in ports:
+                raise ValueError(f"WebSocket端口重复: {desktop['ws_port']}")
+            ports.add(desktop['ws_port'])
+        desktops.append(desktop)
+
+    if not desktops:
+        raise ValueError("配置文件中没有桌面映射")
+    return desktops
+
+
+def load_desktop_settings(path):
+    """读取单桌面设置文件（--settings），返回其中的设置项，未出现的项由命令行参数决定
+
+    格式与多桌面配置中的一个桌面项相同，但不需要 proxy_port:
+    {"vnc_host": "10.0.0.12", "vnc_port": 5901, "grace_period": 30, "queue_wait": 60}
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        settings = json.load(f)
+
+    if not isinstance(settings, dict) or 'desktops' in settings:
+        raise ValueError("单桌面设置文件应为一个桌面的设置项，多桌面配置请使用 --config")
+    for key in ('proxy_port', 'vnc_port', 'ws_port'):
+        if key in settings:
+            settings[key] = int(settings[key])
+    return settings
+
+
+class DesktopRouter:
+    """在一个进程中运行多个桌面代理"""
+
+    def __init__(self, proxies, engine="thread", stats_interval=0):
+        self.proxies = list(proxies)
+        self.engine_name = engine
+        self.engine = None
+        self.stats_interval = stats_interval
+        self.is_running = False
+        self.window = None
+        # 配置重新加载（config_reload.ConfigReloader），由main()设置
+        self.reloader = None
+        # 重新加载配置后待替换的监听套接字 (桌面, 新套接字)，由选择器线程替换
+        self.listener_changes = deque()
+
+    def start_server(self):
+        """启动所有桌面的监听，阻塞直到停止"""
+        if self.engine_name == "asyncio":
+            from async_engine import AsyncioEngine
+            self.engine = AsyncioEngine(self.proxies, self.stats_interval,
+                                        self.log_stats)
+            self.is_running = True
+            self.engine.run()
+            self.is_running = False
+            return
+        self.serve_threaded()
+
+    def serve_threaded(self):
+        """线程模式：一个线程用选择器接受所有桌面的连接"""
+        selector = selectors.DefaultSelector()
+        for proxy in self.proxies:
+            try:
+                server_socket = proxy.create_listen_socket()
+            except Exception as e:
+                proxy.logger.error(f"启动服务器失败: {e}")
+                continue
+            server_socket.setblocking(False)
+            proxy.server_socket = server_socket
+            proxy.acceptor = self
+            proxy.is_running = True
+            selector.register(server_socket, selectors.EVENT_READ, proxy)
+            proxy.logger.info(f"简化VNC代理服务器启动在端口 {proxy.proxy_port}")
+            proxy.start_backend_pool()
+            proxy.start_websocket()
+
+        if not selector.get_map():
+            selector.close()
+            return
+
+        self.is_running = True
+        logger.info(f"多桌面模式已启动，共 {len(selector.get_map())} 个桌面")
+        self.start_stats_reporter()
+
+        try:
+            while self.is_running:
+                self.swap_listeners(selector)
+                # 带超时以便及时发现停止请求和监听套接字的替换
+                for key, _ in selector.select(timeout=1.0):
+                    proxy = key.data
+                    try:
+                        client_socket, client_addr = key.fileobj.accept()
+                    except BlockingIOError:
+                        continue
+                    except OSError as e:
+                        if self.is_running and proxy.is_running:
+                            proxy.logger.error(f"接受连接错误: {e}")
+                        continue
+                    client_socket.setblocking(True)
+                    proxy.dispatch_client(client_socket, client_addr)
+        finally:
+            selector.close()
+
+    def replace_listener(self, proxy, server_socket):
+        """替换一个桌面的监听套接字（监听端口变化时由重新加载配置的线程调用）"""
+        server_socket.setblocking(False)
+        self.listener_changes.append((proxy, server_socket))
+
+    def swap_listeners(self, selector):
+        """在选择器线程中换上新的监听套接字并关闭旧的"""
+        while self.listener_changes:
+            proxy, server_socket = self.listener_changes.popleft()
+            old_socket, proxy.server_socket = proxy.server_socket, server_socket
+            try:
+                selector.unregister(old_socket)
+            except (KeyError, ValueError):
+                pass
+            old_socket.close()
+            selector.register(server_socket, selectors.EVENT_READ, proxy)
+
+    def stop_server(self):
+        """停止所有桌面"""
+        self.is_running = False
+        if self.engine:
+            self.engine.stop()
+        for proxy in self.proxies:
+            proxy.is_running = False
+            if not self.engine and proxy.server_socket:
+                try:
+                    proxy.server_socket.close()
+                except OSError:
+                    pass
+            if proxy.backend_pool:
+                proxy.backend_pool.stop()
+            if proxy.websocket:
+                proxy.websocket.stop()
+            proxy.admission.close()
+            if proxy.active_session:
+                proxy.cleanup_session()
+        while self.listener_changes:
+            self.listener_changes.popleft()[1].close()
+        recorders = {id(p.recorder): p.recorder for p in self.proxies if p.recorder}
+        for recorder in recorders.values():
+            recorder.drain()
+
+    def get_stats(self):
+        """汇总各桌面的运行统计"""
+        return {proxy.name: proxy.get_stats() for proxy in self.proxies}
+
+    def log_stats(self):
+        """输出各桌面的统计日志"""
+        for proxy in self.proxies:
+            proxy.log_stats()
+
+    def start_stats_reporter(self):
+        """启动定期统计日志线程"""
+        if self.stats_interval <= 0:
+            return
+
+        def report():
+            while self.is_running:
+                time.sleep(self.stats_interval)
+                if self.is_running:
+                    self.log_stats()
+
+        threading.Thread(target=report, daemon=True).start()
+
+    def start_gui(self):
+        """启动共享的GUI窗口（vnc_proxy_gui.RouterWindow，按需导入）"""
+        from vnc_proxy_gui import RouterWindow
+
+        self.window = RouterWindow(self)
+        self.window.run()
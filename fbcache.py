@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+代理侧帧缓冲区缓存
+在代理终结握手的连接上解码服务器发来的更新，按会话像素格式把当前画面
+保存在一块连续的 bytearray 中，新接入或接管的客户端可以直接收到由内存
+合成的全屏更新，而后端继续发送增量更新。
+只解码共享连接会使用的编码（shared_view.CACHED_ENCODINGS）：ZRLE等依赖整条连接zlib状态的编码，
+转发给中途加入的客户端后无法解码，共享连接不使用，这里也不解码。
+"""
+
+import struct
+
+import rfb
+
+# 覆盖率统计的分块大小
+COVERAGE_TILE = 64
+
+
+class FramebufferCache:
+    """按像素格式保存的帧缓冲区
+
+    调用方负责串行化：只有后端读取线程调用 apply()，
+    其他线程在与之相同的锁内调用 full_update()。
+    """
+
+    def __init__(self, width, height, pixel_format, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.pixels = None
+        self.decode_errors = 0
+        self.reset(width, height, pixel_format)
+
+    @property
+    def enabled(self):
+        """缓存是否在内存预算之内"""
+        return self.pixels is not None
+
+    @property
+    def valid(self):
+        """缓存是否已覆盖完整画面"""
+        return self.pixels is not None and self.uncovered == 0
+
+    def memory_bytes(self):
+        """占用的像素内存"""
+        return len(self.pixels) if self.pixels is not None else 0
+
+    def reset(self, width, height, pixel_format):
+        """按新的尺寸或像素格式重新分配，内容失效直到重新被完整覆盖"""
+        self.width = width
+        self.height = height
+        self.pixel_format = pixel_format
+        self.bytes_per_pixel = pixel_format.bits_per_pixel // 8
+        self.stride = width * self.bytes_per_pixel
+        size = self.stride * height
+        if size > self.budget_bytes or self.bytes_per_pixel not in (1, 2, 4):
+            self.pixels = None
+            self.uncovered = 0
+            return
+        self.pixels = bytearray(size)
+        self.tiles_x = (width + COVERAGE_TILE - 1) // COVERAGE_TILE
+        self.tiles_y = (height + COVERAGE_TILE - 1) // COVERAGE_TILE
+        self.coverage = bytearray(self.tiles_x * self.tiles_y)
+        self.uncovered = len(self.coverage)
+
+    def invalidate(self):
+        """标记全部内容失效"""
+        if self.pixels is not None:
+            self.coverage = bytearray(len(self.coverage))
+            self.uncovered = len(self.coverage)
+
+    def _mark_covered(self, x, y, width, height):
+        tile = COVERAGE_TILE
+        # 只统计被完整覆盖的分块
+        first_x = (x + tile - 1) // tile
+        first_y = (y + tile - 1) // tile
+        end_x = (x + width) // tile if x + width < self.width else self.tiles_x
+        end_y = (y + height) // tile if y + height < self.height else self.tiles_y
+        coverage = self.coverage
+        for tile_y in range(first_y, end_y):
+            row = tile_y * self.tiles_x
+            for index in range(row + first_x, row + end_x):
+                if not coverage[index]:
+                    coverage[index] = 1
+                    self.uncovered -= 1
+
+    def apply(self, message, rects):
+        """把一条FramebufferUpdate应用到缓存"""
+        for rect in rects:
+            if rect.encoding == rfb.ENCODING_DESKTOP_SIZE:
+                self.reset(rect.width, rect.height, self.pixel_format)
+                continue
+            if self.pixels is None or rect.encoding in (rfb.ENCODING_CURSOR,
+                                                        rfb.ENCODING_X_CURSOR):
+                continue
+            if rect.x + rect.width > self.width or rect.y + rect.height > self.height:
+                self.decode_errors += 1
+                continue
+            try:
+                self._decode(message, rect)
+            except Exception:
+                # 无法解码时整块画面失效，等待下一次全屏更新
+                self.decode_errors += 1
+                self.invalidate()
+                continue
+            self._mark_covered(rect.x, rect.y, rect.width, rect.height)
+
+    def _decode(self, message, rect):
+        encoding = rect.encoding
+        data = memoryview(message)[rect.start:rect.end]
+        if encoding == rfb.ENCODING_RAW:
+            self._blit(rect.x, rect.y, rect.width, rect.height, data, 0)
+        elif encoding == rfb.ENCODING_COPYRECT:
+            src_x, src_y = struct.unpack_from('>HH', data, 0)
+            self._copy(src_x, src_y, rect.x, rect.y, rect.width, rect.height)
+        elif encoding == rfb.ENCODING_RRE:
+            self._rre(data, rect)
+        elif encoding == rfb.ENCODING_HEXTILE:
+            self._hextile(data, rect.x, rect.y, rect.width, rect.height)
+        else:
+            raise rfb.RFBError(
+                f"缓存不支持的编码: {rfb.ENCODING_NAMES.get(encoding, encoding)}")
+
+    def _blit(self, x, y, width, height, data, offset):
+        """把紧密排列的像素块写入帧缓冲区"""
+        row_bytes = width * self.bytes_per_pixel
+        start = y * self.stride + x * self.bytes_per_pixel
+        if x == 0 and width == self.width:
+            size = row_bytes * height
+            self.pixels[start:start + size] = data[offset:offset + size]
+            return
+        pixels = self.pixels
+        stride = self.stride
+        for _ in range(height):
+            pixels[start:start + row_bytes] = data[offset:offset + row_bytes]
+            start += stride
+            offset += row_bytes
+
+    def _fill(self, x, y, width, height, pixel):
+        """用单一像素值填充矩形"""
+        row = bytes(pixel) * width
+        row_bytes = len(row)
+        start = y * self.stride + x * self.bytes_per_pixel
+        pixels = self.pixels
+        stride = self.stride
+        for _ in range(height):
+            pixels[start:start + row_bytes] = row
+            start += stride
+
+    def _copy(self, src_x, src_y, x, y, width, height):
+        """CopyRect：先取出源区域再写入，处理重叠"""
+        bpp = self.bytes_per_pixel
+        row_bytes = width * bpp
+        stride = self.stride
+        start = src_y * stride + src_x * bpp
+        block = bytearray()
+        for _ in range(height):
+            block += self.pixels[start:start + row_bytes]
+            start += stride
+        self._blit(x, y, width, height, block, 0)
+
+    def _rre(self, data, rect):
+        bpp = self.bytes_per_pixel
+        count = struct.unpack_from('>I', data, 0)[0]
+        self._fill(rect.x, rect.y, rect.width, rect.height, data[4:4 + bpp])
+        pos = 4 + bpp
+        for _ in range(count):
+            pixel = data[pos:pos + bpp]
+            sx, sy, sw, sh = struct.unpack_from('>HHHH', data, pos + bpp)
+            self._fill(rect.x + sx, rect.y + sy, sw, sh, pixel)
+            pos += bpp + 8
+
+    def _hextile(self, data, x, y, width, height):
+        bpp = self.bytes_per_pixel
+        background = foreground = bytes(bpp)
+        pos = 0
+        for tile_y in range(y, y + height, 16):
+            tile_height = min(16, y + height - tile_y)
+            for tile_x in range(x, x + width, 16):
+                tile_width = min(16, x + width - tile_x)
+                subencoding = data[pos]
+                pos += 1
+                if subencoding & 1:
+                    self._blit(tile_x, tile_y, tile_width, tile_height, data, pos)
+                    pos += tile_width * tile_height * bpp
+                    continue
+                if subencoding & 2:
+                    background = bytes(data[pos:pos + bpp])
+                    pos += bpp
+                if subencoding & 4:
+                    foreground = bytes(data[pos:pos + bpp])
+                    pos += bpp
+                self._fill(tile_x, tile_y, tile_width, tile_height, background)
+                if not subencoding & 8:
+                    continue
+                count = data[pos]
+                pos += 1
+                coloured = subencoding & 16
+                for _ in range(count):
+                    if coloured:
+                        pixel = data[pos:pos + bpp]
+                        pos += bpp
+                    else:
+                        pixel = foreground
+                    xy = data[pos]
+                    wh = data[pos + 1]
+                    pos += 2
+                    self._fill(tile_x + (xy >> 4), tile_y + (xy & 15),
+                               (wh >> 4) + 1, (wh & 15) + 1, pixel)
+
+    def full_update(self):
+        """由缓存合成一条覆盖全屏的Raw FramebufferUpdate，缓存无效时返回None"""
+        if not self.valid:
+            return None
+        message = bytearray(struct.pack('>BxH', rfb.FRAMEBUFFER_UPDATE, 1))
+        message += rfb.RECT_HEADER_STRUCT.pack(0, 0, self.width, self.height,
+                                               rfb.ENCODING_RAW)
+        message += self.pixels
+        return message
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+会话存活检测与空闲回收
+客户端笔记本休眠或断网时，转发线程阻塞在recv中，活跃会话一直占着桌面：
+- TCP keepalive 和 TCP_USER_TIMEOUT：对端失联后由内核在有限时间内报错，阻塞的转发随之结束
+- IdleWatchdog：每个桌面一个后台线程，定期比较当前会话的转发计数（不在转发热路径上计时）：
+  - 客户端/服务器方向超过设定秒数没有收到数据时结束会话
+  - 超过设定时间没有键盘/指针输入时（需要解析客户端数据流：VNC客户端无人操作时同样在请求更新），
+    free 直接结束会话，handover 只在有客户端等待时结束，新到达的客户端无需决策直接接管
+每次回收都按原因记录日志和计数。
+"""
+
+import errno
+import logging
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# 回收原因
+REASON_CLIENT_IDLE = "client_idle"
+REASON_SERVER_IDLE = "server_idle"
+REASON_INPUT_IDLE = "input_idle"
+REASON_PEER_TIMEOUT = "peer_timeout"
+REASONS = (REASON_CLIENT_IDLE, REASON_SERVER_IDLE, REASON_INPUT_IDLE,
+           REASON_PEER_TIMEOUT)
+
+# 输入空闲后的处理
+IDLE_FREE = "free"          # 结束会话，释放桌面
+IDLE_HANDOVER = "handover"  # 有客户端等待或到达时交给它，否则保留
+
+# keepalive探测次数，探测间隔为空闲时间的 1/KEEPALIVE_PROBES
+KEEPALIVE_PROBES = 3
+# 空闲检查的最长间隔（秒）
+CHECK_INTERVAL = 5.0
+
+
+def set_keepalive(sock, idle):
+    """开启TCP keepalive：空闲idle秒后开始探测，连续 KEEPALIVE_PROBES 次无响应时连接报错"""
+    idle = max(1, int(idle))
+    interval = max(1, idle // KEEPALIVE_PROBES)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+    elif hasattr(socket, 'TCP_KEEPALIVE'):
+        # macOS
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+    elif hasattr(socket, 'SIO_KEEPALIVE_VALS'):
+        # 旧版Windows只能一次设置空闲时间和间隔（毫秒）
+        sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, idle * 1000, interval * 1000))
+        return
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+    if hasattr(socket, 'TCP_KEEPCNT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_PROBES)
+
+
+def set_user_timeout(sock, seconds):
+    """TCP_USER_TIMEOUT：已发送的数据超过seconds秒未被确认时断开连接（仅Linux），不支持时返回False"""
+    option = getattr(socket, 'TCP_USER_TIMEOUT', None)
+    if option is None:
+        return False
+    sock.setsockopt(socket.IPPROTO_TCP, option, int(seconds * 1000))
+    return True
+
+
+def configure_socket(sock, keepalive=0, user_timeout=0):
+    """按设置开启keepalive和用户超时（0为不设置），设置失败时返回错误描述"""
+    try:
+        if keepalive > 0:
+            set_keepalive(sock, keepalive)
+        if user_timeout > 0:
+            set_user_timeout(sock, user_timeout)
+    except (OSError, ValueError) as e:
+        return str(e)
+    return None
+
+
+def is_peer_timeout(error):
+    """转发异常是否为对端失联（keepalive探测或用户超时到期）"""
+    return (isinstance(error, OSError)
+            and error.errno in (errno.ETIMEDOUT, errno.EHOSTUNREACH))
+
+
+def describe(reason, seconds):
+    """回收原因的日志描述"""
+    if reason == REASON_CLIENT_IDLE:
+        return f"客户端方向 {seconds:.0f} 秒没有收到数据"
+    if reason == REASON_SERVER_IDLE:
+        return f"服务器方向 {seconds:.0f} 秒没有收到数据"
+    if reason == REASON_INPUT_IDLE:
+        return f"{seconds:.0f} 秒没有键盘/鼠标输入"
+    return "对端无响应"
+
+
+class IdleWatchdog:
+    """一个桌面的会话空闲检查线程，设置了任一空闲超时才运行"""
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.thread = None
+        self.lock = threading.Lock()
+        # 当前检查的会话，以及各计数最近一次变化时的 (值, 时间)
+        self.session = None
+        self.marks = {}
+
+    def timeouts(self):
+        """原因 -> (当前计数, 超时秒数)"""
+        proxy = self.proxy
+        session = self.session
+        return {
+            REASON_CLIENT_IDLE: (session.upstream.bytes, proxy.client_idle_timeout),
+            REASON_SERVER_IDLE: (session.downstream.bytes, proxy.server_idle_timeout),
+            # 没有解析客户端数据流（或解析失败转为透传）时为None，不做输入空闲检查
+            REASON_INPUT_IDLE: (session.upstream.inputs, proxy.input_idle_minutes * 60),
+        }
+
+    def enabled(self):
+        proxy = self.proxy
+        return (proxy.client_idle_timeout > 0 or proxy.server_idle_timeout > 0
+                or proxy.input_idle_minutes > 0)
+
+    def interval(self):
+        proxy = self.proxy
+        timeouts = [t for t in (proxy.client_idle_timeout, proxy.server_idle_timeout,
+                                proxy.input_idle_minutes * 60) if t > 0]
+        if not timeouts:
+            return CHECK_INTERVAL
+        return min(CHECK_INTERVAL, max(0.1, min(timeouts) / 4))
+
+    def start(self):
+        """启用了空闲超时且检查线程未运行时启动（服务器启动和重新加载配置时调用）"""
+        with self.lock:
+            if not self.enabled() or (self.thread is not None
+                                      and self.thread.is_alive()):
+                return
+            self.thread = threading.Thread(target=self.run, name="idle-watchdog",
+                                           daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while self.proxy.is_running and self.enabled():
+            time.sleep(self.interval())
+            try:
+                self.check(time.monotonic())
+            except Exception as e:
+                self.proxy.logger.error(f"空闲检查出错: {e}")
+
+    def check(self, now):
+        """检查当前会话，超时时交给代理回收"""
+        session = self.proxy.active_session
+        if session is None or not session.active:
+            self.session = None
+            return
+        if session is not self.session:
+            self.session = session
+            self.marks = {}
+        for reason, (value, timeout) in self.timeouts().items():
+            mark = self.marks.get(reason)
+            if mark is None or mark[0] != value:
+                self.marks[reason] = (value, now)
+                if reason == REASON_INPUT_IDLE and mark is not None and session.idle:
+                    session.idle = False
+                    self.proxy.logger.for_session(session).info(
+                        f"会话 {session.client_addr} 恢复输入")
+                continue
+            if value is None or timeout <= 0:
+                continue
+            idle = now - mark[1]
+            if idle >= timeout:
+                self.proxy.reclaim_session(session, reason, idle)
+                return
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地HTTP指标端点
+只在启用 --metrics-port 时导入，无GUI快速启动时不加载 http.server
+"""
+
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from proxy_metrics import render_prometheus
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """/metrics 返回Prometheus文本，/metrics.json 返回JSON快照"""
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        try:
+            if path == '/metrics':
+                body = self.server.metrics.render_prometheus().encode('utf-8')
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            elif path == '/metrics.json':
+                body = json.dumps(self.server.metrics.snapshot(), ensure_ascii=False,
+                                  default=str).encode('utf-8')
+                content_type = 'application/json; charset=utf-8'
+            else:
+                self.send_error(404)
+                return
+        except Exception as e:
+            logger.error(f"生成指标失败: {e}")
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 抓取请求很频繁，不写访问日志
+        pass
+
+
+class MetricsServer:
+    """本地HTTP指标端点，只在抓取时读取各代理的计数，不影响转发路径"""
+
+    def __init__(self, proxies, port, host='127.0.0.1'):
+        self.proxies = proxies
+        self.host = host
+        self.port = port
+        self.httpd = None
+
+    def start(self):
+        """在后台线程中开始服务"""
+        self.httpd = ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.metrics = self
+        threading.Thread(target=self.httpd.serve_forever, name="metrics-http",
+                         daemon=True).start()
+        logger.info(f"指标端点已启动: http://{self.host}:{self.port}/metrics")
+
+    def stop(self):
+        """停止服务"""
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def snapshot(self):
+        """各桌面的统计快照"""
+        return {proxy.name or str(proxy.proxy_port): proxy.get_stats()
+                for proxy in self.proxies}
+
+    def render_prometheus(self):
+        samples = []
+        for proxy in self.proxies:
+            samples.extend(proxy.metric_samples())
+        return render_prometheus(samples)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+日志管道
+接受连接、转发和事件循环线程记录日志时只入队，不做文件I/O；后台线程负责格式化和写出。
+- 队列满时丢弃日志并计数，从不阻塞调用方
+- 日志文件固定UTF-8编码，按大小和/或时间轮转
+- text 格式与以往相同（前缀为桌面名和会话ID），json 格式每行一个JSON对象
+- 带 dedup 键的日志（同一IP反复出现的事件）在时间窗口内只输出一次，下一次输出时附带省略的条数
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from ratelimit import TTLTable
+
+LOG_FILE = 'vnc_proxy_simple.log'
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(prefix)s%(message)s%(suffix)s'
+FORMAT_TEXT = "text"
+FORMAT_JSON = "json"
+QUEUE_SIZE = 10000
+
+# 结构化日志中从记录属性取出的字段
+RECORD_FIELDS = ('desktop', 'session', 'client', 'event')
+
+_pipeline = None
+
+
+def dedup(event, key):
+    """按(事件, 键)去重的extra，例如 dedup('cooldown', ip)"""
+    return {'event': event, 'dedup': (event, key)}
+
+
+class RotatingLogFileHandler(logging.handlers.RotatingFileHandler):
+    """UTF-8日志文件，超过大小或到达轮转间隔时轮转"""
+
+    def __init__(self, filename, max_bytes=0, backup_count=5, rotate_seconds=0):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count,
+                         encoding='utf-8')
+        self.rotate_seconds = rotate_seconds
+        self.next_rotate = time.time() + rotate_seconds if rotate_seconds > 0 else None
+
+    def shouldRollover(self, record):
+        if self.next_rotate is not None and time.time() >= self.next_rotate:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.next_rotate is not None:
+            self.next_rotate = time.time() + self.rotate_seconds
+
+
+class DuplicateFilter(logging.Filter):
+    """同一dedup键的日志在窗口内只放行第一条，在调用线程中执行，被省略的日志不会入队"""
+
+    def __init__(self, window=60, max_keys=4096):
+        super().__init__()
+        self.window = window
+        # 键 -> [窗口结束时间, 窗口内省略的条数]，保留到窗口结束后再一个窗口，以便报告省略数
+        self.seen = TTLTable(2 * window, max_keys)
+        self.lock = threading.Lock()
+        self.suppressed = 0
+
+    def filter(self, record):
+        key = getattr(record, 'dedup', None)
+        if key is None or self.window <= 0:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            entry = self.seen.get(key)
+            if entry is not None and now < entry[0]:
+                entry[1] += 1
+                self.suppressed += 1
+                return False
+            record.suppressed = entry[1] if entry is not None else 0
+            self.seen[key] = [now + self.window, 0]
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """队列满时丢弃日志而不是阻塞"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class TextFormatter(logging.Formatter):
+    """原有的文本格式，桌面名和会话ID作为消息前缀"""
+
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def format(self, record):
+        tags = [value for value in (getattr(record, 'desktop', None),
+                                    getattr(record, 'session', None))
+                if value]
+        record.prefix = f"[{' '.join(tags)}] " if tags else ""
+        suppressed = getattr(record, 'suppressed', 0)
+        record.suffix = f"（此前 {suppressed} 条相同事件已省略）" if suppressed else ""
+        return super().format(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志一行JSON"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(
+                timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in RECORD_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            entry['suppressed'] = suppressed
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogPipeline:
+    """根日志器 -> 有界队列 -> 后台线程 -> 文件和控制台"""
+
+    def __init__(self, log_file=LOG_FILE, log_format=FORMAT_TEXT,
+                 max_bytes=10 * 1024 * 1024, backup_count=5, rotate_seconds=0,
+                 dedup_window=60, console=True, queue_size=QUEUE_SIZE):
+        self.log_file = log_file
+        self.log_format = log_format
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.rotate_seconds = rotate_seconds
+        self.console = console
+        self.queue_size = queue_size
+        self.handler = DroppingQueueHandler(queue.Queue(queue_size))
+        self.dedup = DuplicateFilter(dedup_window)
+        self.handler.addFilter(self.dedup)
+        self.listener = None
+
+    def _build_handlers(self, log_file):
+        formatter = (JsonFormatter() if self.log_format == FORMAT_JSON
+                     else TextFormatter())
+        handlers = []
+        if log_file:
+            handlers.append(RotatingLogFileHandler(log_file, self.max_bytes,
+                                                   self.backup_count,
+                                                   self.rotate_seconds))
+        if self.console:
+            handlers.append(logging.StreamHandler())
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        return handlers
+
+    def start(self, log_file=None):
+        handlers = self._build_handlers(log_file or self.log_file)
+        self.listener = logging.handlers.QueueListener(self.handler.queue, *handlers,
+                                                       respect_handler_level=True)
+        self.listener.start()
+        root = logging.getLogger()
+        if self.handler not in root.handlers:
+            root.addHandler(self.handler)
+
+    def stop(self):
+        """写完队列中的日志并关闭文件"""
+        listener, self.listener = self.listener, None
+        if listener is None:
+            return
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+    def restart_in_worker(self, index):
+        """fork出的工作进程中没有后台线程，换新队列并写到各自的日志文件"""
+        self.handler.queue = queue.Queue(self.queue_size)
+        log_file = self.log_file
+        if log_file:
+            stem, ext = os.path.splitext(log_file)
+            log_file = f"{stem}.worker{index}{ext}"
+        self.start(log_file)
+
+    def get_stats(self):
+        return {
+            'queued': self.handler.queue.qsize(),
+            'dropped': self.handler.dropped,
+            'suppressed': self.dedup.suppressed,
+        }
+
+
+def setup_logging(level=logging.INFO, **options):
+    """安装日志管道，参数见LogPipeline；重复调用时替换之前的管道"""
+    global _pipeline
+    if _pipeline is not None:
+        _pipeline.stop()
+        logging.getLogger().removeHandler(_pipeline.handler)
+    _pipeline = LogPipeline(**options)
+    logging.getLogger().setLevel(level)
+    _pipeline.start()
+    return _pipeline
+
+
+def restart_in_worker(index):
+    """工作进程启动时调用"""
+    if _pipeline is not None:
+        _pipeline.restart_in_worker(index)
+
+
+def shutdown():
+    if _pipeline is not None:
+        _pipeline.stop()
+
+
+def get_stats():
+    """日志管道统计，未安装时返回None"""
+    return _pipeline.get_stats() if _pipeline is not None else None
+
+
+atexit.register(shutdown)
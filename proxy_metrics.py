@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+VNC代理运行统计
+提供转发热路径上使用的轻量统计工具和Prometheus文本格式化；
+本地HTTP指标端点在 metrics_server 中，启用 --metrics-port 时才导入（http.server 导入较慢）
+"""
+
+
+class LatencyRecorder:
+    """固定容量的延迟采样环
+
+    记录一次采样只是一次列表赋值，适合放在转发热路径上；
+    多线程并发记录时可能丢失个别采样，对分位数统计没有影响。
+    """
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.samples = [0.0] * capacity
+        self.count = 0
+
+    def record(self, seconds):
+        """记录一次延迟（秒）"""
+        self.samples[self.count % self.capacity] = seconds
+        self.count += 1
+
+    def percentile(self, pct):
+        """返回最近采样的分位数（秒），没有采样时返回None"""
+        count = min(self.count, self.capacity)
+        if count == 0:
+            return None
+        ordered = sorted(self.samples[:count])
+        index = min(count - 1, int(count * pct / 100.0))
+        return ordered[index]
+
+    def snapshot(self):
+        """返回毫秒单位的统计快照"""
+        p50 = self.percentile(50)
+        p99 = self.percentile(99)
+        return {
+            'count': self.count,
+            'p50_ms': round(p50 * 1000, 3) if p50 is not None else None,
+            'p99_ms': round(p99 * 1000, 3) if p99 is not None else None,
+        }
+
+
+def format_labels(labels):
+    """Prometheus标签，如 {desktop="desk01"}"""
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels.items():
+        value = (str(value).replace('\\', '\\\\').replace('"', '\\"')
+                 .replace('\n', '\\n'))
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def render_prometheus(samples):
+    """把(名称, 类型, 说明, 标签, 值)样本渲染为Prometheus文本格式，同名样本归为一组"""
+    families = {}
+    for name, kind, help_text, labels, value in samples:
+        if value is None:
+            continue
+        family = families.setdefault(name, (kind, help_text, []))
+        family[2].append((labels, value))
+    lines = []
+    for name, (kind, help_text, values) in families.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in values:
+            lines.append(f"{name}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
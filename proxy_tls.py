@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+监听端口的TLS终结（--tls-cert）
+客户端到代理的连接在接受后、进入单用户/决策流程之前完成服务端TLS握手，不再需要前置的stunnel等终结进程；
+到VNC服务器的连接仍为明文（通常在本机回环上）：
+- 每个桌面一个SSLContext，会话票据的密钥随上下文保存，重新连接的客户端出示票据即可恢复会话
+  （TLS 1.3 PSK / TLS 1.2 session ticket），跳过证书链传输、签名和完整的密钥交换
+- 重新加载配置时在同一上下文上重新读取证书和密码套件，已签发的票据仍然有效；证书文件更新（如续期）后
+  重新加载配置即可换上新证书
+- 每次握手记录耗时，按完整握手和会话恢复分别统计
+TLS连接（ssl.SSLSocket）的转发只能走缓冲区路径，asyncio引擎下由线程完成握手和转发。
+按需导入（只在配置了证书时），无TLS时启动不加载ssl模块。
+"""
+
+import os
+import ssl
+import time
+
+from proxy_metrics import LatencyRecorder
+
+# 握手超时（秒），客户端连上后不发送ClientHello时关闭
+HANDSHAKE_TIMEOUT = 10.0
+
+# 最低协议版本
+MIN_VERSIONS = {'1.2': ssl.TLSVersion.TLSv1_2, '1.3': ssl.TLSVersion.TLSv1_3}
+DEFAULT_MIN_VERSION = '1.2'
+# TLS 1.3 每次完整握手后签发的会话票据数（OpenSSL默认值），0为不签发票据、不恢复会话
+DEFAULT_TICKETS = 2
+
+# 握手类型
+HANDSHAKE_FULL = "full"
+HANDSHAKE_RESUMED = "resumed"
+
+
+def parse_alpn(value):
+    """ALPN协议列表：逗号分隔的字符串或配置文件中的列表"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    return [protocol.strip() for protocol in value if protocol.strip()]
+
+
+def file_stamp(*paths):
+    """证书/私钥文件的修改时间，用于发现续期后的新证书"""
+    stamps = []
+    for path in paths:
+        try:
+            stamps.append(os.stat(path).st_mtime_ns if path else None)
+        except OSError:
+            stamps.append(None)
+    return tuple(stamps)
+
+
+class TLSTerminator:
+    """一个桌面的服务端TLS上下文和握手统计"""
+
+    def __init__(self, cert, key=None, ciphers=None, min_version=DEFAULT_MIN_VERSION,
+                 alpn=None, tickets=DEFAULT_TICKETS):
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.stamp = None
+        self.alpn = []
+        self.latency = {HANDSHAKE_FULL: LatencyRecorder(),
+                        HANDSHAKE_RESUMED: LatencyRecorder()}
+        self.handshakes = {HANDSHAKE_FULL: 0, HANDSHAKE_RESUMED: 0}
+        self.failures = 0
+        self.configure(cert, key, ciphers, min_version, alpn, tickets)
+
+    def configure(self, cert, key=None, ciphers=None, min_version=DEFAULT_MIN_VERSION,
+                  alpn=None, tickets=DEFAULT_TICKETS):
+        """（重新）设置证书、密码套件、最低版本、ALPN和会话票据
+
+        在同一上下文上修改，票据密钥不变，重新加载配置后之前签发的票据仍可恢复会话；
+        证书读取失败时抛出异常，上下文保持原有证书。
+        """
+        context = self.context
+        context.load_cert_chain(cert, key or None)
+        self.stamp = file_stamp(cert, key)
+        context.minimum_version = MIN_VERSIONS[min_version]
+        if ciphers:
+            # 只作用于TLS 1.2及以下；TLS 1.3的密码套件由OpenSSL决定
+            context.set_ciphers(ciphers)
+        protocols = parse_alpn(alpn)
+        if protocols or self.alpn:
+            # 客户端提供的协议都不在列表中时握手照常完成，不协商ALPN
+            context.set_alpn_protocols(protocols)
+        self.alpn = protocols
+        if tickets > 0:
+            context.options &= ~ssl.OP_NO_TICKET
+        else:
+            context.options |= ssl.OP_NO_TICKET
+        context.num_tickets = max(0, int(tickets))
+        self.cert = cert
+        self.key = key
+
+    def renewed(self):
+        """证书或私钥文件在上次读取后是否有变化"""
+        return file_stamp(self.cert, self.key) != self.stamp
+
+    def handshake(self, sock):
+        """在已接受的连接上完成服务端握手，返回ssl.SSLSocket；握手失败时关闭连接并抛出OSError
+
+        耗时从开始等待ClientHello算起，包含客户端一侧的处理和网络往返。
+        """
+        started = time.perf_counter()
+        try:
+            tls_socket = self.context.wrap_socket(sock, server_side=True,
+                                                  do_handshake_on_connect=False)
+        except OSError:
+            self.failures += 1
+            sock.close()
+            raise
+        try:
+            tls_socket.do_handshake()
+        except OSError:
+            self.failures += 1
+            tls_socket.close()
+            raise
+        kind = HANDSHAKE_RESUMED if tls_socket.session_reused else HANDSHAKE_FULL
+        self.handshakes[kind] += 1
+        self.latency[kind].record(time.perf_counter() - started)
+        return tls_socket
+
+    def get_stats(self):
+        full = self.handshakes[HANDSHAKE_FULL]
+        resumed = self.handshakes[HANDSHAKE_RESUMED]
+        stats = {'handshakes': full + resumed, 'resumed': resumed,
+                 'failures': self.failures}
+        for kind, recorder in self.latency.items():
+            snapshot = recorder.snapshot()
+            stats[f'{kind}_p50_ms'] = snapshot['p50_ms']
+            stats[f'{kind}_p99_ms'] = snapshot['p99_ms']
+        return stats
+
+
+def describe(tls_socket):
+    """握手结果的日志描述，如 "TLSv1.3，会话恢复，ALPN rfb" """
+    parts = [tls_socket.version() or "TLS",
+             "会话恢复" if tls_socket.session_reused else "完整握手"]
+    protocol = tls_socket.selected_alpn_protocol()
+    if protocol:
+        parts.append(f"ALPN {protocol}")
+    return "，".join(parts)
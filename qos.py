@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+输入优先的客户端数据流调度（--qos）
+客户端->服务器方向经过RFB过滤器（rfb_filters.ClientStreamFilter）按消息边界切分后交给InputQoS：
+- 键盘/指针事件和其他小消息立即转发，不排在大消息之后
+- 超过阈值的剪贴板（ClientCutText）和文件传输消息进入批量队列，按会话的令牌桶限速，
+  新的剪贴板内容替换队列中尚未发出的旧内容
+- 批量消息分块写出，写出期间转发线程/协程仍然读取客户端数据；
+  RFB消息不能交错，已开始写出的批量消息之后到达的输入事件等它写完再发出
+- 记录输入事件从收到到写出的耗时（time-to-forward）
+PointerCoalescer在服务器方向拥塞期间合并指针移动（--coalesce-pointer），可单独使用，也可与InputQoS一起使用。
+"""
+
+import time
+from collections import deque
+
+import rfb
+
+# 超过该长度的剪贴板/文件传输消息按批量流量调度
+BULK_THRESHOLD = 4096
+# 批量消息每次写出的块大小
+BULK_CHUNK = 16 * 1024
+
+# 计入转发耗时的输入事件（QEMU消息主要是扩展按键事件，TigerVNC在服务器支持时用它代替KeyEvent）
+INPUT_EVENTS = (rfb.KEY_EVENT, rfb.POINTER_EVENT, rfb.QEMU_CLIENT_MESSAGE)
+# 可能携带大量数据的消息
+BULK_MESSAGES = (rfb.CLIENT_CUT_TEXT, rfb.FILE_TRANSFER)
+POINTER_EVENT_SIZE = rfb.CLIENT_FIXED_SIZES[rfb.POINTER_EVENT]
+
+
+class ByteBucket:
+    """字节令牌桶：余额不为负时可以开始发送一条消息，发送后按消息长度扣除（可以扣成负数）"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, BULK_CHUNK)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_at(self, now):
+        """可以开始发送的时间（time.monotonic）"""
+        self._refill(now)
+        if self.tokens >= 0:
+            return now
+        return now + -self.tokens / self.rate
+
+    def consume(self, size, now):
+        self._refill(now)
+        self.tokens -= size
+
+
+def is_plain_cut_text(message):
+    """普通剪贴板消息（扩展剪贴板使用负长度，各消息含义不同，不能互相替换）"""
+    return message[0] == rfb.CLIENT_CUT_TEXT and rfb.S32.unpack_from(message, 4)[0] >= 0
+
+
+class PointerCoalescer:
+    """服务器方向拥塞期间合并指针移动
+
+    暂存待写出消息的缓冲区由调用方持有（过滤器或InputQoS），每条消息经 append() 加入；
+    congested 时与缓冲区末尾相邻、按钮状态不变的PointerEvent只保留最新位置。
+    按钮状态变化的PointerEvent（按下/释放）保留原位置，键盘事件和其他消息的顺序不变。
+    """
+
+    def __init__(self):
+        self.congested = False
+        self.buttons = None    # 最近一个PointerEvent的按钮状态
+        self.motion_at = None  # 缓冲区末尾可以合并的指针移动的位置
+        self.pointer_events = 0
+        self.coalesced = 0
+
+    def append(self, buffer, message):
+        """把一条完整消息加入buffer，与末尾的指针移动合并时返回True"""
+        if not message:
+            return False
+        if message[0] != rfb.POINTER_EVENT:
+            self.motion_at = None
+            buffer += message
+            return False
+        self.pointer_events += 1
+        buttons = message[1]
+        motion = buttons == self.buttons
+        self.buttons = buttons
+        # 缓冲区被取空后 motion_at 不再指向末尾，不会误合并
+        if (motion and self.congested
+                and self.motion_at == len(buffer) - POINTER_EVENT_SIZE):
+            buffer[self.motion_at:] = message
+            self.coalesced += 1
+            return True
+        self.motion_at = len(buffer) if motion else None
+        buffer += message
+        return False
+
+    def get_stats(self):
+        return {'pointer_events': self.pointer_events,
+                'pointer_coalesced': self.coalesced}
+
+
+class InputQoS:
+    """一个会话的客户端消息调度器，由过滤器在转发线程/协程中调用，不加锁"""
+
+    def __init__(self, bulk_rate=0, latency=None, bulk_threshold=BULK_THRESHOLD,
+                 chunk=BULK_CHUNK, coalescer=None):
+        # bulk_rate 为批量消息的限速（字节/秒，0为不限速）
+        self.bucket = ByteBucket(bulk_rate) if bulk_rate > 0 else None
+        self.latency = latency
+        # 指针移动合并（PointerCoalescer），排队的小消息经它加入 urgent
+        self.coalescer = coalescer
+        self.bulk_threshold = bulk_threshold
+        self.chunk = chunk
+        self.urgent = bytearray()  # 待发出的输入事件和小消息
+        self.stamps = []           # urgent 中输入事件的收到时间（perf_counter）
+        self.taken = []            # 已交给调用方、尚未写出的输入事件收到时间
+        self.bulk = deque()        # 排队的批量消息
+        self.inflight = None       # 正在分块写出的批量消息剩余部分（memoryview）
+        self.inputs = 0
+        self.overtaken = 0         # 越过排队中批量消息的输入事件数
+        self.bulk_messages = 0
+        self.bulk_bytes = 0
+        self.superseded = 0        # 被新剪贴板内容替换、没有发出的剪贴板消息数
+
+    def push(self, message):
+        """加入一条完整的客户端消息（已经过改写/节流，可能为空）"""
+        if not message:
+            return
+        message_type = message[0]
+        if message_type in BULK_MESSAGES and len(message) > self.bulk_threshold:
+            message = bytes(message)
+            if (self.bulk and is_plain_cut_text(message)
+                    and is_plain_cut_text(self.bulk[-1])):
+                # 剪贴板只保留最新内容
+                self.bulk[-1] = message
+                self.superseded += 1
+            else:
+                self.bulk.append(message)
+            return
+        if message_type in INPUT_EVENTS:
+            self.inputs += 1
+        if self.coalescer is not None:
+            if self.coalescer.append(self.urgent, message):
+                # 合并进排队中的指针移动，转发耗时沿用其收到时间
+                return
+        else:
+            self.urgent += message
+        if message_type in INPUT_EVENTS:
+            self.stamps.append(time.perf_counter())
+            if self.bulk:
+                self.overtaken += 1
+
+    @property
+    def pending(self):
+        """是否有待写出的数据"""
+        return self.inflight is not None or bool(self.urgent) or bool(self.bulk)
+
+    def deadline(self, now):
+        """下一次需要调用take()的时间（time.monotonic），没有待发数据时返回None"""
+        if self.inflight is not None or self.urgent:
+            return now
+        if not self.bulk:
+            return None
+        return self.bucket.ready_at(now) if self.bucket is not None else now
+
+    def take(self, now):
+        """取出现在可以写出的数据：小消息优先，批量消息每次最多一块"""
+        out = bytearray()
+        if self.inflight is None:
+            self._take_urgent(out)
+            if self.bulk and (self.bucket is None or self.bucket.ready_at(now) <= now):
+                message = self.bulk.popleft()
+                self.bulk_messages += 1
+                self.bulk_bytes += len(message)
+                if self.bucket is not None:
+                    self.bucket.consume(len(message), now)
+                self.inflight = memoryview(message)
+        if self.inflight is not None:
+            out += self.inflight[:self.chunk]
+            self.inflight = self.inflight[self.chunk:]
+            if not self.inflight:
+                self.inflight = None
+                # 等在批量消息之后的输入事件紧接着发出
+                self._take_urgent(out)
+        return out
+
+    def _take_urgent(self, out):
+        if self.urgent:
+            out += self.urgent
+            self.urgent.clear()
+            self.taken += self.stamps
+            self.stamps.clear()
+
+    def drain(self):
+        """不再调度（过滤器转为透传）时按顺序取出全部待发数据"""
+        out = bytearray()
+        if self.inflight is not None:
+            out += self.inflight
+            self.inflight = None
+        self._take_urgent(out)
+        while self.bulk:
+            out += self.bulk.popleft()
+        return out
+
+    def written(self):
+        """take()取出的数据已写出，记录其中输入事件的转发耗时"""
+        if not self.taken:
+            return
+        now = time.perf_counter()
+        if self.latency is not None:
+            for stamp in self.taken:
+                self.latency.record(now - stamp)
+        self.taken.clear()
+
+    def get_stats(self):
+        return {
+            'inputs': self.inputs,
+            'inputs_overtaken': self.overtaken,
+            'bulk_messages': self.bulk_messages,
+            'bulk_bytes': self.bulk_bytes,
+            'bulk_queued': len(self.bulk),
+            'cut_text_superseded': self.superseded,
+        }
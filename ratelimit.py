@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+连接速率限制
+- TTLTable：容量有上限、按最小堆到期的键值表，用于冷却列表和限流桶
+- ConnectionLimiter：按IP和子网（IPv4 /24、IPv6 /64）的令牌桶，
+  在接受连接后立即检查，超限的连接不占用线程也不进入握手
+"""
+
+import heapq
+import ipaddress
+import threading
+import time
+
+
+class TTLTable:
+    """带过期时间和容量上限的键值表
+
+    到期时间放在最小堆里，每次访问顺带清理已过期的条目；
+    表满时淘汰最早到期的条目。
+    """
+
+    def __init__(self, ttl, max_entries=65536):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}  # key -> (到期时间, 值)
+        self.heap = []     # (到期时间, key)，键被重新设置后旧条目作废
+        self.lock = threading.Lock()
+        self.evicted = 0
+
+    def _purge(self, now):
+        heap = self.heap
+        entries = self.entries
+        while heap and heap[0][0] <= now:
+            expires, key = heapq.heappop(heap)
+            entry = entries.get(key)
+            if entry is not None and entry[0] == expires:
+                del entries[key]
+
+    def _evict_one(self):
+        heap = self.heap
+        entries = self.entries
+        while heap:
+            expires, key = heapq.heappop(heap)
+            entry = entries.get(key)
+            if entry is not None and entry[0] == expires:
+                del entries[key]
+                self.evicted += 1
+                return
+
+    def set(self, key, value, ttl=None):
+        """设置键值，ttl为None时使用表的默认过期时间"""
+        now = time.monotonic()
+        expires = now + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self._purge(now)
+            if key not in self.entries and len(self.entries) >= self.max_entries:
+                self._evict_one()
+            self.entries[key] = (expires, value)
+            heapq.heappush(self.heap, (expires, key))
+            # 同一个键反复设置会在堆里留下作废条目，过多时重建
+            if len(self.heap) > 2 * len(self.entries) + 64:
+                self.heap = [(entry[0], k) for k, entry in self.entries.items()]
+                heapq.heapify(self.heap)
+
+    def get(self, key, default=None):
+        """取值，不存在或已过期时返回default"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] <= now:
+                del self.entries[key]
+                return default
+            return entry[1]
+
+    def pop(self, key, default=None):
+        """删除并返回键值"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        if entry is None or entry[0] <= time.monotonic():
+            return default
+        return entry[1]
+
+    def clear(self):
+        """清空"""
+        with self.lock:
+            self.entries.clear()
+            self.heap = []
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __getitem__(self, key):
+        marker = object()
+        value = self.get(key, marker)
+        if value is marker:
+            raise KeyError(key)
+        return value
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.entries[key]
+
+    def __contains__(self, key):
+        marker = object()
+        return self.get(key, marker) is not marker
+
+    def __len__(self):
+        now = time.monotonic()
+        with self.lock:
+            self._purge(now)
+            return len(self.entries)
+
+
+class TokenBuckets:
+    """按键分组的令牌桶，桶回满后自动从表中过期"""
+
+    def __init__(self, rate, burst, max_entries=65536):
+        self.rate = rate
+        self.burst = burst
+        self.table = TTLTable(burst / rate, max_entries)
+        # 读取、计算和写回作为一个整体，多个接受连接的线程同时检查时不会重复使用同一个令牌
+        self.lock = threading.Lock()
+
+    def allow(self, key):
+        """取一个令牌，桶空时返回False"""
+        with self.lock:
+            now = time.monotonic()
+            bucket = self.table.get(key)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            if tokens < 1:
+                return False
+            tokens -= 1
+            # 桶回满之前保留，回满后与不存在等价
+            self.table.set(key, (tokens, now), (self.burst - tokens) / self.rate)
+            return True
+
+    def __len__(self):
+        return len(self.table)
+
+
+def subnet_key(ip):
+    """IP所在的限流子网：IPv4 /24，IPv6 /64"""
+    if ':' not in ip:
+        return ip.rsplit('.', 1)[0] + '.0/24'
+    try:
+        address = ipaddress.ip_address(ip.split('%', 1)[0])
+    except ValueError:
+        return ip
+    if address.ipv4_mapped:
+        return subnet_key(str(address.ipv4_mapped))
+    return str(ipaddress.ip_network(f"{address}/64", strict=False))
+
+
+class ConnectionLimiter:
+    """按IP和子网限制新连接速率（rate为0表示不限制该项，默认都不限制）"""
+
+    def __init__(self, ip_rate=0, ip_burst=10, subnet_rate=0, subnet_burst=30,
+                 max_entries=65536):
+        self.max_entries = max_entries
+        self.configure(ip_rate, ip_burst, subnet_rate, subnet_burst)
+        self.allowed = 0
+        self.limited_ip = 0
+        self.limited_subnet = 0
+
+    def configure(self, ip_rate, ip_burst, subnet_rate, subnet_burst):
+        """设置速率和突发数（重新加载配置时调用），令牌桶重新开始计数，统计保留"""
+        self.ip_buckets = (TokenBuckets(ip_rate, ip_burst, self.max_entries)
+                           if ip_rate > 0 else None)
+        self.subnet_buckets = (TokenBuckets(subnet_rate, subnet_burst, self.max_entries)
+                               if subnet_rate > 0 else None)
+
+    @property
+    def enabled(self):
+        return self.ip_buckets is not None or self.subnet_buckets is not None
+
+    def check(self, ip):
+        """检查一个新连接，允许时返回None，否则返回被限制的维度（"ip"或"subnet"）"""
+        # 先取出引用，重新加载配置时桶可能被替换
+        ip_buckets, subnet_buckets = self.ip_buckets, self.subnet_buckets
+        if ip_buckets is not None and not ip_buckets.allow(ip):
+            self.limited_ip += 1
+            return "ip"
+        if subnet_buckets is not None and not subnet_buckets.allow(subnet_key(ip)):
+            self.limited_subnet += 1
+            return "subnet"
+        self.allowed += 1
+        return None
+
+    def get_stats(self):
+        """限流统计"""
+        return {
+            'allowed': self.allowed,
+            'limited_ip': self.limited_ip,
+            'limited_subnet': self.limited_subnet,
+            'tracked_ips': len(self.ip_buckets) if self.ip_buckets else 0,
+            'tracked_subnets': len(self.subnet_buckets) if self.subnet_buckets else 0,
+        }
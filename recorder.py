@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+会话录制
+转发路径只把数据复制一份放入队列，由后台写入线程分块压缩后追加到文件，转发从不等待磁盘；
+队列积压超过上限时放弃该会话的录制，而不是阻塞转发。
+
+文件格式（整数均为大端）:
+    文件头   MAGIC(8) + 元数据长度(4) + 元数据JSON
+    数据块   BLOCK_HEADER + zlib压缩的记录，每条记录为 RECORD_HEADER + 数据
+    索引     INDEX_MAGIC + 条目数(4) + 每个数据块一个 INDEX_ENTRY
+    结尾     TRAILER：索引偏移(8) + END_MAGIC(4)
+
+客户端方向的数据按RFB消息切分后记录：握手单元记为 DIR_HANDSHAKE，
+关键帧数据块以 DIR_KEYFRAME 记录开头，内容是重建客户端状态所需的
+SetPixelFormat + SetEncodings + 非增量更新请求，回放可以从任意关键帧开始。
+录制中断（进程退出）时文件没有索引，读取时按数据块头重建。
+"""
+
+import json
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+import rfb
+from rfb_filters import ClientStreamFilter, STATE_MESSAGES
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"VNCREC\x00\x01"
+BLOCK_MAGIC = b"VBLK"
+INDEX_MAGIC = b"VIDX"
+END_MAGIC = b"VEND"
+
+# 魔数, 标志, 原始长度, 压缩长度, 首条时间戳ns, 末条时间戳ns, 记录数
+BLOCK_HEADER = struct.Struct('>4sBIIQQI')
+# 方向, 时间戳ns（相对录制开始）, 数据长度
+RECORD_HEADER = struct.Struct('>BQI')
+# 首条时间戳ns, 数据块偏移, 标志
+INDEX_ENTRY = struct.Struct('>QQB')
+TRAILER = struct.Struct('>Q4s')
+U32 = struct.Struct('>I')
+
+# 记录方向
+DIR_C2S = 0        # 客户端 -> 服务器
+DIR_S2C = 1        # 服务器 -> 客户端
+DIR_KEYFRAME = 2   # 关键帧：客户端状态（像素格式、编码、全屏请求）
+DIR_HANDSHAKE = 3  # 客户端握手单元
+
+# 数据块标志
+BLOCK_KEYFRAME = 0x01
+
+BLOCK_SIZE = 256 * 1024
+BLOCK_MAX_AGE_NS = 1_000_000_000  # 数据块最长积累1秒，崩溃时最多丢失这么多
+FILE_SUFFIX = ".vncrec"
+
+
+class SessionRecording:
+    """一个会话的录制，record() 可在转发线程中调用"""
+
+    def __init__(self, recorder, path, meta):
+        self.recorder = recorder
+        self.path = path
+        self.meta = meta
+        self.started = time.monotonic_ns()
+        self.closed = False
+        self.truncated = False
+        self.failed = False
+
+        # 以下只在写入线程中使用
+        self.file = None
+        self.block = bytearray()
+        self.block_flags = 0
+        self.block_first = None
+        self.block_last = 0
+        self.block_count = 0
+        self.index = []
+        self.splitter = ClientStreamFilter(self._on_set_encodings, self._on_passthrough,
+                                           on_unit=self._on_unit)
+        self.units = []
+        self.pixel_format_message = None
+        self.encodings_message = None
+        self.full_request = None
+        self.last_keyframe = None
+
+    def c2s(self, data):
+        """记录客户端发往服务器的数据（转发路径的tap）"""
+        self.record(DIR_C2S, data)
+
+    def s2c(self, data):
+        """记录服务器发往客户端的数据（转发路径的tap）"""
+        self.record(DIR_S2C, data)
+
+    def record(self, direction, data):
+        if self.closed:
+            return
+        if not self.recorder.reserve(len(data)):
+            self.closed = True
+            self.truncated = True
+            logger.warning(f"录制写入积压超过上限，停止录制: {self.path}")
+            self.recorder.submit((self, None, None, None))
+            return
+        self.recorder.submit((self, time.monotonic_ns() - self.started, direction,
+                              bytes(data)))
+
+    def close(self):
+        """会话结束，写完剩余数据和索引"""
+        if not self.closed:
+            self.closed = True
+            self.recorder.submit((self, None, None, None))
+
+    # ---- 以下在写入线程中执行 ----
+
+    def _on_set_encodings(self, encodings):
+        return encodings
+
+    def _on_passthrough(self, reason):
+        logger.info(f"无法解析客户端数据流（{reason}），此后的录制没有关键帧: {self.path}")
+
+    def _on_unit(self, state, unit):
+        self.units.append((state, unit))
+
+    def _open(self):
+        self.file = open(self.path, 'wb')
+        meta = json.dumps(self.meta, ensure_ascii=False).encode('utf-8')
+        self.file.write(MAGIC + U32.pack(len(meta)) + meta)
+
+    def _write(self, timestamp, direction, data):
+        if self.file is None:
+            self._open()
+        if direction == DIR_S2C:
+            self._append(timestamp, DIR_S2C, data)
+            return
+        if self.splitter.passthrough:
+            self._append(timestamp, DIR_C2S, data)
+            return
+        out = self.splitter.feed(data)
+        units, self.units = self.units, []
+        consumed = 0
+        for state, unit in units:
+            consumed += len(unit)
+            if state != STATE_MESSAGES:
+                self._append(timestamp, DIR_HANDSHAKE, unit)
+                continue
+            message_type = unit[0]
+            if message_type == rfb.SET_PIXEL_FORMAT:
+                self.pixel_format_message = bytes(unit)
+            elif message_type == rfb.SET_ENCODINGS:
+                self.encodings_message = bytes(unit)
+            elif message_type == rfb.FRAMEBUFFER_UPDATE_REQUEST:
+                self.full_request = b"\x03\x00" + bytes(unit[2:])
+            self._append(timestamp, DIR_C2S, unit)
+        if len(out) > consumed:
+            # 转为透传时剩余的未解析数据
+            self._append(timestamp, DIR_C2S, bytes(out[consumed:]))
+
+    def _append(self, timestamp, direction, data):
+        interval = self.recorder.keyframe_interval_ns
+        if (direction == DIR_C2S and interval and self.full_request is not None
+                and not self.splitter.passthrough
+                and (self.last_keyframe is None
+                     or timestamp - self.last_keyframe >= interval)):
+            # 在客户端消息边界开始一个关键帧数据块
+            self._flush_block()
+            self.block_flags = BLOCK_KEYFRAME
+            self.last_keyframe = timestamp
+            state = ((self.pixel_format_message or b"")
+                     + (self.encodings_message or b"") + self.full_request)
+            self._add_record(timestamp, DIR_KEYFRAME, state)
+        self._add_record(timestamp, direction, data)
+        if (len(self.block) >= BLOCK_SIZE
+                or timestamp - self.block_first >= BLOCK_MAX_AGE_NS):
+            self._flush_block()
+
+    def _add_record(self, timestamp, direction, data):
+        if self.block_first is None:
+            self.block_first = timestamp
+        self.block_last = timestamp
+        self.block_count += 1
+        self.block += RECORD_HEADER.pack(direction, timestamp, len(data))
+        self.block += data
+
+    def _flush_block(self):
+        if not self.block_count:
+            return
+        payload = zlib.compress(bytes(self.block), 1)
+        offset = self.file.tell()
+        self.file.write(BLOCK_HEADER.pack(BLOCK_MAGIC, self.block_flags,
+                                          len(self.block), len(payload),
+                                          self.block_first, self.block_last,
+                                          self.block_count))
+        self.file.write(payload)
+        self.index.append((self.block_first, offset, self.block_flags))
+        self.block = bytearray()
+        self.block_flags = 0
+        self.block_first = None
+        self.block_count = 0
+
+    def _finish(self):
+        if self.file is None:
+            return
+        self._flush_block()
+        index_offset = self.file.tell()
+        self.file.write(INDEX_MAGIC + U32.pack(len(self.index)))
+        for entry in self.index:
+            self.file.write(INDEX_ENTRY.pack(*entry))
+        self.file.write(TRAILER.pack(index_offset, END_MAGIC))
+        self.file.close()
+        self.file = None
+
+
+class Recorder:
+    """录制管理：为会话创建录制文件，后台线程负责压缩和写入"""
+
+    def __init__(self, directory, keyframe_interval=10, max_pending_mb=64):
+        self.directory = directory
+        self.keyframe_interval_ns = int(keyframe_interval * 1e9)
+        self.max_pending = int(max_pending_mb * 1024 * 1024)
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.recordings = 0
+        self.truncated = 0
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread = threading.Thread(target=self.writer_loop, name="session-recorder",
+                                       daemon=True)
+        self.thread.start()
+
+    def open(self, session, desktop=None):
+        """为会话开始录制，返回SessionRecording"""
+        if self.thread is None:
+            self.start()
+        host, port = session.client_addr[0], session.client_addr[1]
+        stamp = session.start_time.strftime('%Y%m%d-%H%M%S')
+        name = (f"{desktop or 'vnc'}-{stamp}-{host.replace(':', '_')}-{port}"
+                f"{FILE_SUFFIX}")
+        meta = {
+            'desktop': desktop,
+            'client_addr': f"{host}:{port}",
+            'start_time': session.start_time.isoformat(timespec='milliseconds'),
+        }
+        self.recordings += 1
+        return SessionRecording(self, os.path.join(self.directory, name), meta)
+
+    def reserve(self, size):
+        """登记待写入的字节数，超过上限时返回False"""
+        with self.lock:
+            if self.pending + size > self.max_pending:
+                return False
+            self.pending += size
+            return True
+
+    def submit(self, item):
+        self.queue.put(item)
+
+    def drain(self, timeout=5):
+        """等待此前提交的数据全部写完"""
+        if self.thread is None:
+            return True
+        done = threading.Event()
+        self.queue.put((None, None, None, done))
+        return done.wait(timeout)
+
+    def writer_loop(self):
+        while True:
+            recording, timestamp, direction, data = self.queue.get()
+            if recording is None:
+                data.set()
+                continue
+            if data is not None:
+                with self.lock:
+                    self.pending -= len(data)
+            if recording.failed:
+                continue
+            try:
+                if data is None:
+                    if recording.truncated:
+                        self.truncated += 1
+                    recording._finish()
+                else:
+                    recording._write(timestamp, direction, data)
+            except Exception as e:
+                logger.error(f"写入录制失败 {recording.path}: {e}")
+                recording.failed = True
+                recording.closed = True
+                if recording.file:
+                    try:
+                        recording.file.close()
+                    except OSError:
+                        pass
+                    recording.file = None
+
+    def get_stats(self):
+        return {'recordings': self.recordings, 'pending_bytes': self.pending,
+                'truncated': self.truncated}
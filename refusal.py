@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+RFB拒绝消息
+被拒绝的客户端不再各占一个线程：线程模式下交给进程内共用的选择器线程（RefusalEngine），
+asyncio引擎在事件循环中按同样的流程处理：
+1. 立即发送服务器版本串（3.8）
+2. 在握手超时内等待客户端的12字节版本串，超时直接关闭
+3. 按客户端版本一次写出预先生成的失败消息（3.3与3.7/3.8格式不同）
+4. shutdown(SHUT_WR) 半关闭，读取并丢弃客户端的剩余数据，直到对方关闭或等待超时再关闭连接
+   （连接上还有未读数据时直接关闭会发出RST，客户端可能读不到失败原因）
+WebSocket客户端（websocket_listener.WebSocketSocket）在原始套接字上按同样的流程处理，收发经过帧编解码，
+失败消息之后附带close帧。TLS客户端（ssl.SSLSocket）在握手完成后交给拒绝引擎，非阻塞收发需要等待时同样等下一次事件。
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+from collections import deque
+
+import rfb
+from proxy_logging import dedup
+
+logger = logging.getLogger(__name__)
+
+SERVER_VERSION = rfb.format_version((3, 8))
+HANDSHAKE_TIMEOUT = 5.0
+LINGER_TIMEOUT = 1.0
+
+# 处理结果
+RESULT_REFUSED = "refused"  # 失败消息已发出
+RESULT_TIMEOUT = "timeout"  # 握手超时
+RESULT_CLOSED = "closed"    # 客户端在发送版本串前断开
+RESULT_ERROR = "error"
+
+# 连接状态
+STATE_VERSION = "version"  # 等待客户端版本串
+STATE_REPLY = "reply"      # 正在发送失败消息
+STATE_LINGER = "linger"    # 已半关闭，等待客户端关闭
+
+# 预先生成的失败消息：(原因, 协议版本) -> 字节串
+_payloads = {}
+MAX_PAYLOADS = 64
+
+
+def refusal_payload(reason, version):
+    """取得预先生成的失败消息"""
+    key = (reason, version)
+    payload = _payloads.get(key)
+    if payload is None:
+        if len(_payloads) >= MAX_PAYLOADS:
+            _payloads.clear()
+        payload = _payloads[key] = rfb.build_refusal(version, reason)
+    return payload
+
+
+def client_version(data):
+    """客户端版本串 -> 回复所用的协议版本，无法解析时按3.3"""
+    try:
+        return rfb.negotiate_version(rfb.parse_version(bytes(data)))
+    except rfb.RFBError:
+        return (3, 3)
+
+
+def tls_retry(error):
+    """TLS连接的非阻塞收发需要等待下一次可读/可写（有TLS连接时ssl模块一定已经导入）"""
+    ssl = sys.modules.get('ssl')
+    return ssl is not None and isinstance(error, (ssl.SSLWantReadError,
+                                                  ssl.SSLWantWriteError))
+
+
+def log_result(log, reason, result, detail, timeout):
+    """记录一次拒绝的结果，detail为协议版本（RESULT_ERROR时为异常），同类日志按dedup合并"""
+    if result == RESULT_REFUSED:
+        log.info(f"已发送RFB拒绝消息（RFB {detail[0]}.{detail[1]}）: {reason}",
+                 extra=dedup('refused', reason))
+    elif result == RESULT_TIMEOUT:
+        log.info(f"被拒绝的客户端未在 {timeout} 秒内完成握手，关闭连接",
+                 extra=dedup('refuse_timeout', reason))
+    elif result == RESULT_ERROR:
+        log.warning(f"发送拒绝消息失败: {detail}", extra=dedup('refuse_error', reason))
+
+
+class _Refusal:
+    """选择器线程中的一个被拒绝的连接"""
+
+    __slots__ = ('sock', 'codec', 'reason', 'timeout', 'on_done', 'state', 'received',
+                 'out', 'deadline', 'version', 'events')
+
+    def __init__(self, sock, reason, timeout, on_done):
+        # WebSocket连接在其原始套接字上收发，codec为帧编解码器（websocket_listener.WebSocketCodec）
+        self.codec = getattr(sock, 'codec', None)
+        self.sock = sock.sock if self.codec is not None else sock
+        self.reason = reason
+        self.timeout = timeout
+        self.on_done = on_done
+        self.state = STATE_VERSION
+        self.received = b""
+        self.out = (self.codec.encode(SERVER_VERSION) if self.codec is not None
+                    else SERVER_VERSION)
+        self.deadline = None
+        self.version = None
+        self.events = 0
+
+
+class RefusalEngine:
+    """在一个选择器线程中完成所有拒绝握手"""
+
+    def __init__(self, linger=LINGER_TIMEOUT):
+        self.linger = linger
+        self.selector = selectors.DefaultSelector()
+        self.incoming = deque()
+        self.wake_recv, self.wake_send = socket.socketpair()
+        self.wake_recv.setblocking(False)
+        self.wake_send.setblocking(False)
+        self.selector.register(self.wake_recv, selectors.EVENT_READ, None)
+        # (到期时间, 序号, 连接)，连接的deadline变化后旧条目作废
+        self.deadlines = []
+        self.sequence = itertools.count()
+        self.pid = os.getpid()
+        self.thread = None
+        self.active = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="rfb-refusal", daemon=True)
+        self.thread.start()
+        return self
+
+    def submit(self, sock, reason, timeout=HANDSHAKE_TIMEOUT, on_done=None):
+        """交给选择器线程拒绝，立即返回；on_done(结果, 协议版本) 在选择器线程中调用"""
+        self.incoming.append(_Refusal(sock, reason, timeout, on_done))
+        try:
+            self.wake_send.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            # 唤醒数据已经足够多，选择器线程一定会醒来
+            pass
+
+    def get_stats(self):
+        return {'active': self.active, 'completed': self.completed,
+                'timeouts': self.timeouts, 'errors': self.errors}
+
+    def run(self):
+        while True:
+            timeout = None
+            if self.deadlines:
+                timeout = max(0.0, self.deadlines[0][0] - time.monotonic())
+            for key, mask in self.selector.select(timeout):
+                if key.data is None:
+                    self._accept_incoming()
+                else:
+                    self._handle(key.data, mask)
+            self._expire(time.monotonic())
+
+    def _accept_incoming(self):
+        try:
+            while self.wake_recv.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self.incoming:
+            conn = self.incoming.popleft()
+            self.active += 1
+            try:
+                conn.sock.setblocking(False)
+                self._set_deadline(conn, conn.timeout)
+                self._flush(conn)
+            except OSError as e:
+                self._finish(conn, RESULT_ERROR, e)
+
+    def _set_deadline(self, conn, seconds):
+        conn.deadline = time.monotonic() + seconds
+        heapq.heappush(self.deadlines, (conn.deadline, next(self.sequence), conn))
+
+    def _watch(self, conn):
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if conn.out else 0)
+        if conn.events == events:
+            return
+        if conn.events:
+            self.selector.modify(conn.sock, events, conn)
+        else:
+            self.selector.register(conn.sock, events, conn)
+        conn.events = events
+
+    def _flush(self, conn):
+        """尽量写出待发数据；失败消息写完后半关闭并开始等待客户端关闭"""
+        if conn.out:
+            try:
+                sent = conn.sock.send(conn.out)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError as e:
+                if not tls_retry(e):
+                    raise
+                sent = 0
+            conn.out = conn.out[sent:]
+        if not conn.out and conn.state == STATE_REPLY:
+            conn.state = STATE_LINGER
+            conn.sock.shutdown(socket.SHUT_WR)
+            self._set_deadline(conn, self.linger)
+        self._watch(conn)
+
+    def _handle(self, conn, mask):
+        try:
+            if mask & selectors.EVENT_READ:
+                if conn.state == STATE_VERSION:
+                    data = self._receive(conn, 12 - len(conn.received))
+                    if data is None:
+                        self._flush(conn)
+                        return
+                    if not data:
+                        self._finish(conn, RESULT_CLOSED)
+                        return
+                    conn.received += data[:12 - len(conn.received)]
+                    if len(conn.received) == 12:
+                        conn.version = client_version(conn.received)
+                        payload = refusal_payload(conn.reason, conn.version)
+                        if conn.codec is not None:
+                            payload = conn.codec.encode(payload) + conn.codec.close()
+                        conn.out += payload
+                        conn.state = STATE_REPLY
+                else:
+                    # 丢弃客户端随后发来的数据
+                    data = self._receive(conn, 4096)
+                    if data is None:
+                        self._flush(conn)
+                        return
+                    if not data:
+                        self._finish(conn, RESULT_REFUSED if conn.state == STATE_LINGER
+                                     else RESULT_CLOSED)
+                        return
+            self._flush(conn)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            if not tls_retry(e):
+                self._finish(conn, RESULT_ERROR, e)
+
+    def _receive(self, conn, size):
+        """读取客户端数据；WebSocket连接经过帧解码，只收到控制帧时返回None（回复放入待发数据）
+
+        半关闭之后的数据直接丢弃，不再解码（TLS连接半关闭后读到的是未解密的数据）。
+        """
+        if conn.codec is None or conn.state == STATE_LINGER:
+            return conn.sock.recv(size)
+        data = conn.sock.recv(4096)
+        if not data:
+            return data
+        data = conn.codec.feed(data)
+        conn.out += conn.codec.take_outgoing()
+        if data or conn.codec.closed:
+            return data
+        return None
+
+    def _expire(self, now):
+        deadlines = self.deadlines
+        while deadlines and deadlines[0][0] <= now:
+            deadline, _, conn = heapq.heappop(deadlines)
+            if conn.deadline != deadline:
+                continue
+            if conn.state == STATE_LINGER:
+                self._finish(conn, RESULT_REFUSED)
+            else:
+                self._finish(conn, RESULT_TIMEOUT)
+
+    def _finish(self, conn, result, error=None):
+        if conn.deadline is None and result != RESULT_ERROR:
+            return
+        conn.deadline = None
+        self.active -= 1
+        if conn.events:
+            try:
+                self.selector.unregister(conn.sock)
+            except (KeyError, ValueError):
+                pass
+        try:
+            conn.sock.close()
+        except OSError:
+            pass
+        if result == RESULT_TIMEOUT:
+            self.timeouts += 1
+        elif result == RESULT_ERROR:
+            self.errors += 1
+        else:
+            self.completed += 1
+        if conn.on_done:
+            try:
+                conn.on_done(result, conn.version if error is None else error)
+            except Exception as e:
+                logger.error(f"拒绝回调出错: {e}")
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """进程内共用的拒绝引擎，fork出的工作进程中重新创建"""
+    global _engine
+    with _engine_lock:
+        if _engine is None or _engine.pid != os.getpid():
+            _engine = RefusalEngine().start()
+        return _engine
+
+
+def get_stats():
+    """拒绝引擎统计，未使用过时返回None"""
+    engine = _engine
+    if engine is None or engine.pid != os.getpid():
+        return None
+    return engine.get_stats()
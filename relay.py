@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数据转发核心
+- 每个方向一块预分配缓冲区，recv_into 读入、sendall 写出，不为每个数据块分配对象
+- 突发流量时缓冲区按倍数扩大到 256 KB，空闲后逐步收缩
+- Linux 上可用 os.splice 经管道在内核中直接转发，数据不进入 Python
+- 需要改写客户端消息时，客户端->服务器方向经过RFB过滤器，无法解析时回到快速路径
+- 指定tap时（会话录制），每个收到的数据块在转发前交给tap(数据)，只能走缓冲区路径
+"""
+
+import os
+import selectors
+import socket
+import sys
+import time
+
+from session import SEND_STALL_SECONDS
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# 缓冲区大小
+RELAY_INITIAL_BUFFER = 16 * 1024
+RELAY_MAX_BUFFER = 256 * 1024
+# 连续多少次小读取后收缩缓冲区
+RELAY_SHRINK_AFTER = 64
+
+# 转发路径
+PATH_AUTO = "auto"
+PATH_SPLICE = "splice"
+PATH_BUFFER = "buffer"
+PATH_FILTER = "filter"  # 经过RFB过滤器（只用于客户端->服务器方向）
+
+SPLICE_AVAILABLE = sys.platform.startswith('linux') and hasattr(os, 'splice')
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
+# 合并指针移动时服务器方向套接字中未发送数据的上限，超过时套接字不报告可写（视为拥塞）
+NOTSENT_LOWAT = 4096
+TCP_NOTSENT_LOWAT = getattr(socket, 'TCP_NOTSENT_LOWAT',
+                            25 if sys.platform.startswith('linux') else None)
+
+
+class RelayBuffer:
+    """单方向的自适应转发缓冲区"""
+
+    __slots__ = ('initial', 'maximum', 'size', 'buffer', 'view', 'small_reads')
+
+    def __init__(self, initial=RELAY_INITIAL_BUFFER, maximum=RELAY_MAX_BUFFER):
+        self.initial = initial
+        self.maximum = maximum
+        self.small_reads = 0
+        self._allocate(initial)
+
+    def _allocate(self, size):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+    def adapt(self, n):
+        """根据本次读取量调整缓冲区：读满则扩大，长期读不满则收缩"""
+        if n == self.size:
+            self.small_reads = 0
+            if self.size < self.maximum:
+                self._allocate(min(self.size * 2, self.maximum))
+        elif n < self.size // 4:
+            self.small_reads += 1
+            if self.small_reads >= RELAY_SHRINK_AFTER and self.size > self.initial:
+                self.small_reads = 0
+                self._allocate(max(self.size // 2, self.initial))
+        else:
+            self.small_reads = 0
+
+
+def limit_unsent(sock, size=NOTSENT_LOWAT):
+    """设置TCP_NOTSENT_LOWAT，让拥塞在内核发送缓冲区（可自动增长到数MB）填满之前就表现为不可写
+
+    不支持的系统上返回False，此时只有发送缓冲区满时才视为拥塞。
+    """
+    if TCP_NOTSENT_LOWAT is None:
+        return False
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT, size)
+    except OSError:
+        return False
+    return True
+
+
+class WritableCheck:
+    """零超时检查套接字当前是否可写"""
+
+    def __init__(self, sock):
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(sock, selectors.EVENT_WRITE)
+
+    def writable(self):
+        return bool(self.selector.select(0))
+
+    def close(self):
+        self.selector.close()
+
+
+def choose_path(preferred, *socks):
+    """根据配置和套接字类型选择转发路径"""
+    if preferred == PATH_BUFFER or not SPLICE_AVAILABLE:
+        return PATH_BUFFER
+    # splice 只适用于普通TCP套接字（TLS等包装套接字必须经过Python）
+    for sock in socks:
+        if type(sock) is not socket.socket or sock.gettimeout() is not None:
+            return PATH_BUFFER
+    return PATH_SPLICE
+
+
+def pump_buffer(src, dst, session, stats, latency, tap=None):
+    """recv_into + sendall 转发，直到对端关闭或会话结束"""
+    relay_buffer = RelayBuffer()
+    perf_counter = time.perf_counter
+    while session.active:
+        n = src.recv_into(relay_buffer.view)
+        if not n:
+            return
+        stats.bytes += n
+        stats.chunks += 1
+        if tap is not None:
+            tap(relay_buffer.view[:n])
+        started = perf_counter()
+        dst.sendall(relay_buffer.view[:n])
+        elapsed = perf_counter() - started
+        latency.record(elapsed)
+        if elapsed > SEND_STALL_SECONDS:
+            stats.stalls += 1
+        relay_buffer.adapt(n)
+
+
+def pump_splice(src, dst, session, stats, latency, chunk=RELAY_MAX_BUFFER):
+    """经管道 splice 转发，数据不复制到用户态，直到对端关闭或会话结束"""
+    read_fd, write_fd = os.pipe()
+    try:
+        try:
+            fcntl.fcntl(write_fd, F_SETPIPE_SZ, chunk)
+        except OSError:
+            # 超过 /proc/sys/fs/pipe-max-size 时保持默认管道容量
+            pass
+        src_fd = src.fileno()
+        dst_fd = dst.fileno()
+        splice = os.splice
+        flags = os.SPLICE_F_MOVE
+        perf_counter = time.perf_counter
+        while session.active:
+            n = splice(src_fd, write_fd, chunk, flags=flags)
+            if not n:
+                return
+            stats.bytes += n
+            stats.chunks += 1
+            started = perf_counter()
+            while n:
+                n -= splice(read_fd, dst_fd, n, flags=flags)
+            elapsed = perf_counter() - started
+            latency.record(elapsed)
+            if elapsed > SEND_STALL_SECONDS:
+                stats.stalls += 1
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+def pump_filtered(src, dst, session, stats, latency, stream_filter, path=PATH_BUFFER,
+                  tap=None):
+    """经过滤器转发；过滤器转为透传后改用path继续转发
+
+    过滤器中有节流待发的请求或排队的消息时，等待客户端数据最多到到期时间，到期后单独发出；
+    已到期时客户端仍有数据可读则先读取（输入事件先于分块写出的批量消息进入调度）。
+    过滤器合并指针移动时，每次读到数据后检查服务器方向是否可写，不可写时消息暂存在过滤器中，
+    同时等待客户端数据和服务器方向可写。
+    src为包装的套接字（WebSocket）时，已解出、尚未读取的数据（src.pending()）视为可读，不等待。
+    """
+    relay_buffer = RelayBuffer()
+    perf_counter = time.perf_counter
+    selector = None
+    # 合并指针移动时检查服务器方向是否可写
+    dst_check = None
+    dst_waiting = False
+    buffered = getattr(src, 'pending', None)
+
+    def send(data):
+        started = perf_counter()
+        dst.sendall(data)
+        elapsed = perf_counter() - started
+        stream_filter.written()
+        latency.record(elapsed)
+        if elapsed > SEND_STALL_SECONDS:
+            stats.stalls += 1
+
+    try:
+        while session.active and not stream_filter.passthrough:
+            deadline = stream_filter.deadline()
+            holding = stream_filter.holding
+            if deadline is not None or holding:
+                if selector is None:
+                    selector = selectors.DefaultSelector()
+                    selector.register(src, selectors.EVENT_READ)
+                if holding != dst_waiting:
+                    # 只在有暂存数据时关注服务器方向可写，否则它总是可写
+                    if holding:
+                        selector.register(dst, selectors.EVENT_WRITE)
+                    else:
+                        selector.unregister(dst)
+                    dst_waiting = holding
+                timeout = (max(0.0, deadline - time.monotonic()) if deadline is not None
+                           else None)
+                readable = buffered is not None and buffered() > 0
+                events = selector.select(0 if readable else timeout)
+                if not readable and not any(key.fileobj is src for key, _ in events):
+                    if events:
+                        # 服务器方向恢复可写
+                        stream_filter.congested = False
+                    data = stream_filter.flush()
+                    if data:
+                        send(data)
+                    continue
+            n = src.recv_into(relay_buffer.view)
+            if not n:
+                return
+            stats.bytes += n
+            stats.chunks += 1
+            if tap is not None:
+                tap(relay_buffer.view[:n])
+            if stream_filter.coalescer is not None:
+                if dst_check is None:
+                    dst_check = WritableCheck(dst)
+                stream_filter.congested = not dst_check.writable()
+            data = stream_filter.feed(relay_buffer.view[:n])
+            if data:
+                send(data)
+    finally:
+        if selector is not None:
+            selector.close()
+        if dst_check is not None:
+            dst_check.close()
+    if session.active:
+        pump(path, src, dst, session, stats, latency, tap)
+
+
+def pump(path, src, dst, session, stats, latency, tap=None):
+    """按选定路径转发，stats为该方向的DirectionStats；有tap时总是走缓冲区路径"""
+    if path == PATH_SPLICE and tap is None:
+        pump_splice(src, dst, session, stats, latency)
+    else:
+        pump_buffer(src, dst, session, stats, latency, tap)
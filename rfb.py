@@ -0,0 +1,611 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+RFB（VNC）协议工具
+代理自己终结握手、按消息边界解析数据流时使用的常量和函数
+"""
+
+import struct
+import threading
+import time
+from collections import namedtuple
+
+# 客户端 -> 服务器 消息类型
+SET_PIXEL_FORMAT = 0
+SET_ENCODINGS = 2
+FRAMEBUFFER_UPDATE_REQUEST = 3
+KEY_EVENT = 4
+POINTER_EVENT = 5
+CLIENT_CUT_TEXT = 6
+FILE_TRANSFER = 7  # UltraVNC文件传输扩展
+# 扩展消息：服务器声明支持对应的伪编码后，TigerVNC等客户端随即发送
+ENABLE_CONTINUOUS_UPDATES = 150
+CLIENT_FENCE = 248
+XVP = 250
+SET_DESKTOP_SIZE = 251
+QEMU_CLIENT_MESSAGE = 255
+# QEMU消息的子类型
+QEMU_EXTENDED_KEY_EVENT = 0
+QEMU_AUDIO = 1
+QEMU_AUDIO_SET_FORMAT = 2
+
+# 服务器 -> 客户端 消息类型
+FRAMEBUFFER_UPDATE = 0
+SET_COLOUR_MAP_ENTRIES = 1
+BELL = 2
+SERVER_CUT_TEXT = 3
+
+# 编码
+ENCODING_RAW = 0
+ENCODING_COPYRECT = 1
+ENCODING_RRE = 2
+ENCODING_CORRE = 4
+ENCODING_HEXTILE = 5
+ENCODING_ZLIB = 6
+ENCODING_TIGHT = 7
+ENCODING_ZRLE = 16
+ENCODING_CURSOR = -239
+ENCODING_X_CURSOR = -240
+ENCODING_DESKTOP_SIZE = -223
+ENCODING_LAST_RECT = -224
+# 压缩级别和JPEG质量伪编码：级别0~9
+ENCODING_COMPRESS_LEVEL_0 = -256
+ENCODING_QUALITY_LEVEL_0 = -32
+
+ENCODING_NAMES = {
+    ENCODING_RAW: 'raw',
+    ENCODING_COPYRECT: 'copyrect',
+    ENCODING_RRE: 'rre',
+    ENCODING_CORRE: 'corre',
+    ENCODING_HEXTILE: 'hextile',
+    ENCODING_ZLIB: 'zlib',
+    ENCODING_TIGHT: 'tight',
+    ENCODING_ZRLE: 'zrle',
+    ENCODING_CURSOR: 'cursor',
+    ENCODING_X_CURSOR: 'x-cursor',
+    ENCODING_DESKTOP_SIZE: 'desktop-size',
+    ENCODING_LAST_RECT: 'last-rect',
+}
+
+# 安全类型
+SECURITY_INVALID = 0
+SECURITY_NONE = 1
+SECURITY_VNC_AUTH = 2
+
+# 固定长度的客户端消息
+CLIENT_FIXED_SIZES = {
+    SET_PIXEL_FORMAT: 20,
+    FRAMEBUFFER_UPDATE_REQUEST: 10,
+    KEY_EVENT: 8,
+    POINTER_EVENT: 6,
+    ENABLE_CONTINUOUS_UPDATES: 10,
+    XVP: 4,
+}
+# 变长客户端消息需要先读到的头部长度
+CLIENT_HEADER_SIZES = {
+    SET_ENCODINGS: 4,
+    CLIENT_CUT_TEXT: 8,
+    FILE_TRANSFER: 12,
+    CLIENT_FENCE: 9,
+    SET_DESKTOP_SIZE: 8,
+    QEMU_CLIENT_MESSAGE: 4,
+}
+
+PIXEL_FORMAT_STRUCT = struct.Struct('>BBBBHHHBBB3x')
+SERVER_INIT_STRUCT = struct.Struct('>HH16sI')
+RECT_HEADER_STRUCT = struct.Struct('>HHHHi')
+UPDATE_REQUEST_STRUCT = struct.Struct('>BBHHHH')
+U16 = struct.Struct('>H')
+U32 = struct.Struct('>I')
+S32 = struct.Struct('>i')
+
+
+class RFBError(Exception):
+    """RFB协议错误或不支持的协议特性"""
+
+
+PixelFormat = namedtuple('PixelFormat', [
+    'bits_per_pixel', 'depth', 'big_endian', 'true_colour',
+    'red_max', 'green_max', 'blue_max',
+    'red_shift', 'green_shift', 'blue_shift',
+])
+
+
+def parse_pixel_format(data, offset=0):
+    """解析16字节像素格式"""
+    return PixelFormat(*PIXEL_FORMAT_STRUCT.unpack_from(data, offset))
+
+
+def pack_pixel_format(pixel_format):
+    """打包像素格式为16字节"""
+    return PIXEL_FORMAT_STRUCT.pack(*pixel_format)
+
+
+class ServerInit(namedtuple('ServerInit', ['width', 'height', 'pixel_format', 'name'])):
+    """ServerInit消息：帧缓冲区尺寸、像素格式和桌面名称"""
+
+    def pack(self):
+        """打包为ServerInit消息"""
+        return (SERVER_INIT_STRUCT.pack(self.width, self.height,
+                                        pack_pixel_format(self.pixel_format),
+                                        len(self.name))
+                + self.name)
+
+
+def parse_version(data):
+    """解析 'RFB xxx.yyy\\n' 版本串，返回(主版本, 次版本)"""
+    if len(data) != 12 or not data.startswith(b"RFB ") or data[7:8] != b".":
+        raise RFBError(f"无效的RFB版本串: {data!r}")
+    try:
+        return int(data[4:7]), int(data[8:11])
+    except ValueError:
+        raise RFBError(f"无效的RFB版本串: {data!r}")
+
+
+def negotiate_version(version):
+    """把对端版本归一到代理支持的 3.3 / 3.7 / 3.8"""
+    major, minor = version
+    if major > 3 or minor >= 8:
+        return (3, 8)
+    if minor == 7:
+        return (3, 7)
+    return (3, 3)
+
+
+def format_version(version):
+    """格式化版本串"""
+    return b"RFB %03d.%03d\n" % version
+
+
+def build_refusal(version, reason):
+    """服务器版本串之后的连接失败消息：3.3为安全类型0，3.7/3.8为0个安全类型，后接原因"""
+    reason_bytes = reason.encode('utf-8')
+    head = U32.pack(SECURITY_INVALID) if version == (3, 3) else b"\x00"
+    return head + U32.pack(len(reason_bytes)) + reason_bytes
+
+
+def build_update_request(incremental, x, y, width, height):
+    """构造FramebufferUpdateRequest消息"""
+    return UPDATE_REQUEST_STRUCT.pack(FRAMEBUFFER_UPDATE_REQUEST,
+                                      1 if incremental else 0,
+                                      x, y, width, height)
+
+
+def build_set_encodings(encodings):
+    """构造SetEncodings消息"""
+    return (struct.pack('>BxH', SET_ENCODINGS, len(encodings))
+            + struct.pack('>%di' % len(encodings), *encodings))
+
+
+def parse_set_encodings(message):
+    """解析SetEncodings消息，返回编码列表"""
+    count = U16.unpack_from(message, 2)[0]
+    return list(struct.unpack_from('>%di' % count, message, 4))
+
+
+def encoding_name(encoding):
+    """编码的可读名称"""
+    name = ENCODING_NAMES.get(encoding)
+    if name is not None:
+        return name
+    if 0 <= encoding - ENCODING_COMPRESS_LEVEL_0 <= 9:
+        return f"compress-{encoding - ENCODING_COMPRESS_LEVEL_0}"
+    if 0 <= encoding - ENCODING_QUALITY_LEVEL_0 <= 9:
+        return f"quality-{encoding - ENCODING_QUALITY_LEVEL_0}"
+    return str(encoding)
+
+
+def encoding_names(encodings):
+    """编码列表转为可读名称"""
+    return [encoding_name(encoding) for encoding in encodings]
+
+
+class SocketReader:
+    """带缓冲的阻塞读取器，按精确字节数读取"""
+
+    def __init__(self, sock, size=262144):
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def _fill(self):
+        n = self.sock.recv_into(self.buffer)
+        if not n:
+            raise EOFError("连接已关闭")
+        self.start = 0
+        self.end = n
+
+    def read_into(self, out, n):
+        """读取n字节追加到bytearray"""
+        while n:
+            if self.start == self.end:
+                self._fill()
+            take = min(n, self.end - self.start)
+            out += self.view[self.start:self.start + take]
+            self.start += take
+            n -= take
+
+    def read(self, n):
+        """读取n字节"""
+        if self.end - self.start >= n:
+            data = bytes(self.view[self.start:self.start + n])
+            self.start += n
+            return data
+        out = bytearray()
+        self.read_into(out, n)
+        return bytes(out)
+
+    def pending(self):
+        """已缓冲但尚未读取的字节数"""
+        return self.end - self.start
+
+
+def read_reason(reader):
+    """读取失败原因字符串"""
+    length = U32.unpack(reader.read(4))[0]
+    return reader.read(length).decode('utf-8', 'replace')
+
+
+def client_handshake(sock, reader, server_version=None, shared=True):
+    """作为客户端与VNC服务器完成握手（仅支持无认证），返回(协议版本, ServerInit)
+
+    server_version 为已经预先读取的服务器版本串。
+    """
+    if server_version is None:
+        server_version = reader.read(12)
+    version = negotiate_version(parse_version(server_version))
+    sock.sendall(format_version(version))
+
+    if version == (3, 3):
+        security_type = U32.unpack(reader.read(4))[0]
+        if security_type == SECURITY_INVALID:
+            raise RFBError(f"VNC服务器拒绝连接: {read_reason(reader)}")
+        if security_type != SECURITY_NONE:
+            raise RFBError(f"VNC服务器要求认证（安全类型 {security_type}），代理握手只支持无认证")
+    else:
+        count = reader.read(1)[0]
+        if count == 0:
+            raise RFBError(f"VNC服务器拒绝连接: {read_reason(reader)}")
+        types = reader.read(count)
+        if SECURITY_NONE not in types:
+            raise RFBError(f"VNC服务器不提供无认证方式（安全类型 {list(types)}），代理握手只支持无认证")
+        sock.sendall(bytes([SECURITY_NONE]))
+        if version == (3, 8):
+            result = U32.unpack(reader.read(4))[0]
+            if result != 0:
+                raise RFBError(f"VNC服务器安全握手失败: {read_reason(reader)}")
+
+    # ClientInit
+    sock.sendall(b"\x01" if shared else b"\x00")
+    header = reader.read(SERVER_INIT_STRUCT.size)
+    width, height, pixel_format, name_length = SERVER_INIT_STRUCT.unpack(header)
+    name = reader.read(name_length)
+    return version, ServerInit(width, height, parse_pixel_format(pixel_format), name)
+
+
+def server_handshake(sock, reader, server_init):
+    """作为服务器与VNC客户端完成握手（无认证），返回(协议版本, 共享标志)"""
+    sock.sendall(format_version((3, 8)))
+    version = negotiate_version(parse_version(reader.read(12)))
+
+    if version == (3, 3):
+        sock.sendall(U32.pack(SECURITY_NONE))
+    else:
+        sock.sendall(bytes([1, SECURITY_NONE]))
+        choice = reader.read(1)[0]
+        if choice != SECURITY_NONE:
+            raise RFBError(f"客户端选择了不支持的安全类型 {choice}")
+        if version == (3, 8):
+            sock.sendall(U32.pack(0))
+
+    shared_flag = reader.read(1)[0]
+    sock.sendall(server_init.pack())
+    return version, shared_flag
+
+
+def read_client_message(reader):
+    """读取一条完整的客户端消息，返回(消息类型, 消息字节)"""
+    message = bytearray()
+    reader.read_into(message, 1)
+    message_type = message[0]
+    size = CLIENT_FIXED_SIZES.get(message_type)
+    if size is not None:
+        reader.read_into(message, size - 1)
+        return message_type, message
+    header_size = CLIENT_HEADER_SIZES.get(message_type)
+    if header_size is None:
+        raise RFBError(f"不支持的客户端消息类型: {message_type}")
+    reader.read_into(message, header_size - 1)
+    reader.read_into(message, client_payload_length(message, 0))
+    return message_type, message
+
+
+def client_payload_length(data, offset):
+    """变长客户端消息头部之后的数据长度（头部须已完整），无法确定长度时抛出RFBError"""
+    message_type = data[offset]
+    if message_type == SET_ENCODINGS:
+        return 4 * U16.unpack_from(data, offset + 2)[0]
+    if message_type == FILE_TRANSFER:
+        return U32.unpack_from(data, offset + 8)[0]
+    if message_type == CLIENT_FENCE:
+        return data[offset + 8]
+    if message_type == SET_DESKTOP_SIZE:
+        # 每个屏幕16字节
+        return 16 * data[offset + 6]
+    if message_type == QEMU_CLIENT_MESSAGE:
+        subtype = data[offset + 1]
+        if subtype == QEMU_EXTENDED_KEY_EVENT:
+            return 8
+        if subtype == QEMU_AUDIO:
+            # 只有设置音频格式带参数
+            operation = U16.unpack_from(data, offset + 2)[0]
+            return 6 if operation == QEMU_AUDIO_SET_FORMAT else 0
+        raise RFBError(f"不支持的QEMU客户端消息子类型: {subtype}")
+    # 扩展剪贴板使用负长度
+    return abs(S32.unpack_from(data, offset + 4)[0])
+
+
+Rect = namedtuple('Rect', ['x', 'y', 'width', 'height', 'encoding', 'start', 'end'])
+
+
+class ServerMessageReader:
+    """按消息边界读取服务器数据流
+
+    FramebufferUpdate会按编码解析出每个矩形的数据范围，
+    因此只能用于代理自己协商了编码的连接。
+    """
+
+    def __init__(self, reader, pixel_format):
+        self.reader = reader
+        self.pixel_format = pixel_format
+
+    def read_message(self):
+        """读取一条完整的服务器消息，返回(消息类型, 消息字节, 矩形列表)"""
+        reader = self.reader
+        message = bytearray()
+        reader.read_into(message, 1)
+        message_type = message[0]
+        rects = None
+
+        if message_type == FRAMEBUFFER_UPDATE:
+            reader.read_into(message, 3)
+            count = U16.unpack_from(message, 2)[0]
+            bytes_per_pixel = self.pixel_format.bits_per_pixel // 8
+            rects = []
+            index = 0
+            while index < count:
+                header_start = len(message)
+                reader.read_into(message, RECT_HEADER_STRUCT.size)
+                x, y, width, height, encoding = RECT_HEADER_STRUCT.unpack_from(
+                    message, header_start)
+                if encoding == ENCODING_LAST_RECT:
+                    break
+                start = len(message)
+                self._read_rect(message, encoding, width, height, bytes_per_pixel)
+                rects.append(Rect(x, y, width, height, encoding, start, len(message)))
+                index += 1
+        elif message_type == SET_COLOUR_MAP_ENTRIES:
+            reader.read_into(message, 5)
+            reader.read_into(message, 6 * U16.unpack_from(message, 4)[0])
+        elif message_type == BELL:
+            pass
+        elif message_type == SERVER_CUT_TEXT:
+            reader.read_into(message, 7)
+            reader.read_into(message, abs(S32.unpack_from(message, 4)[0]))
+        else:
+            raise RFBError(f"不支持的服务器消息类型: {message_type}")
+        return message_type, message, rects
+
+    def _read_rect(self, message, encoding, width, height, bytes_per_pixel):
+        reader = self.reader
+        if encoding == ENCODING_RAW:
+            reader.read_into(message, width * height * bytes_per_pixel)
+        elif encoding == ENCODING_COPYRECT:
+            reader.read_into(message, 4)
+        elif encoding in (ENCODING_RRE, ENCODING_CORRE):
+            offset = len(message)
+            reader.read_into(message, 4 + bytes_per_pixel)
+            count = U32.unpack_from(message, offset)[0]
+            subrect = 8 if encoding == ENCODING_RRE else 4
+            reader.read_into(message, count * (bytes_per_pixel + subrect))
+        elif encoding == ENCODING_HEXTILE:
+            self._read_hextile(message, width, height, bytes_per_pixel)
+        elif encoding in (ENCODING_ZRLE, ENCODING_ZLIB):
+            offset = len(message)
+            reader.read_into(message, 4)
+            reader.read_into(message, U32.unpack_from(message, offset)[0])
+        elif encoding == ENCODING_CURSOR:
+            reader.read_into(message, width * height * bytes_per_pixel
+                             + (width + 7) // 8 * height)
+        elif encoding == ENCODING_X_CURSOR:
+            if width and height:
+                reader.read_into(message, 6 + 2 * ((width + 7) // 8) * height)
+        elif encoding == ENCODING_DESKTOP_SIZE:
+            pass
+        else:
+            raise RFBError(f"无法解析的编码: {ENCODING_NAMES.get(encoding, encoding)}")
+
+    def _read_hextile(self, message, width, height, bytes_per_pixel):
+        reader = self.reader
+        for tile_y in range(0, height, 16):
+            tile_height = min(16, height - tile_y)
+            for tile_x in range(0, width, 16):
+                tile_width = min(16, width - tile_x)
+                offset = len(message)
+                reader.read_into(message, 1)
+                subencoding = message[offset]
+                if subencoding & 1:
+                    reader.read_into(message,
+                                     tile_width * tile_height * bytes_per_pixel)
+                    continue
+                size = 0
+                if subencoding & 2:
+                    size += bytes_per_pixel
+                if subencoding & 4:
+                    size += bytes_per_pixel
+                if subencoding & 8:
+                    if size:
+                        reader.read_into(message, size)
+                    offset = len(message)
+                    reader.read_into(message, 1)
+                    subrect = bytes_per_pixel + 2 if subencoding & 16 else 2
+                    size = message[offset] * subrect
+                if size:
+                    reader.read_into(message, size)
+
+
+class UpdateRequestMerger:
+    """合并多个来源的FramebufferUpdateRequest
+
+    同一时间只让一个增量请求在途，期间到达的增量请求合并成外接矩形，
+    收到FramebufferUpdate后再发出；非增量请求和超出在途区域的请求立即发出。
+    min_interval 大于0时，增量请求之间至少间隔这么多秒，未到期的待发请求由计时器发出。
+    """
+
+    def __init__(self, send, min_interval=0):
+        self.send = send
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.outstanding = None  # 在途请求区域 (x1, y1, x2, y2)
+        self.pending = None      # 待发请求区域
+        self.last_sent = None
+        self.timer = None
+        self.forwarded = 0
+        self.merged = 0
+
+    def request(self, incremental, x, y, width, height):
+        """登记一个更新请求"""
+        region = (x, y, x + width, y + height)
+        with self.lock:
+            if incremental and ((self.outstanding is not None
+                                 and _contains(self.outstanding, region))
+                                or not self._due()):
+                self.pending = (region if self.pending is None
+                                else _union(self.pending, region))
+                self.merged += 1
+                if self.outstanding is None:
+                    self._schedule()
+                return
+            message = build_update_request(incremental, x, y, width, height)
+            self.outstanding = (region if self.outstanding is None
+                                else _union(self.outstanding, region))
+            self.forwarded += 1
+            self.last_sent = time.monotonic()
+        self.send(message)
+
+    def on_update(self):
+        """收到一条FramebufferUpdate，发出合并后的待发请求"""
+        with self.lock:
+            self.outstanding = None
+            if self.pending is None:
+                return
+            if not self._due():
+                self._schedule()
+                return
+            message = self._take_pending()
+        self.send(message)
+
+    def cancel(self):
+        """停止计时器"""
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+
+    def _due(self):
+        return (not self.min_interval or self.last_sent is None
+                or time.monotonic() - self.last_sent >= self.min_interval)
+
+    def _schedule(self):
+        # 调用方持有self.lock
+        if self.timer is None:
+            delay = max(0.0, self.last_sent + self.min_interval - time.monotonic())
+            self.timer = threading.Timer(delay, self._flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _take_pending(self):
+        # 调用方持有self.lock
+        x1, y1, x2, y2 = self.outstanding = self.pending
+        self.pending = None
+        self.forwarded += 1
+        self.last_sent = time.monotonic()
+        return build_update_request(True, x1, y1, x2 - x1, y2 - y1)
+
+    def _flush(self):
+        with self.lock:
+            self.timer = None
+            if self.pending is None or self.outstanding is not None:
+                return
+            message = self._take_pending()
+        try:
+            self.send(message)
+        except OSError:
+            # 后端已断开，由后端线程结束会话
+            pass
+
+
+class UpdateThrottle:
+    """限制单个客户端FramebufferUpdateRequest的转发速率
+
+    距上次转发不足最小间隔时，增量请求合并成外接矩形，到期后作为一个请求发出；
+    非增量请求总是立即转发，并吸收被它覆盖的待发区域。
+    """
+
+    def __init__(self, max_rate):
+        self.interval = 1.0 / max_rate
+        self.last_sent = None
+        self.pending = None  # 待发请求区域 (x1, y1, x2, y2)
+        self.received = 0
+        self.forwarded = 0
+        self.delayed = 0  # 因间隔未到而推迟的请求数（含随后被合并的）
+
+    @property
+    def suppressed(self):
+        """被合并或吸收、没有单独转发的请求数"""
+        return self.received - self.forwarded
+
+    def on_request(self, message, now):
+        """处理一个更新请求，返回应立即转发的数据（可能为空）"""
+        self.received += 1
+        _, incremental, x, y, width, height = UPDATE_REQUEST_STRUCT.unpack(message)
+        region = (x, y, x + width, y + height)
+        if not incremental:
+            if self.pending is not None and _contains(region, self.pending):
+                self.pending = None
+        elif self.pending is not None or (self.last_sent is not None
+                                          and now - self.last_sent < self.interval):
+            self.pending = (region if self.pending is None
+                            else _union(self.pending, region))
+            self.delayed += 1
+            return b""
+        self.last_sent = now
+        self.forwarded += 1
+        return message
+
+    def deadline(self):
+        """待发请求的到期时间，没有待发请求时返回None"""
+        if self.pending is None:
+            return None
+        return self.last_sent + self.interval
+
+    def flush(self, now, force=False):
+        """到期（或force）时返回合并后的请求"""
+        if self.pending is None or (not force and now < self.deadline()):
+            return b""
+        x1, y1, x2, y2 = self.pending
+        self.pending = None
+        self.last_sent = now
+        self.forwarded += 1
+        return build_update_request(True, x1, y1, x2 - x1, y2 - y1)
+
+
+def _contains(outer, inner):
+    return (outer[0] <= inner[0] and outer[1] <= inner[1]
+            and outer[2] >= inner[2] and outer[3] >= inner[3])
+
+
+def _union(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
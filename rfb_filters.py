@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+客户端->服务器数据流的RFB过滤
+- EncodingPolicy：按客户端来源网络选择规则，改写SetEncodings中的编码列表
+- ClientStreamFilter：增量解析客户端数据流，逐条识别消息，交给回调改写SetEncodings，
+  并可按最大速率节流FramebufferUpdateRequest（rfb.UpdateThrottle），
+  或让输入事件优先于剪贴板等大消息发出（qos.InputQoS），
+  服务器方向拥塞期间暂存消息并合并指针移动（qos.PointerCoalescer）
+
+策略配置（JSON，按顺序匹配，第一条命中的规则生效）:
+[
+    {"match": "loopback", "force": ["raw"]},
+    {"match": "!lan", "prefer": ["tight", "zrle"], "compression": 6, "quality": 7}
+]
+match 可以是CIDR、loopback、lan（私有/回环/链路本地地址）、any，或它们的列表，前缀 ! 表示取反。
+"""
+
+import ipaddress
+import json
+import time
+
+import rfb
+from qos import INPUT_EVENTS
+
+# 过滤器状态
+STATE_VERSION = "version"
+STATE_SECURITY = "security"
+STATE_VNC_AUTH = "vnc_auth"
+STATE_CLIENT_INIT = "client_init"
+STATE_MESSAGES = "messages"
+STATE_PASSTHROUGH = "passthrough"
+
+# VNC认证的客户端响应长度
+VNC_AUTH_RESPONSE_SIZE = 16
+
+ENCODINGS_BY_NAME = {name: encoding for encoding, name in rfb.ENCODING_NAMES.items()}
+
+
+def parse_encoding(value):
+    """编码名称或数字 -> 编码值"""
+    if isinstance(value, int):
+        return value
+    try:
+        return ENCODINGS_BY_NAME[str(value).lower()]
+    except KeyError:
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError(f"未知编码: {value}")
+
+
+def parse_level(value, what):
+    if value is None:
+        return None
+    level = int(value)
+    if not 0 <= level <= 9:
+        raise ValueError(f"{what}必须在0~9之间: {value}")
+    return level
+
+
+def _match_one(pattern):
+    """单个匹配条件 -> 判断函数"""
+    negate = pattern.startswith('!')
+    if negate:
+        pattern = pattern[1:]
+    if pattern in ('any', '*'):
+        test = lambda ip: True
+    elif pattern == 'loopback':
+        test = lambda ip: ip.is_loopback
+    elif pattern == 'lan':
+        test = lambda ip: ip.is_private or ip.is_loopback or ip.is_link_local
+    else:
+        network = ipaddress.ip_network(pattern, strict=False)
+        test = lambda ip: ip.version == network.version and ip in network
+    if negate:
+        return lambda ip: not test(ip)
+    return test
+
+
+def client_ip(address):
+    """客户端地址字符串 -> ip_address，IPv4映射地址转为IPv4"""
+    ip = ipaddress.ip_address(address.split('%', 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped:
+        return ip.ipv4_mapped
+    return ip
+
+
+class EncodingRule:
+    """一条编码策略规则"""
+
+    def __init__(self, match='any', force=None, prefer=None, exclude=None,
+                 compression=None, quality=None, name=None):
+        patterns = [match] if isinstance(match, str) else list(match)
+        self.name = name or ",".join(patterns)
+        self.tests = [_match_one(pattern) for pattern in patterns]
+        # force 替换客户端的全部实际编码；prefer 在客户端支持的编码中提前；exclude 去掉
+        self.force = [parse_encoding(e) for e in force] if force is not None else None
+        self.prefer = [parse_encoding(e) for e in prefer or ()]
+        self.exclude = {parse_encoding(e) for e in exclude or ()}
+        self.compression = parse_level(compression, "压缩级别")
+        self.quality = parse_level(quality, "质量级别")
+
+    @classmethod
+    def from_config(cls, entry):
+        unknown = set(entry) - {'name', 'match', 'force', 'prefer', 'exclude',
+                                'compression', 'quality'}
+        if unknown:
+            raise ValueError(f"编码策略规则包含未知配置项: {', '.join(sorted(unknown))}")
+        return cls(**entry)
+
+    def matches(self, ip):
+        return any(test(ip) for test in self.tests)
+
+    def apply(self, encodings):
+        """改写编码列表，伪编码（负值）保留在实际编码之后"""
+        real = [e for e in encodings if e >= 0]
+        pseudo = [e for e in encodings if e < 0]
+        if self.force is not None:
+            real = list(self.force)
+        else:
+            real = [e for e in real if e not in self.exclude]
+            if self.prefer:
+                real = ([e for e in self.prefer if e in real]
+                        + [e for e in real if e not in self.prefer])
+        if self.compression is not None:
+            pseudo = [e for e in pseudo
+                      if not 0 <= e - rfb.ENCODING_COMPRESS_LEVEL_0 <= 9]
+            pseudo.append(rfb.ENCODING_COMPRESS_LEVEL_0 + self.compression)
+        if self.quality is not None:
+            pseudo = [e for e in pseudo
+                      if not 0 <= e - rfb.ENCODING_QUALITY_LEVEL_0 <= 9]
+            pseudo.append(rfb.ENCODING_QUALITY_LEVEL_0 + self.quality)
+        if rfb.ENCODING_RAW not in real:
+            # Raw是所有客户端都必须支持的兜底编码
+            real.append(rfb.ENCODING_RAW)
+        return real + pseudo
+
+
+class EncodingPolicy:
+    """按来源网络选择编码规则"""
+
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+
+    @classmethod
+    def from_config(cls, config):
+        """规则列表，或 {"rules": [...]}"""
+        if config is None:
+            return cls()
+        if isinstance(config, dict):
+            config = config.get('rules', [])
+        return cls(EncodingRule.from_config(entry) for entry in config)
+
+    @property
+    def enabled(self):
+        return bool(self.rules)
+
+    def rule_for(self, address):
+        """客户端地址命中的规则，没有时返回None"""
+        try:
+            ip = client_ip(address)
+        except ValueError:
+            return None
+        for rule in self.rules:
+            if rule.matches(ip):
+                return rule
+        return None
+
+
+def load_encoding_policy(source):
+    """从JSON文件路径或已解析的配置创建EncodingPolicy"""
+    if isinstance(source, str):
+        with open(source, 'r', encoding='utf-8') as f:
+            source = json.load(f)
+    return EncodingPolicy.from_config(source)
+
+
+class ClientStreamFilter:
+    """客户端数据流的增量解析器
+
+    握手阶段识别协议版本、安全类型和ClientInit，之后按消息边界切分；
+    SetEncodings交给 on_set_encodings(编码列表) 改写，指定throttle时更新请求经过节流，
+    其他消息原样转发。遇到无法解析的内容（协议3.3、需要额外交互的安全类型、未知的扩展消息）时
+    转为透传，on_passthrough(原因) 通知调用方。
+
+    节流产生待发请求或指定qos时，调用方需要在 deadline() 到期后调用 flush() 取出待发数据，
+    并在每次写出后调用 written()。
+    指定coalescer时，调用方在服务器方向不可写时把 congested 设为True，期间消息暂存不输出；
+    holding 为True时等服务器方向可写后把 congested 设为False，再调用 flush() 取出暂存的数据。
+    on_unit(状态, 数据) 在每个握手单元或消息解析完成时调用（改写之前）。
+    指定stats（客户端方向的session.DirectionStats）时，每个键盘/指针事件累加其 inputs。
+    """
+
+    def __init__(self, on_set_encodings, on_passthrough=None, throttle=None,
+                 on_unit=None, qos=None, coalescer=None, stats=None):
+        self.on_set_encodings = on_set_encodings
+        self.on_passthrough = on_passthrough
+        self.throttle = throttle
+        self.on_unit = on_unit
+        self.qos = qos
+        self.coalescer = coalescer
+        self.stats = stats
+        self.state = STATE_VERSION
+        self.pending = bytearray()
+        # 未启用qos时，拥塞期间暂存的消息
+        self.held = bytearray()
+
+    @property
+    def passthrough(self):
+        return self.state == STATE_PASSTHROUGH
+
+    @property
+    def congested(self):
+        return self.coalescer is not None and self.coalescer.congested
+
+    @congested.setter
+    def congested(self, value):
+        if self.coalescer is not None:
+            self.coalescer.congested = value
+
+    @property
+    def holding(self):
+        """拥塞期间是否有暂存的数据（等待服务器方向可写）"""
+        if not self.congested:
+            return False
+        return self.qos.pending if self.qos is not None else bool(self.held)
+
+    def _give_up(self, reason):
+        self.state = STATE_PASSTHROUGH
+        if self.on_passthrough:
+            self.on_passthrough(reason)
+
+    def deadline(self):
+        """节流中待发请求或排队消息的到期时间（time.monotonic），没有时返回None"""
+        deadline = self.throttle.deadline() if self.throttle is not None else None
+        if self.congested:
+            # 暂存的数据等服务器方向可写后再发出
+            return deadline
+        now = time.monotonic()
+        if self.qos is not None:
+            queued = self.qos.deadline(now)
+        else:
+            queued = now if self.held else None
+        if queued is not None and (deadline is None or queued < deadline):
+            deadline = queued
+        return deadline
+
+    def flush(self):
+        """取出已到期的合并请求和可以发出的排队/暂存消息"""
+        now = time.monotonic()
+        data = self.throttle.flush(now) if self.throttle is not None else b""
+        if self.qos is None and self.coalescer is None:
+            return data
+        self._hold(data)
+        return self._release(now)
+
+    def _hold(self, message):
+        """消息交给qos排队，或进入暂存区"""
+        if self.qos is not None:
+            self.qos.push(message)
+        else:
+            self.coalescer.append(self.held, message)
+
+    def _release(self, now):
+        """不拥塞时取出可以写出的数据"""
+        if self.congested:
+            return b""
+        if self.qos is not None:
+            return self.qos.take(now)
+        data = bytes(self.held)
+        self.held.clear()
+        return data
+
+    def written(self):
+        """输出的数据已写出"""
+        if self.qos is not None:
+            self.qos.written()
+
+    def feed(self, data):
+        """输入收到的数据，返回应转发给服务器的数据（可能为空）"""
+        if self.state == STATE_PASSTHROUGH:
+            return data
+        pending = self.pending
+        pending += data
+        out = bytearray(self.flush())
+        offset = 0
+        while self.state != STATE_PASSTHROUGH:
+            size = self._next_size(pending, offset)
+            if size is None or len(pending) - offset < size:
+                break
+            message = pending[offset:offset + size]
+            offset += size
+            state = self.state
+            if self.on_unit is not None:
+                self.on_unit(state, message)
+            if (self.stats is not None and state == STATE_MESSAGES
+                    and message[0] in INPUT_EVENTS):
+                self.stats.inputs += 1
+            if state == STATE_MESSAGES and (self.qos is not None
+                                            or self.coalescer is not None):
+                self._hold(self._handle(message))
+            else:
+                out += self._handle(message)
+        if self.qos is not None or self.coalescer is not None:
+            out += self._release(time.monotonic())
+        if self.state == STATE_PASSTHROUGH:
+            if self.qos is not None:
+                # 不再解析，排队的消息按顺序全部发出
+                out += self.qos.drain()
+            out += self.held
+            self.held.clear()
+            if self.throttle is not None:
+                # 不再解析，节流中的请求立即发出
+                out += self.throttle.flush(time.monotonic(), force=True)
+            out += pending[offset:]
+            offset = len(pending)
+        del pending[:offset]
+        return out
+
+    def _next_size(self, pending, offset):
+        """当前状态下下一个完整单元的长度，长度未知（头部不全）时返回None"""
+        state = self.state
+        if state == STATE_VERSION:
+            return 12
+        if state in (STATE_SECURITY, STATE_CLIENT_INIT):
+            return 1
+        if state == STATE_VNC_AUTH:
+            return VNC_AUTH_RESPONSE_SIZE
+        if offset >= len(pending):
+            return None
+        message_type = pending[offset]
+        size = rfb.CLIENT_FIXED_SIZES.get(message_type)
+        if size is not None:
+            return size
+        header_size = rfb.CLIENT_HEADER_SIZES.get(message_type)
+        if header_size is None:
+            self._give_up(f"未知的客户端消息类型 {message_type}")
+            return None
+        if len(pending) - offset < header_size:
+            return None
+        try:
+            return header_size + rfb.client_payload_length(pending, offset)
+        except rfb.RFBError as e:
+            self._give_up(str(e))
+            return None
+
+    def _handle(self, message):
+        state = self.state
+        if state == STATE_VERSION:
+            try:
+                version = rfb.negotiate_version(rfb.parse_version(bytes(message)))
+            except rfb.RFBError as e:
+                self._give_up(str(e))
+                return message
+            if version == (3, 3):
+                # 3.3由服务器指定安全类型，只看客户端数据流无法确定握手长度
+                self._give_up("协议3.3")
+            else:
+                self.state = STATE_SECURITY
+        elif state == STATE_SECURITY:
+            security_type = message[0]
+            if security_type == rfb.SECURITY_NONE:
+                self.state = STATE_CLIENT_INIT
+            elif security_type == rfb.SECURITY_VNC_AUTH:
+                self.state = STATE_VNC_AUTH
+            else:
+                self._give_up(f"安全类型 {security_type}")
+        elif state == STATE_VNC_AUTH:
+            self.state = STATE_CLIENT_INIT
+        elif state == STATE_CLIENT_INIT:
+            self.state = STATE_MESSAGES
+        elif message[0] == rfb.SET_ENCODINGS:
+            encodings = self.on_set_encodings(rfb.parse_set_encodings(message))
+            return rfb.build_set_encodings(encodings)
+        elif message[0] == rfb.FRAMEBUFFER_UPDATE_REQUEST and self.throttle is not None:
+            return self.throttle.on_request(message, time.monotonic())
+        return message
+
+
+def build_rewriter(rule, logger, client_addr, session=None):
+    """按规则改写SetEncodings并记录协商结果的回调"""
+
+    def rewrite(requested):
+        encodings = rule.apply(requested) if rule else list(requested)
+        if session is not None:
+            session.encodings = encodings
+        if rule and encodings != requested:
+            logger.info(f"客户端 {client_addr} 请求编码 {rfb.encoding_names(requested)}，"
+                        f"按策略 {rule.name} 改写为 {rfb.encoding_names(encodings)}")
+        else:
+            logger.info(f"客户端 {client_addr} 协商编码 {rfb.encoding_names(encodings)}")
+        return encodings
+
+    return rewrite
+
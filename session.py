@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+VNC会话对象
+用 __slots__ 固定属性，转发热路径上的计数只是对象属性自增
+"""
+
+import time
+import uuid
+from datetime import datetime
+
+import rfb
+
+# 一次发送耗时超过该值记为发送阻塞（对端或网络跟不上）
+SEND_STALL_SECONDS = 0.05
+
+# 转发方向
+UPSTREAM = "upstream"      # 客户端 -> VNC服务器
+DOWNSTREAM = "downstream"  # VNC服务器 -> 客户端
+
+
+class DirectionStats:
+    """单方向的转发计数"""
+
+    __slots__ = ('bytes', 'chunks', 'stalls', 'inputs')
+
+    def __init__(self):
+        self.bytes = 0
+        self.chunks = 0
+        self.stalls = 0
+        # 客户端方向解析到的键盘/指针事件数，不解析客户端数据流时为None
+        self.inputs = None
+
+    def add(self, other):
+        """累加另一组计数"""
+        self.bytes += other.bytes
+        self.chunks += other.chunks
+        self.stalls += other.stalls
+
+    def snapshot(self):
+        return {'bytes': self.bytes, 'chunks': self.chunks, 'stalls': self.stalls}
+
+
+class Session:
+    """一个客户端会话：客户端连接、后端连接和转发计数"""
+
+    __slots__ = ('id', 'client_socket', 'vnc_socket', 'client_addr', 'start_time',
+                 'started', 'active', 'relay_path', 'shared', 'tasks', 'upstream',
+                 'downstream', 'encodings', 'throttle', 'qos', 'coalescer', 'recording',
+                 'idle')
+
+    def __init__(self, client_socket, vnc_socket, client_addr):
+        # 日志和统计中关联同一会话的短ID
+        self.id = uuid.uuid4().hex[:8]
+        self.client_socket = client_socket
+        self.vnc_socket = vnc_socket
+        self.client_addr = client_addr
+        self.start_time = datetime.now()
+        self.started = time.monotonic()
+        self.active = True
+        self.relay_path = None
+        # 共享观看模式下的SharedBackend
+        self.shared = None
+        # asyncio引擎的转发任务
+        self.tasks = ()
+        self.upstream = DirectionStats()
+        self.downstream = DirectionStats()
+        # 客户端最近一次协商的编码（只在经过RFB过滤器或共享会话时可知）
+        self.encodings = None
+        # 更新请求节流（rfb.UpdateThrottle），未启用时为None
+        self.throttle = None
+        # 输入优先调度（qos.InputQoS），未启用时为None
+        self.qos = None
+        # 拥塞时的指针移动合并（qos.PointerCoalescer），未启用时为None
+        self.coalescer = None
+        # 会话录制（recorder.SessionRecording），未录制时为None
+        self.recording = None
+        # 长时间没有输入、等待交给新客户端（liveness.IDLE_HANDOVER）
+        self.idle = False
+
+    def updates_suppressed(self):
+        """被节流或合并、没有单独转发的更新请求数"""
+        if self.throttle is not None:
+            return self.throttle.suppressed
+        if self.shared is not None:
+            return self.shared.merger.merged
+        return 0
+
+    def pointer_coalesced(self):
+        """服务器方向拥塞时被合并、没有单独转发的指针移动事件数"""
+        return self.coalescer.coalesced if self.coalescer is not None else 0
+
+    def duration(self):
+        """会话持续时间（秒）"""
+        return time.monotonic() - self.started
+
+    def snapshot(self):
+        """会话状态快照"""
+        return {
+            'id': self.id,
+            'client_addr': f"{self.client_addr[0]}:{self.client_addr[1]}",
+            'start_time': self.start_time.strftime('%Y-%m-%d %H:%M:%S'),
+            'duration_seconds': round(self.duration(), 3),
+            'relay_path': self.relay_path,
+            'shared': self.shared is not None,
+            UPSTREAM: self.upstream.snapshot(),
+            DOWNSTREAM: self.downstream.snapshot(),
+            'encodings': (rfb.encoding_names(self.encodings)
+                          if self.encodings is not None else None),
+            'updates_suppressed': self.updates_suppressed(),
+            'updates_delayed': (self.throttle.delayed if self.throttle is not None
+                                else 0),
+            'qos': self.qos.get_stats() if self.qos is not None else None,
+            'pointer_coalesced': self.pointer_coalesced(),
+            'input_events': self.upstream.inputs,
+            'idle': self.idle,
+            'recording': self.recording.path if self.recording is not None else None,
+        }
@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+共享观看模式
+代理自己持有一条后端连接并完成RFB握手，会话所有者拥有完整控制权，
+其余客户端作为只读观察者接收同一份FramebufferUpdate广播：
+- 观察者的键盘、鼠标和剪贴板消息被丢弃
+- 所有客户端的FramebufferUpdateRequest合并成一个上游请求
+- 观察者发送队列满时丢弃积压的更新并请求一次全屏刷新，不拖慢所有者
+- 共享连接只有一种像素格式（由所有者决定），与之不同的观察者无法解码广播的更新：
+  观察者请求其他格式时断开；所有者切换格式时，先断开仍使用旧格式的观察者，再把请求发给服务器
+启用帧缓冲区缓存时，新加入、重连或掉队的客户端直接收到由缓存合成的全屏画面，
+所有者断开后后端连接可保留一段时间等待重连。
+保留后端的接管模式（--takeover-mode keep_backend）也使用这里的后端连接：没有观察者，
+新客户端获准接管时直接替换所有者，不重新连接VNC服务器。
+"""
+
+import socket
+import threading
+import time
+from collections import deque
+
+import rfb
+from fbcache import FramebufferCache
+from qos import INPUT_EVENTS
+from session import SEND_STALL_SECONDS
+from status_bus import EVENT_VIEWERS
+
+# 共享连接向后端声明的编码：只用不依赖历史状态的编码，
+# 观察者中途加入或丢弃积压更新后仍能正确解码（ZRLE/Zlib/Tight的zlib流贯穿整条连接，不能使用）
+SHARED_ENCODINGS = (rfb.ENCODING_HEXTILE, rfb.ENCODING_RRE, rfb.ENCODING_RAW)
+
+# 有帧缓冲区缓存时可以额外使用CopyRect：客户端画面总是从缓存快照开始，与服务器一致
+CACHED_ENCODINGS = (rfb.ENCODING_COPYRECT,) + SHARED_ENCODINGS
+
+# 每个观察者最多积压的字节数（至少容纳两帧全屏Raw更新）
+OBSERVER_QUEUE_BYTES = 32 * 1024 * 1024
+
+
+class Viewer:
+    """共享会话中的一个客户端连接"""
+
+    def __init__(self, sock, addr, observer, pixel_format=None):
+        self.sock = sock
+        self.addr = addr
+        self.observer = observer
+        # 客户端解码使用的像素格式（ServerInit中的格式，或之后SetPixelFormat请求的格式）
+        self.pixel_format = pixel_format
+        self.reader = rfb.SocketReader(sock)
+        self.active = True
+        # 观察者的发送队列
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.max_queued_bytes = OBSERVER_QUEUE_BYTES
+        self.condition = threading.Condition()
+        self.dropped_updates = 0
+        self.dropped_input = 0
+        # 已为丢弃的更新请求过全屏刷新，队列排空前不再重复请求
+        self.refresh_requested = False
+        # 已由缓存发送过全屏画面，下一个全量更新请求可改为增量
+        self.primed = False
+
+    def enqueue(self, message):
+        """放入发送队列，超过积压上限时返回False"""
+        with self.condition:
+            if self.queued_bytes + len(message) > self.max_queued_bytes:
+                return False
+            self.queue.append(message)
+            self.queued_bytes += len(message)
+            self.condition.notify()
+        return True
+
+    def drop_queued(self):
+        """丢弃所有积压的消息，返回丢弃数量"""
+        with self.condition:
+            dropped = len(self.queue)
+            self.queue.clear()
+            self.queued_bytes = 0
+        return dropped
+
+    def write_loop(self):
+        """发送线程：把队列中的消息写给观察者"""
+        while self.active:
+            with self.condition:
+                while self.active and not self.queue:
+                    self.condition.wait()
+                if not self.active:
+                    return
+                message = self.queue.popleft()
+                self.queued_bytes -= len(message)
+                if not self.queue:
+                    self.refresh_requested = False
+            self.sock.sendall(message)
+
+    def close(self):
+        """关闭连接并唤醒发送线程"""
+        self.active = False
+        with self.condition:
+            self.condition.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class SharedBackend:
+    """一条由代理终结握手的后端连接，供所有者和观察者共享"""
+
+    def __init__(self, proxy, vnc_socket):
+        self.proxy = proxy
+        self.logger = proxy.logger
+        self.vnc_socket = vnc_socket
+        self.reader = rfb.SocketReader(vnc_socket)
+        self.server_init = None
+        self.message_reader = None
+        self.session = None
+        self.owner = None
+        self.observers = []
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.merger = rfb.UpdateRequestMerger(
+            self.send_upstream,
+            1.0 / proxy.max_update_rate if proxy.max_update_rate > 0 else 0)
+        self.active = True
+        # 帧缓冲区缓存，未启用或超出内存预算时为None
+        self.cache = None
+        self.cache_hits = 0
+        # 所有者断开后保留后端等待重连的秒数
+        self.linger = proxy.reconnect_linger
+        self.linger_timer = None
+        # 所有者已断开、后端正在等待重连
+        self.owner_vacant = False
+
+    def connect(self, greeting=None):
+        """与VNC服务器完成握手，greeting为预热连接已读取的服务器版本串"""
+        version, self.server_init = rfb.client_handshake(self.vnc_socket, self.reader,
+                                                         server_version=greeting,
+                                                         shared=True)
+        self.message_reader = rfb.ServerMessageReader(self.reader,
+                                                      self.server_init.pixel_format)
+        self.logger.info(f"共享后端握手完成: RFB {version[0]}.{version[1]}, "
+                         f"{self.server_init.width}x{self.server_init.height}, "
+                         f"桌面 {self.server_init.name.decode('utf-8', 'replace')}")
+        if self.proxy.fb_cache_mb > 0:
+            self.setup_cache()
+
+    def setup_cache(self):
+        """按会话像素格式创建帧缓冲区缓存"""
+        budget = int(self.proxy.fb_cache_mb * 1024 * 1024)
+        init = self.server_init
+        cache = FramebufferCache(init.width, init.height, init.pixel_format, budget)
+        if not cache.enabled:
+            self.logger.warning(f"帧缓冲区 {init.width}x{init.height}"
+                                f"x{init.pixel_format.bits_per_pixel}位 "
+                                f"超出缓存预算 {self.proxy.fb_cache_mb}MB，不启用缓存")
+            return
+        self.cache = cache
+        self.logger.info(f"帧缓冲区缓存已启用: {cache.memory_bytes() // 1024}KB")
+
+    def allowed_encodings(self):
+        """共享连接可以向服务器声明的编码"""
+        return CACHED_ENCODINGS if self.cache else SHARED_ENCODINGS
+
+    def send_upstream(self, data):
+        """向VNC服务器发送（多个线程共用，需加锁）"""
+        with self.send_lock:
+            self.vnc_socket.sendall(data)
+        session = self.session
+        if session is not None:
+            session.upstream.bytes += len(data)
+            session.upstream.chunks += 1
+
+    def handshake_viewer(self, sock, addr, observer):
+        """与客户端完成握手，返回Viewer"""
+        viewer = Viewer(sock, addr, observer, self.server_init.pixel_format)
+        viewer.max_queued_bytes = max(
+            OBSERVER_QUEUE_BYTES,
+            2 * self.server_init.width * self.server_init.height
+            * (self.server_init.pixel_format.bits_per_pixel // 8))
+        rfb.server_handshake(sock, viewer.reader, self.server_init)
+        return viewer
+
+    def start(self, owner):
+        """以握手完成的所有者启动共享会话"""
+        self.owner = owner
+        threading.Thread(target=self.backend_loop, daemon=True).start()
+        threading.Thread(target=self.owner_loop, args=(owner,), daemon=True).start()
+
+    def join(self, sock, addr):
+        """加入共享会话（在客户端处理线程中调用）
+
+        所有者空缺（等待重连）时成为新的所有者，否则作为只读观察者。
+        """
+        try:
+            viewer = self.handshake_viewer(sock, addr, observer=True)
+        except Exception as e:
+            self.logger.info(f"客户端 {addr} 加入共享会话时握手失败: {e}")
+            try:
+                sock.close()
+            except OSError:
+                pass
+            return
+        with self.lock:
+            if not self.active:
+                viewer.close()
+                return
+            if self.owner_vacant:
+                self.attach_owner(viewer)
+                return
+            # 在锁内取快照：之后广播的消息都晚于快照
+            snapshot = self.cache.full_update() if self.cache else None
+            if snapshot is not None:
+                viewer.enqueue(snapshot)
+                viewer.primed = True
+                self.cache_hits += 1
+            self.observers.append(viewer)
+            count = len(self.observers)
+            self.publish_status()
+        self.logger.info(f"观察者 {addr} 加入共享会话，当前观察者 {count} 人"
+                         f"{'（由缓存发送首帧）' if viewer.primed else ''}")
+        threading.Thread(target=self.observer_write_loop, args=(viewer,),
+                         daemon=True).start()
+        threading.Thread(target=self.observer_read_loop, args=(viewer,),
+                         daemon=True).start()
+
+    def remove_observer(self, viewer, reason):
+        """移除观察者"""
+        with self.lock:
+            if viewer not in self.observers:
+                return
+            self.observers.remove(viewer)
+            count = len(self.observers)
+            self.publish_status()
+        viewer.close()
+        self.logger.info(f"观察者 {viewer.addr} 离开共享会话（{reason}），"
+                         f"丢弃更新 {viewer.dropped_updates} 条，"
+                         f"丢弃输入 {viewer.dropped_input} 条，"
+                         f"剩余观察者 {count} 人")
+
+    def attach_owner(self, viewer):
+        """空缺的所有者位置由新客户端接替（调用方持有self.lock）"""
+        viewer.observer = False
+        if self.linger_timer:
+            self.linger_timer.cancel()
+            self.linger_timer = None
+        snapshot = self.cache.full_update() if self.cache else None
+        if snapshot is not None:
+            # 在锁内发送，保证快照之后的更新按顺序到达
+            viewer.sock.sendall(snapshot)
+            viewer.primed = True
+            self.cache_hits += 1
+        self.owner = viewer
+        self.owner_vacant = False
+        session = self.session
+        if session is not None:
+            session.client_socket = viewer.sock
+            session.client_addr = viewer.addr
+        self.publish_status()
+        self.logger.info(f"客户端 {viewer.addr} 接替共享会话所有者"
+                         f"{'（由缓存发送首帧）' if viewer.primed else ''}")
+        threading.Thread(target=self.owner_loop, args=(viewer,), daemon=True).start()
+
+    def replace_owner(self, viewer, session):
+        """已握手的新客户端接管所有者，旧所有者断开；返回是否成功"""
+        with self.lock:
+            if not self.active:
+                viewer.close()
+                return False
+            previous = self.owner
+            self.session = session
+            self.attach_owner(viewer)
+        if previous:
+            previous.close()
+        if not viewer.primed:
+            # 代新客户端请求全屏画面；客户端随后自己的全量请求改为增量，不让服务器再编码一次全屏
+            self.merger.request(False, 0, 0, self.server_init.width,
+                                self.server_init.height)
+            viewer.primed = True
+        return True
+
+    def owner_gone(self, owner, reason):
+        """所有者断开：配置了重连等待时保留后端，否则结束会话"""
+        with self.lock:
+            if self.owner is not owner:
+                return
+            if self.linger > 0 and self.active:
+                self.owner = None
+                self.owner_vacant = True
+                self.linger_timer = threading.Timer(self.linger, self.linger_expired)
+                self.linger_timer.daemon = True
+                self.linger_timer.start()
+                self.publish_status()
+                lingering = True
+            else:
+                lingering = False
+        if not lingering:
+            self.end(reason)
+            return
+        owner.close()
+        self.logger.info(f"所有者 {owner.addr} 断开（{reason}），保留后端连接 {self.linger} 秒等待重连")
+
+    def linger_expired(self):
+        """重连等待超时"""
+        with self.lock:
+            if not self.owner_vacant:
+                return
+        self.end(f"所有者未在 {self.linger} 秒内重连")
+
+    def backend_loop(self):
+        """读取服务器消息，转发给所有者并广播给观察者"""
+        reason = "VNC服务器断开"
+        try:
+            while self.active:
+                message_type, message, rects = self.message_reader.read_message()
+                with self.lock:
+                    if message_type == rfb.FRAMEBUFFER_UPDATE:
+                        self.merger.on_update()
+                        if self.cache:
+                            self.cache.apply(message, rects)
+                    # 与缓存更新在同一把锁内取快照，新加入者不会漏掉或重复消息
+                    owner = self.owner
+                    observers = list(self.observers)
+
+                stats = self.session.downstream
+                stats.bytes += len(message)
+                stats.chunks += 1
+                if owner:
+                    started = time.perf_counter()
+                    try:
+                        owner.sock.sendall(message)
+                    except OSError as e:
+                        self.owner_gone(owner, f"发送失败: {e}")
+                    if time.perf_counter() - started > SEND_STALL_SECONDS:
+                        stats.stalls += 1
+
+                # 剪贴板内容只发给所有者
+                if message_type != rfb.SERVER_CUT_TEXT:
+                    self.broadcast(message, observers)
+        except Exception as e:
+            if self.active:
+                reason = f"后端读取异常: {e}"
+        finally:
+            self.end(reason)
+
+    def broadcast(self, message, observers):
+        """把消息放入每个观察者的发送队列"""
+        for viewer in observers:
+            if viewer.enqueue(message):
+                continue
+            # 观察者太慢：丢弃积压，补发一次全屏刷新
+            viewer.dropped_updates += viewer.drop_queued() + 1
+            # 只有后端线程修改缓存，此时缓存正好包含当前消息
+            snapshot = self.cache.full_update() if self.cache else None
+            if snapshot is not None:
+                viewer.enqueue(snapshot)
+                self.cache_hits += 1
+                continue
+            if not viewer.refresh_requested:
+                viewer.refresh_requested = True
+                self.merger.request(False, 0, 0, self.server_init.width,
+                                    self.server_init.height)
+
+    def owner_loop(self, owner):
+        """读取所有者的消息并转发给服务器"""
+        reason = "所有者断开"
+        try:
+            while self.active:
+                message_type, message = rfb.read_client_message(owner.reader)
+                if message_type == rfb.SET_PIXEL_FORMAT:
+                    pixel_format = rfb.parse_pixel_format(message, 4)
+                    owner.pixel_format = pixel_format
+                    with self.lock:
+                        self.server_init = self.server_init._replace(
+                            pixel_format=pixel_format)
+                        self.message_reader.pixel_format = pixel_format
+                        if self.cache and pixel_format != self.cache.pixel_format:
+                            # 缓存按新格式重新填充，期间不提供快照
+                            self.cache.reset(self.cache.width, self.cache.height,
+                                             pixel_format)
+                            if not self.cache.enabled:
+                                self.logger.warning("新像素格式超出缓存预算，停用帧缓冲区缓存")
+                                self.cache = None
+                        stale = [viewer for viewer in self.observers
+                                 if viewer.pixel_format != pixel_format]
+                    # 新格式的更新只会在服务器收到请求之后产生，先移除的观察者不会收到
+                    for viewer in stale:
+                        self.remove_observer(viewer, "所有者切换了像素格式，请重新连接")
+                    self.send_upstream(message)
+                elif message_type == rfb.SET_ENCODINGS:
+                    requested = rfb.parse_set_encodings(message)
+                    # 先按编码策略改写，再限制为共享连接能处理的编码
+                    rule = self.proxy.encoding_policy.rule_for(owner.addr[0])
+                    preferred = rule.apply(requested) if rule else requested
+                    allowed = self.allowed_encodings()
+                    encodings = [e for e in preferred if e in allowed]
+                    if rfb.ENCODING_RAW not in encodings:
+                        encodings.append(rfb.ENCODING_RAW)
+                    self.logger.info(f"所有者 {owner.addr} 请求编码 "
+                                     f"{rfb.encoding_names(requested)}，"
+                                     + (f"按策略 {rule.name}，" if rule else "")
+                                     + f"共享连接使用 {rfb.encoding_names(encodings)}")
+                    if self.session is not None:
+                        self.session.encodings = encodings
+                    self.send_upstream(rfb.build_set_encodings(encodings))
+                elif message_type == rfb.FRAMEBUFFER_UPDATE_REQUEST:
+                    self.request_update(owner, message)
+                else:
+                    if message_type in INPUT_EVENTS and self.session is not None:
+                        self.session.upstream.inputs += 1
+                    self.send_upstream(message)
+        except Exception as e:
+            if self.active and not isinstance(e, EOFError):
+                reason = f"所有者连接异常: {e}"
+        finally:
+            self.owner_gone(owner, reason)
+
+    def observer_read_loop(self, viewer):
+        """读取观察者的消息：只处理更新请求，丢弃输入"""
+        reason = "观察者断开"
+        try:
+            while self.active and viewer.active:
+                message_type, message = rfb.read_client_message(viewer.reader)
+                if message_type == rfb.FRAMEBUFFER_UPDATE_REQUEST:
+                    self.request_update(viewer, message)
+                elif message_type == rfb.SET_PIXEL_FORMAT:
+                    pixel_format = rfb.parse_pixel_format(message, 4)
+                    if pixel_format != self.server_init.pixel_format:
+                        # 广播的更新按共享连接的格式编码，观察者无法解码
+                        reason = (f"请求的像素格式（{pixel_format.bits_per_pixel}位，"
+                                  f"深度 {pixel_format.depth}）"
+                                  f"与共享连接不同")
+                        break
+                    viewer.pixel_format = pixel_format
+                elif message_type in (rfb.KEY_EVENT, rfb.POINTER_EVENT,
+                                      rfb.CLIENT_CUT_TEXT, rfb.FILE_TRANSFER):
+                    viewer.dropped_input += 1
+        except Exception as e:
+            if viewer.active and not isinstance(e, EOFError):
+                reason = f"观察者连接异常: {e}"
+        finally:
+            self.remove_observer(viewer, reason)
+
+    def observer_write_loop(self, viewer):
+        """观察者发送线程"""
+        try:
+            viewer.write_loop()
+        except Exception as e:
+            self.remove_observer(viewer, f"发送失败: {e}")
+
+    def request_update(self, viewer, message):
+        """把客户端的更新请求交给合并器"""
+        _, incremental, x, y, width, height = rfb.UPDATE_REQUEST_STRUCT.unpack(
+            bytes(message))
+        if viewer.primed and not incremental:
+            # 客户端已经从缓存拿到全屏画面，不必让服务器再发一次
+            viewer.primed = False
+            incremental = 1
+        self.merger.request(incremental, x, y, width, height)
+
+    def publish_status(self):
+        """观察者人数、所有者空缺和所有者地址发布到状态总线（调用方持有self.lock）"""
+        session = self.session
+        if session is None or session is not self.proxy.active_session:
+            return
+        changes = {'observers': len(self.observers), 'owner_vacant': self.owner_vacant}
+        if self.owner is not None:
+            changes['client'] = f"{self.owner.addr[0]}:{self.owner.addr[1]}"
+        self.proxy.status.publish(EVENT_VIEWERS, **changes)
+
+    def end(self, reason):
+        """共享会话结束：后端或所有者断开时调用"""
+        if not self.active:
+            return
+        self.logger.info(f"共享会话结束: {reason}")
+        if self.linger_timer:
+            self.linger_timer.cancel()
+        session = self.session
+        if session is not None and session is self.proxy.active_session:
+            self.proxy.cleanup_session(session)
+        else:
+            self.close()
+
+    def close(self):
+        """关闭后端、所有者和全部观察者连接"""
+        self.active = False
+        self.merger.cancel()
+        with self.lock:
+            observers, self.observers = self.observers, []
+        for viewer in observers:
+            viewer.close()
+        if self.owner:
+            self.owner.close()
+        try:
+            self.vnc_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.vnc_socket.close()
+        except OSError:
+            pass
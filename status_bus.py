@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+状态总线
+代理在状态变化时发布事件（服务器启停、会话开始/结束/换客户端、观察者、等待队列、吞吐量采样），
+GUI窗口和托盘提示订阅后只在收到事件时重绘，不再定时读取会话对象。
+- 每次发布生成一份新的不可变快照（DesktopStatus），内容未变化时不通知订阅方
+- 订阅回调在发布方线程中执行，必须很快返回；GUI订阅方自行转交到Tk线程
+- 吞吐量采样线程只在有订阅方时运行，无GUI时没有额外开销
+"""
+
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+
+logger = logging.getLogger(__name__)
+
+# 事件
+EVENT_SERVER = "server"          # 服务器启动/停止
+EVENT_SESSION = "session"        # 会话开始、结束或更换客户端
+EVENT_VIEWERS = "viewers"        # 共享会话的观察者人数、所有者空缺
+EVENT_QUEUE = "queue"            # 等待队列长度
+EVENT_THROUGHPUT = "throughput"  # 吞吐量采样
+EVENT_CONFIG = "config"          # 重新加载配置后监听端口或后端地址变化
+EVENT_SUBSCRIBED = "subscribed"  # 订阅时立即收到的当前状态
+
+HISTORY = 60  # 保留的吞吐量采样数
+
+
+class DesktopStatus(namedtuple('DesktopStatus', [
+        'name', 'port', 'backend', 'running', 'mode', 'client', 'session_id',
+        'since', 'observers', 'owner_vacant', 'queue_depth', 'rate_up', 'rate_down',
+        'history'])):
+    """一个桌面的状态快照
+
+    backend 为VNC服务器 "主机:端口"，mode 为会话模式（shared_view / keep_backend / None），
+    client 为 "IP:端口"（无会话时为None），
+    rate_up / rate_down 为最近一次采样的字节/秒，history 为最近的 (上行, 下行) 采样。
+    """
+
+    __slots__ = ()
+
+
+def idle_session():
+    """没有会话时的会话相关字段"""
+    return {'client': None, 'session_id': None, 'since': None, 'observers': 0,
+            'owner_vacant': False, 'rate_up': 0, 'rate_down': 0, 'history': ()}
+
+
+class StatusBus:
+    """一个桌面的状态总线"""
+
+    def __init__(self, name=None, port=None, mode=None, backend=None,
+                 sample_interval=1.0, history=HISTORY):
+        self.lock = threading.Lock()
+        self.status = DesktopStatus(name=name, port=port, backend=backend,
+                                    running=False, mode=mode, queue_depth=0,
+                                    **idle_session())
+        self.subscribers = []
+        self.sample_interval = sample_interval
+        self.history = deque(maxlen=history)
+        self.read_totals = None
+        self.sampler = None
+        self.published = 0
+
+    def snapshot(self):
+        return self.status
+
+    def publish(self, event, **changes):
+        """更新状态并通知订阅方，状态未变化时返回False"""
+        with self.lock:
+            status = self.status._replace(**changes)
+            if status == self.status:
+                return False
+            if event == EVENT_SESSION:
+                self.history.clear()
+            self.status = status
+            self.published += 1
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            try:
+                callback(event, status)
+            except Exception as e:
+                logger.error(f"状态订阅回调出错: {e}")
+        return True
+
+    def subscribe(self, callback):
+        """订阅状态变化：callback(事件, DesktopStatus)，订阅时立即收到一次当前状态"""
+        with self.lock:
+            self.subscribers.append(callback)
+            status = self.status
+            if self.read_totals is not None and self.sampler is None:
+                self.sampler = threading.Thread(target=self.sample_loop,
+                                                name="status-sampler", daemon=True)
+                self.sampler.start()
+        callback(EVENT_SUBSCRIBED, status)
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def sample_with(self, read_totals):
+        """设置吞吐量采样来源：read_totals() 返回 (上行累计字节, 下行累计字节)"""
+        self.read_totals = read_totals
+
+    def sample_loop(self):
+        """有订阅方时每个采样间隔发布一次吞吐量，没有会话时不发布"""
+        previous = self.read_totals()
+        last = time.monotonic()
+        while True:
+            time.sleep(self.sample_interval)
+            with self.lock:
+                if not self.subscribers:
+                    self.sampler = None
+                    return
+            totals = self.read_totals()
+            now = time.monotonic()
+            elapsed = max(now - last, 1e-6)
+            # 会话结束时累计值在两次更新之间可能短暂回退
+            rate_up = max(0, int((totals[0] - previous[0]) / elapsed))
+            rate_down = max(0, int((totals[1] - previous[1]) / elapsed))
+            previous, last = totals, now
+            if self.status.client is None:
+                continue
+            with self.lock:
+                self.history.append((rate_up, rate_down))
+                history = tuple(self.history)
+            self.publish(EVENT_THROUGHPUT, rate_up=rate_up, rate_down=rate_down,
+                         history=history)
+
+    def get_stats(self):
+        return {'subscribers': len(self.subscribers), 'published': self.published}
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""ClientStreamFilter 的消息切分：输入构造的客户端数据流，检查切出的单元、输出和透传"""
+
+import struct
+from types import SimpleNamespace
+
+import pytest
+
+import rfb
+from rfb_filters import (STATE_CLIENT_INIT, STATE_MESSAGES, STATE_SECURITY,
+                         STATE_VERSION, STATE_VNC_AUTH, ClientStreamFilter)
+
+VERSION_38 = b"RFB 003.008\n"
+HANDSHAKE = VERSION_38 + bytes((rfb.SECURITY_NONE,)) + b"\x01"
+
+# 核心消息和各扩展消息各一条
+MESSAGES = [
+    struct.pack('>B3x', rfb.SET_PIXEL_FORMAT) + bytes(16),
+    rfb.build_set_encodings([rfb.ENCODING_ZRLE, rfb.ENCODING_RAW]),
+    rfb.build_update_request(True, 0, 0, 100, 100),
+    struct.pack('>BBxxI', rfb.KEY_EVENT, 1, 0x61),
+    struct.pack('>BBHH', rfb.POINTER_EVENT, 1, 10, 20),
+    struct.pack('>BxxxI', rfb.CLIENT_CUT_TEXT, 5) + b"hello",
+    # 扩展剪贴板：负长度
+    struct.pack('>Bxxxi', rfb.CLIENT_CUT_TEXT, -8) + b"\x00\x00\x00\x01abcd",
+    struct.pack('>BBBxII', rfb.FILE_TRANSFER, 1, 0, 0, 3) + b"abc",
+    struct.pack('>BBHHHH', rfb.ENABLE_CONTINUOUS_UPDATES, 1, 0, 0, 100, 100),
+    struct.pack('>BxxxIB', rfb.CLIENT_FENCE, 0x80000003, 4) + b"abcd",
+    struct.pack('>BxxxIB', rfb.CLIENT_FENCE, 3, 0),
+    struct.pack('>BxBB', rfb.XVP, 1, 2),
+    struct.pack('>BxHHBx', rfb.SET_DESKTOP_SIZE, 800, 600, 2) + bytes(32),
+    struct.pack('>BBHII', rfb.QEMU_CLIENT_MESSAGE, rfb.QEMU_EXTENDED_KEY_EVENT, 1,
+                0x61, 30),
+    struct.pack('>BBH', rfb.QEMU_CLIENT_MESSAGE, rfb.QEMU_AUDIO, 0),
+    struct.pack('>BBHBBI', rfb.QEMU_CLIENT_MESSAGE, rfb.QEMU_AUDIO,
+                rfb.QEMU_AUDIO_SET_FORMAT, 3, 2, 44100),
+]
+
+
+class Recorder:
+    """记录过滤器切出的单元和透传原因"""
+
+    def __init__(self, rewrite=None):
+        self.units = []
+        self.passthrough = []
+        self.requested = []
+        self.rewrite = rewrite
+
+    def on_set_encodings(self, encodings):
+        self.requested.append(encodings)
+        return self.rewrite(encodings) if self.rewrite else encodings
+
+    def on_unit(self, state, message):
+        self.units.append((state, bytes(message)))
+
+    def build(self, **kwargs):
+        return ClientStreamFilter(self.on_set_encodings, self.passthrough.append,
+                                  on_unit=self.on_unit, **kwargs)
+
+
+def feed_bytes(stream_filter, data, step=1):
+    return b"".join(bytes(stream_filter.feed(data[i:i + step]))
+                    for i in range(0, len(data), step))
+
+
+def test_handshake_units():
+    recorder = Recorder()
+    stream_filter = recorder.build()
+    assert bytes(stream_filter.feed(HANDSHAKE)) == HANDSHAKE
+    assert recorder.units == [(STATE_VERSION, VERSION_38), (STATE_SECURITY, b"\x01"),
+                              (STATE_CLIENT_INIT, b"\x01")]
+    assert stream_filter.state == STATE_MESSAGES
+
+
+def test_vnc_auth_response():
+    recorder = Recorder()
+    stream_filter = recorder.build()
+    response = bytes(range(16))
+    data = VERSION_38 + bytes((rfb.SECURITY_VNC_AUTH,)) + response + b"\x00"
+    assert feed_bytes(stream_filter, data, 5) == data
+    assert (STATE_VNC_AUTH, response) in recorder.units
+    assert stream_filter.state == STATE_MESSAGES
+
+
+@pytest.mark.parametrize('step', [1, 3, 7, 1000])
+def test_messages_split_at_any_boundary(step):
+    recorder = Recorder()
+    stream_filter = recorder.build()
+    data = HANDSHAKE + b"".join(MESSAGES)
+    assert feed_bytes(stream_filter, data, step) == data
+    assert not recorder.passthrough
+    units = [message for state, message in recorder.units if state == STATE_MESSAGES]
+    assert units == MESSAGES
+    assert not stream_filter.pending
+
+
+def test_set_encodings_rewritten():
+    recorder = Recorder(lambda encodings: [rfb.ENCODING_RAW])
+    stream_filter = recorder.build()
+    stream_filter.feed(HANDSHAKE)
+    message = rfb.build_set_encodings([rfb.ENCODING_TIGHT, rfb.ENCODING_ZRLE,
+                                       rfb.ENCODING_RAW])
+    key = MESSAGES[3]
+    out = feed_bytes(stream_filter, message + key, 2)
+    assert out == rfb.build_set_encodings([rfb.ENCODING_RAW]) + key
+    assert recorder.requested == [[rfb.ENCODING_TIGHT, rfb.ENCODING_ZRLE,
+                                   rfb.ENCODING_RAW]]
+
+
+def test_input_events_counted():
+    stats = SimpleNamespace(inputs=0)
+    stream_filter = Recorder().build(stats=stats)
+    stream_filter.feed(HANDSHAKE + b"".join(MESSAGES))
+    # 键盘、指针事件和QEMU客户端消息（扩展按键）
+    assert stats.inputs == 5
+
+
+@pytest.mark.parametrize('data, reason', [
+    (b"\x09\x00\x00\x00trailing", "9"),
+    (struct.pack('>BBH', rfb.QEMU_CLIENT_MESSAGE, 9, 0) + b"xyz", "QEMU"),
+])
+def test_unknown_message_passthrough(data, reason):
+    recorder = Recorder()
+    stream_filter = recorder.build()
+    key = MESSAGES[3]
+    out = bytes(stream_filter.feed(HANDSHAKE + key + data))
+    assert out == HANDSHAKE + key + data
+    assert stream_filter.passthrough
+    assert len(recorder.passthrough) == 1 and reason in recorder.passthrough[0]
+    # 透传后不再解析，数据原样返回
+    tail = b"\xff" * 5
+    assert stream_filter.feed(tail) == tail
+
+
+def test_passthrough_keeps_partial_message():
+    """未完成的消息在转为透传时一起发出，不丢数据"""
+    recorder = Recorder()
+    stream_filter = recorder.build()
+    partial = MESSAGES[5][:6]
+    assert bytes(stream_filter.feed(HANDSHAKE + partial)) == HANDSHAKE
+    assert bytes(stream_filter.feed(MESSAGES[5][6:] + b"\x09")) == MESSAGES[5] + b"\x09"
+    assert recorder.passthrough
+
+
+@pytest.mark.parametrize('data, reason', [
+    (b"RFB 003.003\n" + b"\x00" * 4, "3.3"),
+    (VERSION_38 + bytes((rfb.SECURITY_VNC_AUTH + 100,)) + b"\x00" * 4, "102"),
+])
+def test_handshake_passthrough(data, reason):
+    recorder = Recorder()
+    stream_filter = recorder.build()
+    assert feed_bytes(stream_filter, data, 4) == data
+    assert stream_filter.passthrough
+    assert reason in recorder.passthrough[0]
+
+
+def test_non_incremental_request_not_throttled():
+    stream_filter = Recorder().build(throttle=rfb.UpdateThrottle(1))
+    stream_filter.feed(HANDSHAKE)
+    incremental = rfb.build_update_request(True, 0, 0, 10, 10)
+    full = rfb.build_update_request(False, 0, 0, 100, 100)
+    assert bytes(stream_filter.feed(incremental)) == incremental
+    # 间隔未到，增量请求被推迟
+    assert bytes(stream_filter.feed(incremental)) == b""
+    assert stream_filter.deadline() is not None
+    assert bytes(stream_filter.feed(full)) == full
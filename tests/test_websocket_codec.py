@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""WebSocketCodec 的帧解析：向 feed() 输入构造的客户端帧，检查输出和错误"""
+
+import zlib
+
+import pytest
+
+import websocket_listener
+from websocket_listener import (CLOSE_PROTOCOL_ERROR, CLOSE_TOO_BIG,
+                                CLOSE_UNSUPPORTED_DATA, DEFLATE_TAIL, OP_BINARY,
+                                OP_CLOSE, OP_CONTINUATION, OP_PING, OP_PONG, OP_TEXT,
+                                U16, U64, DeflateSender, WebSocketCodec, WebSocketError,
+                                close_frame, frame_header, unmask)
+
+MASK = b"\x37\xfa\x21\x3d"
+
+
+def client_frame(payload, opcode=OP_BINARY, fin=True, rsv1=False, masked=True):
+    """构造客户端帧（默认加掩码）"""
+    first = (0x80 if fin else 0) | (0x40 if rsv1 else 0) | opcode
+    flag = 0x80 if masked else 0
+    length = len(payload)
+    if length < 126:
+        header = bytes((first, flag | length))
+    elif length < 65536:
+        header = bytes((first, flag | 126)) + U16.pack(length)
+    else:
+        header = bytes((first, flag | 127)) + U64.pack(length)
+    if not masked:
+        return header + payload
+    return header + MASK + unmask(payload, MASK)
+
+
+def deflate(data):
+    """按 permessage-deflate 压缩一条消息（去掉结尾的空块）"""
+    compressor = zlib.compressobj(1, zlib.DEFLATED, -15)
+    out = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    assert out.endswith(DEFLATE_TAIL)
+    return out[:-len(DEFLATE_TAIL)]
+
+
+def feed_all(codec, chunks):
+    return b"".join(bytes(codec.feed(chunk)) for chunk in chunks)
+
+
+@pytest.mark.parametrize('length', [0, 1, 125, 126, 127, 65535, 65536, 70000])
+def test_payload_lengths(length):
+    payload = bytes(i % 251 for i in range(length))
+    assert bytes(WebSocketCodec().feed(client_frame(payload))) == payload
+
+
+@pytest.mark.parametrize('length', [5, 300, 70000])
+def test_split_anywhere(length):
+    """帧在任意位置被拆开（包括扩展长度和掩码中间），都等到完整后才输出"""
+    payload = bytes(i % 251 for i in range(length))
+    frame = client_frame(payload)
+    for cut in range(1, min(16, len(frame))):
+        codec = WebSocketCodec()
+        assert bytes(codec.feed(frame[:cut])) == b""
+        assert bytes(codec.feed(frame[cut:])) == payload
+
+
+def test_byte_at_a_time():
+    frames = (client_frame(b"a" * 200) + client_frame(b"b" * 3)
+              + client_frame(b"c" * 70000))
+    codec = WebSocketCodec()
+    out = feed_all(codec, [frames[i:i + 1] for i in range(len(frames))])
+    assert out == b"a" * 200 + b"b" * 3 + b"c" * 70000
+    assert not codec.buffer
+
+
+def test_several_frames_in_one_chunk():
+    codec = WebSocketCodec()
+    data = client_frame(b"one") + client_frame(b"two") + client_frame(b"thr")[:3]
+    assert bytes(codec.feed(data)) == b"onetwo"
+    assert bytes(codec.feed(client_frame(b"thr")[3:])) == b"thr"
+
+
+def test_control_frames_inside_fragmented_message():
+    codec = WebSocketCodec()
+    data = (client_frame(b"abc", fin=False)
+            + client_frame(b"hi", opcode=OP_PING)
+            + client_frame(b"def", opcode=OP_CONTINUATION, fin=False)
+            + client_frame(b"", opcode=OP_PONG)
+            + client_frame(b"ghi", opcode=OP_CONTINUATION))
+    assert bytes(codec.feed(data)) == b"abcdefghi"
+    assert bytes(codec.outgoing) == frame_header(OP_PONG, 2) + b"hi"
+    assert codec.message is None
+    # 消息结束后可以开始新的消息
+    assert bytes(codec.feed(client_frame(b"next"))) == b"next"
+
+
+def test_close_replies_once_and_stops_parsing():
+    codec = WebSocketCodec()
+    data = client_frame(U16.pack(1001), opcode=OP_CLOSE) + client_frame(b"late")
+    assert bytes(codec.feed(data)) == b""
+    assert codec.closed
+    assert bytes(codec.outgoing) == close_frame(1001)
+    assert codec.close() == b""
+
+
+@pytest.mark.parametrize('frame, message, code', [
+    (client_frame(b"x", masked=False), "没有掩码", CLOSE_PROTOCOL_ERROR),
+    (client_frame(b"x", opcode=OP_TEXT), "二进制", CLOSE_UNSUPPORTED_DATA),
+    (client_frame(b"x", opcode=OP_CONTINUATION), "后续分片", CLOSE_PROTOCOL_ERROR),
+    (client_frame(b"x", rsv1=True), "未协商压缩", CLOSE_PROTOCOL_ERROR),
+    (bytes((0xa2, 0x81)) + MASK + b"x", "扩展位", CLOSE_PROTOCOL_ERROR),
+    (client_frame(b"x", opcode=0x3), "操作码", CLOSE_PROTOCOL_ERROR),
+    (client_frame(b"x", opcode=0xb), "控制帧", CLOSE_PROTOCOL_ERROR),
+    (client_frame(b"x", opcode=OP_PING, fin=False), "控制帧", CLOSE_PROTOCOL_ERROR),
+    (client_frame(b"x" * 126, opcode=OP_PING), "控制帧", CLOSE_PROTOCOL_ERROR),
+])
+def test_protocol_errors(frame, message, code):
+    with pytest.raises(WebSocketError, match=message) as info:
+        WebSocketCodec().feed(frame)
+    assert info.value.code == code
+
+
+def test_new_message_before_previous_ends():
+    codec = WebSocketCodec()
+    codec.feed(client_frame(b"abc", fin=False))
+    with pytest.raises(WebSocketError, match="尚未结束"):
+        codec.feed(client_frame(b"def"))
+
+
+def test_oversized_frame_rejected_from_header():
+    """帧头声明的长度超过上限时不等数据到达就报错"""
+    header = bytes((0x82, 0x80 | 127)) + U64.pack(websocket_listener.MAX_MESSAGE + 1)
+    with pytest.raises(WebSocketError) as info:
+        WebSocketCodec().feed(header)
+    assert info.value.code == CLOSE_TOO_BIG
+
+
+def test_compressed_message():
+    data = b"framebuffer " * 1000
+    codec = WebSocketCodec(DeflateSender())
+    assert bytes(codec.feed(client_frame(deflate(data), rsv1=True))) == data
+    # 客户端方向保留压缩上下文，第二条消息依赖第一条
+    compressor = zlib.compressobj(1, zlib.DEFLATED, -15)
+    first = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    second = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    codec = WebSocketCodec(DeflateSender())
+    assert bytes(codec.feed(client_frame(first[:-4], rsv1=True))) == data
+    assert bytes(codec.feed(client_frame(second[:-4], rsv1=True))) == data
+
+
+def test_compressed_fragments():
+    data = bytes(range(256)) * 40
+    compressed = deflate(data)
+    third = len(compressed) // 3
+    codec = WebSocketCodec(DeflateSender())
+    out = feed_all(codec, [
+        client_frame(compressed[:third], fin=False, rsv1=True),
+        client_frame(b"", opcode=OP_PING),
+        client_frame(compressed[third:2 * third], opcode=OP_CONTINUATION, fin=False),
+        client_frame(compressed[2 * third:], opcode=OP_CONTINUATION),
+    ])
+    assert out == data
+
+
+def test_rsv1_on_continuation_rejected():
+    codec = WebSocketCodec(DeflateSender())
+    codec.feed(client_frame(deflate(b"abc" * 100)[:10], fin=False, rsv1=True))
+    with pytest.raises(WebSocketError, match="后续分片"):
+        codec.feed(client_frame(b"", opcode=OP_CONTINUATION, rsv1=True))
+
+
+@pytest.mark.parametrize('size, accepted', [(1023, True), (1024, True), (1025, False),
+                                            (64 * 1024, False)])
+def test_decompressed_size_cap(monkeypatch, size, accepted):
+    monkeypatch.setattr(websocket_listener, 'MAX_MESSAGE', 1024)
+    codec = WebSocketCodec(DeflateSender())
+    frame = client_frame(deflate(bytes(size)), rsv1=True)
+    if accepted:
+        assert bytes(codec.feed(frame)) == bytes(size)
+    else:
+        with pytest.raises(WebSocketError) as info:
+            codec.feed(frame)
+        assert info.value.code == CLOSE_TOO_BIG
+
+
+def test_server_frames():
+    codec = WebSocketCodec()
+    assert codec.encode(b"abc") == b"\x82\x03abc"
+    header, payload = codec.frame(b"x" * 300)
+    assert header == b"\x82\x7e" + U16.pack(300) and payload == b"x" * 300
+    assert codec.close() == close_frame()
+    assert codec.close() == b""
+
+
+def test_server_frames_compressed():
+    codec = WebSocketCodec(DeflateSender())
+    data = b"0" * 4096
+    header, payload = codec.frame(data)
+    assert header[0] == 0xc2
+    decompressor = zlib.decompressobj(-15)
+    assert decompressor.decompress(payload + DEFLATE_TAIL) == data
+    # 小消息原样发出
+    assert codec.encode(b"tiny") == b"\x82\x04tiny"
@@ -8,117 +8,588 @@
 import socket
 import threading
 import time
-import tkinter as tk
-from tkinter import messagebox
 import logging
-from datetime import datetime
-import queue
-import pystray
-from PIL import Image, ImageDraw
-import sys
 import os
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('vnc_proxy_simple.log'),
-        logging.StreamHandler()
-    ]
-)
+from proxy_metrics import LatencyRecorder
+from session import Session, DirectionStats, UPSTREAM, DOWNSTREAM
+from status_bus import (StatusBus, EVENT_CONFIG, EVENT_SERVER, EVENT_SESSION,
+                        idle_session)
+from backend_pool import BackendPool, PooledConnection
+from admission import AdmissionScheduler, ADMIT, ALLOW_NEW, KEEP_CURRENT
+from ratelimit import ConnectionLimiter, TTLTable
+from rfb_filters import (ClientStreamFilter, EncodingPolicy, build_rewriter,
+                         load_encoding_policy)
+from qos import InputQoS, PointerCoalescer
+import liveness
+import relay
+import rfb
+import proxy_logging
+import refusal
+import websocket_listener
+from proxy_logging import dedup
+
+# 日志由 main() 安装的日志管道（proxy_logging）写出
 logger = logging.getLogger(__name__)
 
+# 接管方式：reconnect 断开旧会话后重新连接VNC服务器；keep_backend 保留已握手的后端连接，只替换客户端
+TAKEOVER_RECONNECT = "reconnect"
+TAKEOVER_KEEP_BACKEND = "keep_backend"
+
+# 重新加载配置时：需要重启才能生效的设置、用于新会话的后端设置、连接速率限制
+RESTART_SETTINGS = ('shared_view', 'takeover_mode', 'fb_cache_mb', 'reconnect_linger',
+                    'record', 'ws_port')
+BACKEND_SETTINGS = ('vnc_host', 'vnc_port', 'pool_size', 'pool_max_idle',
+                    'pool_prefetch_version')
+RATE_SETTINGS = ('ip_rate', 'ip_burst', 'subnet_rate', 'subnet_burst')
+TLS_SETTINGS = ('tls_cert', 'tls_key', 'tls_ciphers', 'tls_min_version', 'tls_alpn',
+                'tls_tickets')
+
+class DesktopLogger(logging.LoggerAdapter):
+    """给日志带上桌面名称（和会话ID），多桌面模式下区分日志来源"""
+    
+    def process(self, msg, kwargs):
+        # 合并调用时传入的extra（如dedup键），而不是被适配器的extra覆盖
+        extra = kwargs.get('extra')
+        kwargs['extra'] = dict(self.extra, **extra) if extra else self.extra
+        return msg, kwargs
+        
+    def for_session(self, session):
+        """带会话ID和客户端地址的日志器"""
+        addr = session.client_addr
+        return DesktopLogger(self.logger, dict(self.extra, session=session.id,
+                                               client=f"{addr[0]}:{addr[1]}"))
+
 class SimpleVNCProxy:
-    def __init__(self, vnc_host="127.0.0.1", vnc_port=5901, proxy_port=5900):
+    def __init__(self, vnc_host="127.0.0.1", vnc_port=5901, proxy_port=5900,
+                 engine="thread", stats_interval=0, relay_path=relay.PATH_AUTO,
+                 name=None, shared_view=False, fb_cache_mb=0, reconnect_linger=0,
+                 pool_size=0, pool_max_idle=30, pool_prefetch_version=False,
+                 queue_wait=0, max_queue=16, ip_rate=0, ip_burst=10,
+                 subnet_rate=0, subnet_burst=30, max_tracked=65536, backlog=128,
+                 headless_decision=KEEP_CURRENT, encoding_policy=None,
+                 max_update_rate=0, recorder=None, takeover_mode=TAKEOVER_RECONNECT,
+                 refuse_timeout=5,
+                 decision_timeout=5, qos=False, qos_bulk_rate=0, coalesce_pointer=False,
+                 keepalive=0, user_timeout=0, client_idle_timeout=0,
+                 server_idle_timeout=0, input_idle_minutes=0,
+                 input_idle_action=liveness.IDLE_HANDOVER, ws_port=0,
+                 ws_deflate=websocket_listener.DEFLATE_AUTO, tls=None):
         self.vnc_host = vnc_host
         self.vnc_port = vnc_port
         self.proxy_port = proxy_port
+        self.backlog = backlog  # 监听队列长度，重连高峰时避免SYN被丢弃
+        
+        # 桌面名称（多桌面模式下用于日志和对话框）
+        self.name = name
+        self.logger = DesktopLogger(logger, {'desktop': name})
+        
+        # 转发引擎: "thread" 为每个方向一个线程, "asyncio" 为单事件循环
+        self.engine_name = engine
+        self.engine = None
+        
+        # 转发路径: auto/splice/buffer，各路径启动的转发方向数
+        self.relay_path = relay_path
+        self.relay_path_counts = {relay.PATH_SPLICE: 0, relay.PATH_BUFFER: 0,
+                                  relay.PATH_FILTER: 0}
+        
+        # 按客户端来源网络改写SetEncodings的策略，配置后客户端->服务器方向经过RFB过滤器
+        self.encoding_policy = encoding_policy or EncodingPolicy()
+        # 每个会话每秒最多转发的增量更新请求数（0为不限制），同样需要经过RFB过滤器
+        self.max_update_rate = max_update_rate
+        
+        # 输入优先调度：客户端方向经过RFB过滤器，键盘/指针事件先于剪贴板等大消息发出，
+        # 大消息按每个会话的令牌桶限速（KB/秒，0为不限速）
+        self.qos = qos
+        self.qos_bulk_rate = qos_bulk_rate
+        # 服务器方向拥塞期间合并按钮状态不变的连续指针移动，同样需要经过RFB过滤器
+        self.coalesce_pointer = coalesce_pointer
+        
+        # WebSocket监听端口（0为关闭）：浏览器客户端直接连接，不经过websockify；
+        # ws_deflate 为permessage-deflate的协商方式（websocket_listener.DEFLATE_*）
+        self.ws_port = ws_port
+        self.ws_deflate = ws_deflate
+        self.websocket = (websocket_listener.WebSocketListener(self, ws_port, backlog)
+                          if ws_port else None)
+        
+        # 监听端口（和WebSocket端口）的TLS终结（proxy_tls.TLSTerminator，None为明文），
+        # 客户端完成TLS握手后才进入单用户和决策流程，到VNC服务器的连接仍为明文
+        self.tls = tls
+        
+        # 共享观看模式：后续客户端以只读观察者身份共用同一条后端连接
+        self.shared_view = shared_view
+        
+        # 保留后端的接管：会话同样由代理终结握手（SharedBackend，但没有观察者），
+        # 新客户端获准接管时直接替换所有者，不重新连接VNC服务器
+        self.keep_backend = takeover_mode == TAKEOVER_KEEP_BACKEND and not shared_view
+        
+        # 会话录制（recorder.Recorder，可多个桌面共用），录制的会话只走缓冲区转发路径
+        self.recorder = recorder
+        if recorder and (shared_view or self.keep_backend):
+            self.logger.warning("由代理终结握手的会话（共享观看、保留后端接管）不支持录制，已忽略")
+            self.recorder = None
+        
+        # 帧缓冲区缓存预算（MB，0为关闭）和所有者断开后保留后端等待重连的秒数，
+        # 只对由代理终结握手的共享会话生效
+        self.fb_cache_mb = fb_cache_mb
+        self.reconnect_linger = reconnect_linger
+        if (fb_cache_mb or reconnect_linger) and not (shared_view or self.keep_backend):
+            self.logger.warning("帧缓冲区缓存和重连等待需要共享观看模式（--shared-view）"
+                                "或保留后端接管（--takeover-mode keep_backend），已忽略")
+        
+        # 预热后端连接池（pool_size为0时不启用）
+        self.backend_pool = None
+        if pool_size > 0:
+            self.backend_pool = BackendPool(vnc_host, vnc_port, pool_size,
+                                            pool_max_idle, pool_prefetch_version,
+                                            self.logger)
+        
+        # 状态总线：会话、队列和吞吐量变化时发布，GUI订阅后只在状态变化时重绘
+        mode = ("shared_view" if shared_view
+                else "keep_backend" if self.keep_backend else None)
+        self.status = StatusBus(name, proxy_port, mode, f"{vnc_host}:{vnc_port}")
+        self.status.sample_with(self.traffic_bytes)
         
         # 连接状态
-        self.active_session = None  # 当前活跃的会话
+        self.active_session = None  # 当前活跃的会话（赋值时发布到状态总线）
+        self.session_lock = threading.Lock()  # 保护当前会话的检查与清除
         self.server_socket = None
+        self.watchdog = liveness.IdleWatchdog(self)
         self.is_running = False
+        # 线程模式多桌面路由（DesktopRouter），监听端口变化时由它替换选择器中的监听套接字
+        self.acceptor = None
+        
+        # 构建时的完整桌面设置（resolve_desktop），重新加载配置时与新设置比较
+        self.settings = {}
+        # 配置重新加载（config_reload.ConfigReloader），由main()设置
+        self.reloader = None
         
-        # 等待队列
-        self.waiting_queue = queue.Queue()
+        # 接入调度：有活跃会话时新客户端排队等待决策
+        self.admission = AdmissionScheduler(self, queue_wait, max_queue,
+                                            decision_timeout)
+        # 无GUI时新客户端的默认决策：keep_current 保留当前会话，allow_new 直接接管
+        self.headless_decision = headless_decision
         
-        # GUI
+        # GUI（vnc_proxy_gui，不带 --no-gui 时才导入）：Tk根窗口、主窗口和决策对话框
         self.root = None
+        self.window = None
         self.decision_dialog = None
-        self.user_decision = None
         
-        # 系统托盘
-        self.tray_icon = None
-        self.show_gui = True
-        
-        # 被拒绝的客户端冷却
-        self.rejected_ips = {}  # ip -> reject_time
+        # 被拒绝的客户端冷却（有容量上限，按到期时间自动清理）
+        self.rejected_ips = TTLTable(60, max_tracked)  # ip -> reject_time
         self.grace_period = 60  # 1分钟冷却期
+        # 被拒绝的客户端发送版本串的最长等待时间（秒），超时直接关闭
+        self.refuse_timeout = refuse_timeout
+        
+        # 会话两端连接的TCP keepalive空闲秒数和TCP_USER_TIMEOUT秒数（0为不设置）
+        self.keepalive = keepalive
+        self.user_timeout = user_timeout
+        # 客户端/服务器方向没有收到数据、没有键盘/指针输入多久后回收会话（0为不检查），
+        # 输入空闲的处理方式见 liveness.IDLE_FREE / IDLE_HANDOVER
+        self.client_idle_timeout = client_idle_timeout
+        self.server_idle_timeout = server_idle_timeout
+        self.input_idle_minutes = input_idle_minutes
+        self.input_idle_action = input_idle_action
+        self.reclaimed = dict.fromkeys(liveness.REASONS, 0)
+        
+        # 接受连接后、启动线程前的速率限制
+        self.rate_limiter = ConnectionLimiter(ip_rate, ip_burst, subnet_rate,
+                                              subnet_burst, max_tracked)
+        
+        # 运行统计
+        self.relay_latency = LatencyRecorder()
+        self.backend_connect_latency = LatencyRecorder()  # 新会话获得后端连接的耗时
+        self.input_latency = LatencyRecorder()  # QoS模式下输入事件从收到到写出的耗时
+        self.counters = {'accepted': 0, 'refused': 0, 'takeovers': 0, 'sessions': 0,
+                         'updates_suppressed': 0, 'updates_delayed': 0,
+                         'pointer_coalesced': 0, 'websocket': 0, 'websocket_failed': 0}
+        # 已结束会话的累计流量和时长，加上当前会话即为总量
+        self.traffic_totals = {UPSTREAM: DirectionStats(), DOWNSTREAM: DirectionStats()}
+        self.session_seconds_total = 0.0
+        self.stats_interval = stats_interval  # 统计日志间隔（秒），0为关闭
+        
+    @property
+    def active_session(self):
+        return self._active_session
+        
+    @active_session.setter
+    def active_session(self, session):
+        self._active_session = session
+        self.publish_session(session)
+        
+    @property
+    def is_running(self):
+        return self._is_running
+        
+    @is_running.setter
+    def is_running(self, running):
+        self._is_running = running
+        self.status.publish(EVENT_SERVER, running=running)
+        if running:
+            self.watchdog.start()
+        
+    def publish_session(self, session):
+        """把当前会话（客户端、会话ID、开始时间）发布到状态总线"""
+        if session is None:
+            self.status.publish(EVENT_SESSION, **idle_session())
+            return
+        host, port = session.client_addr[0], session.client_addr[1]
+        self.status.publish(EVENT_SESSION,
+                            **dict(idle_session(), client=f"{host}:{port}",
+                                   session_id=session.id,
+                                   since=session.start_time.strftime('%H:%M:%S')))
+        
+    @property
+    def grace_period(self):
+        """冷却期（秒）"""
+        return self.rejected_ips.ttl
+        
+    @grace_period.setter
+    def grace_period(self, seconds):
+        self.rejected_ips.ttl = seconds
+        
+    def create_listen_socket(self):
+        """创建监听套接字"""
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind(('0.0.0.0', self.proxy_port))
+        server_socket.listen(self.backlog)
+        return server_socket
         
     def start_server(self):
         """启动代理服务器"""
+        if self.engine_name == "asyncio":
+            from async_engine import AsyncioEngine
+            self.engine = AsyncioEngine([self], self.stats_interval, self.log_stats)
+            self.engine.run()
+            return
+            
         try:
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind(('0.0.0.0', self.proxy_port))
-            self.server_socket.listen(5)
+            self.server_socket = self.create_listen_socket()
             self.is_running = True
             
-            logger.info(f"简化VNC代理服务器启动在端口 {self.proxy_port}")
+            self.logger.info(f"简化VNC代理服务器启动在端口 {self.proxy_port}")
+            self.start_backend_pool()
+            self.start_websocket()
+            self.start_stats_reporter()
             
             while self.is_running:
+                # 监听端口变化时旧套接字被关闭，下一轮使用新的监听套接字
+                server_socket = self.server_socket
                 try:
-                    client_socket, client_addr = self.server_socket.accept()
-                    logger.info(f"新客户端连接: {client_addr}")
-                    
-                    # 在新线程中处理
-                    threading.Thread(
-                        target=self.handle_new_client,
-                        args=(client_socket, client_addr),
-                        daemon=True
-                    ).start()
+                    client_socket, client_addr = server_socket.accept()
+                    self.dispatch_client(client_socket, client_addr)
                     
                 except socket.error as e:
-                    if self.is_running:
-                        logger.error(f"接受连接错误: {e}")
+                    if self.is_running and server_socket is self.server_socket:
+                        self.logger.error(f"接受连接错误: {e}")
                         
         except Exception as e:
-            logger.error(f"启动服务器失败: {e}")
+            self.logger.error(f"启动服务器失败: {e}")
+            
+    def rebind(self, port):
+        """监听端口变化时重新绑定：新端口绑定成功后才关闭旧的监听套接字，已有会话不受影响"""
+        old_port = self.proxy_port
+        self.proxy_port = port
+        if self.is_running and self.server_socket is not None:
+            try:
+                server_socket = self.create_listen_socket()
+            except OSError as e:
+                self.proxy_port = old_port
+                self.logger.error(f"绑定新端口 {port} 失败，继续监听端口 {old_port}: {e}")
+                return False
+            if self.engine:
+                self.engine.replace_listener(self, server_socket)
+            elif self.acceptor:
+                self.acceptor.replace_listener(self, server_socket)
+            else:
+                old_socket, self.server_socket = self.server_socket, server_socket
+                close_listener(old_socket)
+            self.logger.info(f"监听端口已从 {old_port} 改为 {port}")
+        self.status.publish(EVENT_CONFIG, port=port)
+        return True
+        
+    def reconfigure_backend(self, settings):
+        """后端地址或连接池设置变化：之后的新会话使用新设置，当前会话的后端连接不受影响"""
+        self.vnc_host = settings['vnc_host']
+        self.vnc_port = settings['vnc_port']
+        pool = None
+        if settings['pool_size'] > 0:
+            pool = BackendPool(self.vnc_host, self.vnc_port, settings['pool_size'],
+                               settings['pool_max_idle'],
+                               settings['pool_prefetch_version'], self.logger)
+        old_pool, self.backend_pool = self.backend_pool, pool
+        if old_pool:
+            old_pool.stop()
+        if self.is_running:
+            self.start_backend_pool()
+        self.status.publish(EVENT_CONFIG, backend=f"{self.vnc_host}:{self.vnc_port}")
+        
+    def apply_settings(self, settings):
+        """应用重新加载的桌面设置，返回变化的设置项
+        
+        当前会话继续转发：后端地址和连接池用于之后的新会话，冷却期、决策超时、排队和限流立即生效，
+        空闲超时和WebSocket压缩方式立即生效，编码策略、更新节流、输入优先调度和keepalive作用于新会话，监听端口变化时才重新绑定。
+        TLS设置和续期后的证书文件用于之后的新连接，开启或关闭TLS需要重启。
+        """
+        old = self.settings
+        changed = [key for key in settings if settings[key] != old.get(key)]
+        renewed = self.tls is not None and self.tls.renewed()
+        if not changed and not renewed:
+            return []
+        
+        restart = [key for key in changed if key in RESTART_SETTINGS]
+        if ('tls_cert' in changed
+                and bool(settings['tls_cert']) != (self.tls is not None)):
+            restart.append('tls_cert')
+        if restart:
+            self.logger.warning(f"以下设置需要重启才能生效: {', '.join(restart)}")
+        # 未生效的设置保留原值，之后每次重新加载都会再次提示
+        self.settings = dict(settings,
+                             **{key: old[key] for key in restart if key in old})
+        
+        if any(key in BACKEND_SETTINGS for key in changed):
+            self.reconfigure_backend(settings)
+        self.grace_period = settings['grace_period']
+        self.admission.queue_wait = settings['queue_wait']
+        self.admission.max_queue = settings['max_queue']
+        self.admission.decision_timeout = settings['decision_timeout']
+        self.headless_decision = settings['headless_decision']
+        self.refuse_timeout = settings['refuse_timeout']
+        self.max_update_rate = settings['max_update_rate']
+        self.qos = settings['qos']
+        self.qos_bulk_rate = settings['qos_bulk_rate']
+        self.coalesce_pointer = settings['coalesce_pointer']
+        self.keepalive = settings['keepalive']
+        self.user_timeout = settings['user_timeout']
+        self.client_idle_timeout = settings['client_idle_timeout']
+        self.server_idle_timeout = settings['server_idle_timeout']
+        self.input_idle_minutes = settings['input_idle_minutes']
+        self.input_idle_action = settings['input_idle_action']
+        self.ws_deflate = settings['ws_deflate']
+        if self.is_running:
+            self.watchdog.start()
+        if 'encoding_policy' in changed:
+            self.encoding_policy = (build_encoding_policy(settings['encoding_policy'])
+                                    or EncodingPolicy())
+        if any(key in RATE_SETTINGS for key in changed):
+            self.rate_limiter.configure(*(settings[key] for key in RATE_SETTINGS))
+        if (settings['proxy_port'] != self.proxy_port
+                and not self.rebind(settings['proxy_port'])):
+            # 下次重新加载时再尝试绑定
+            self.settings['proxy_port'] = self.proxy_port
+        if self.tls and 'tls_cert' not in restart and (
+                renewed or any(key in TLS_SETTINGS for key in changed)):
+            self.reconfigure_tls(settings, old)
+            
+        applied = [key for key in changed if self.settings[key] == settings[key]]
+        if applied:
+            self.logger.info("配置已重新加载: "
+                             + ", ".join(f"{key}={settings[key]}" for key in applied))
+        return applied
+        
+    def reconfigure_tls(self, settings, old):
+        """在同一TLS上下文上重新读取证书和TLS设置，已签发的会话票据仍然有效；失败时保持原有设置"""
+        try:
+            self.tls.configure(*(settings[key] for key in TLS_SETTINGS))
+        except (OSError, ValueError) as e:
+            self.logger.error(f"重新加载TLS设置失败，继续使用原有证书: {e}")
+            # 下次重新加载时再尝试
+            for key in TLS_SETTINGS:
+                self.settings[key] = old.get(key)
+            return
+        self.logger.info(f"已重新读取TLS证书 {settings['tls_cert']}")
+        
+    def start_backend_pool(self):
+        """启动预热后端连接池"""
+        if self.backend_pool:
+            self.backend_pool.start()
+            self.logger.info(f"预热后端连接池已启动: {self.backend_pool.size} 条连接，"
+                             f"最长空闲 {self.backend_pool.max_idle} 秒")
+            
+    def start_websocket(self):
+        """启动WebSocket监听；端口绑定失败时只记录错误，TCP端口照常服务"""
+        if not self.websocket:
+            return
+        try:
+            self.websocket.start()
+        except OSError as e:
+            self.logger.error(f"WebSocket端口 {self.ws_port} 绑定失败: {e}")
+            return
+        self.logger.info(f"WebSocket监听已启动在端口 {self.ws_port}")
+        
+    def connect_backend(self):
+        """获取到VNC服务器的连接，优先取用预热连接池，返回PooledConnection"""
+        started = time.perf_counter()
+        if self.backend_pool:
+            conn = self.backend_pool.acquire()
+        else:
+            vnc_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                vnc_socket.connect((self.vnc_host, self.vnc_port))
+            except:
+                vnc_socket.close()
+                raise
+            conn = PooledConnection(vnc_socket, None, time.monotonic())
+        self.backend_connect_latency.record(time.perf_counter() - started)
+        return conn
+        
+    def accept_allowed(self, client_socket, client_addr):
+        """接受连接后的第一道检查：超出速率限制的连接直接关闭，不启动线程也不握手"""
+        limited = self.rate_limiter.check(client_addr[0])
+        if limited is None:
+            self.counters['accepted'] += 1
+            return True
+        # 同一IP的限流日志每分钟只输出一次
+        scope = "IP" if limited == "ip" else "子网"
+        self.logger.warning(f"客户端 {client_addr} 超出{scope}连接速率限制，丢弃连接",
+                            extra=dedup('rate_limited', client_addr[0]))
+        try:
+            client_socket.close()
+        except OSError:
+            pass
+        return False
+        
+    def dispatch_client(self, client_socket, client_addr):
+        """在新线程中处理已接受的客户端连接"""
+        if not self.accept_allowed(client_socket, client_addr):
+            return
+        self.logger.info(f"新客户端连接: {client_addr}",
+                         extra=dedup('connect', client_addr[0]))
+        if self.tls:
+            # 拒绝消息也要经过TLS发送，冷却期检查在握手之后
+            threading.Thread(
+                target=self.handle_tls_client,
+                args=(client_socket, client_addr),
+                daemon=True
+            ).start()
+            return
+        if self.refuse_in_grace_period(client_socket, client_addr):
+            return
+        threading.Thread(
+            target=self.handle_new_client,
+            args=(client_socket, client_addr),
+            daemon=True
+        ).start()
+            
+    def dispatch_websocket(self, client_socket, client_addr):
+        """在新线程中完成WebSocket握手（由WebSocket监听线程调用）"""
+        if not self.accept_allowed(client_socket, client_addr):
+            return
+        self.logger.info(f"新WebSocket客户端连接: {client_addr}",
+                         extra=dedup('connect', client_addr[0]))
+        threading.Thread(
+            target=self.handle_websocket_client,
+            args=(client_socket, client_addr),
+            daemon=True
+        ).start()
+        
+    def tls_handshake(self, client_socket, client_addr):
+        """完成服务端TLS握手，返回ssl.SSLSocket；失败时连接已关闭，返回None"""
+        from proxy_tls import HANDSHAKE_TIMEOUT, describe
+        
+        started = time.perf_counter()
+        try:
+            client_socket.settimeout(HANDSHAKE_TIMEOUT)
+            tls_socket = self.tls.handshake(client_socket)
+            tls_socket.settimeout(None)
+        except OSError as e:
+            self.logger.info(f"客户端 {client_addr} TLS握手失败: {e}",
+                             extra=dedup('tls_failed', client_addr[0]))
+            return None
+        self.logger.info(f"客户端 {client_addr} 完成TLS握手（{describe(tls_socket)}），"
+                         f"用时 {(time.perf_counter() - started) * 1000:.1f}ms")
+        return tls_socket
+        
+    def handle_tls_client(self, client_socket, client_addr):
+        """TLS握手完成后与明文客户端走同样的单用户、决策和冷却期流程"""
+        tls_socket = self.tls_handshake(client_socket, client_addr)
+        if tls_socket is not None:
+            self.handle_new_client(tls_socket, client_addr)
             
+    def handle_websocket_client(self, client_socket, client_addr):
+        """握手完成后WebSocket连接与TCP客户端走同样的单用户、决策和冷却期流程"""
+        if self.tls:
+            # wss：先完成TLS握手，WebSocket握手和之后的帧都经过TLS
+            client_socket = self.tls_handshake(client_socket, client_addr)
+            if client_socket is None:
+                return
+        deflate = websocket_listener.deflate_wanted(self.ws_deflate, client_addr[0])
+        try:
+            client_socket.settimeout(websocket_listener.HANDSHAKE_TIMEOUT)
+            ws_socket = websocket_listener.handshake(client_socket, deflate)
+            client_socket.settimeout(None)
+        except OSError as e:
+            self.counters['websocket_failed'] += 1
+            self.logger.info(f"客户端 {client_addr} WebSocket握手失败: {e}",
+                             extra=dedup('websocket_failed', client_addr[0]))
+            try:
+                client_socket.close()
+            except OSError:
+                pass
+            return
+        self.counters['websocket'] += 1
+        extension = "，启用permessage-deflate" if ws_socket.codec.deflate else ""
+        self.logger.info(f"客户端 {client_addr} 完成WebSocket握手{extension}")
+        self.handle_new_client(ws_socket, client_addr)
+        
+    def refuse_in_grace_period(self, client_socket, client_addr):
+        """冷却期内的客户端直接交给拒绝引擎，返回是否已拒绝；共享观看的观察者不受冷却期限制"""
+        session = self.active_session
+        if session and session.shared and self.shared_view:
+            return False
+        if not self.is_in_grace_period(client_addr[0]):
+            return False
+        self.logger.info(f"客户端 {client_addr} 在冷却期内，拒绝连接",
+                         extra=dedup('cooldown', client_addr[0]))
+        self.send_refuse_and_close(client_socket, "服务器正被其他用户使用，请稍后再试。")
+        return True
+        
     def handle_new_client(self, client_socket, client_addr):
         """处理新客户端连接"""
         client_ip = client_addr[0]
         
         try:
-            # 检查冷却期
-            if self.is_in_grace_period(client_ip):
-                logger.info(f"客户端 {client_addr} 在冷却期内，拒绝连接")
-                self.send_refuse_and_close(client_socket, "服务器正被其他用户使用，请稍后再试。")
+            # 共享观看模式下已有会话时，新客户端作为观察者加入
+            session = self.active_session
+            if session and session.shared and self.shared_view:
+                session.shared.join(client_socket, client_addr)
                 return
                 
-            # 如果没有活跃会话，直接连接
-            if self.active_session is None:
-                self.create_new_session(client_socket, client_addr)
+            # 检查冷却期
+            if self.refuse_in_grace_period(client_socket, client_addr):
                 return
                 
-            # 有活跃会话，需要用户决策
-            logger.info(f"有活跃会话，新客户端 {client_addr} 等待决策")
-            decision = self.get_user_decision(client_addr)
-            
-            if decision == "allow_new":
-                # 断开旧会话
-                self.disconnect_current_session()
-                # 创建新会话
-                self.create_new_session(client_socket, client_addr)
-            else:
-                # 拒绝新连接，并将新用户IP加入冷却列表
-                self.rejected_ips[client_ip] = time.time()
-                logger.info(f"新用户 {client_addr} 被拒绝，加入1分钟冷却列表")
+            # 没有活跃会话时直接接入，否则排队等待决策或当前会话结束
+            request = self.admission.submit(client_socket, client_addr)
+            if request is None:
+                self.logger.info(f"等待队列已满，拒绝客户端 {client_addr}",
+                                 extra=dedup('queue_full', client_ip))
                 self.send_refuse_and_close(client_socket, "服务器正被其他用户使用，请稍后再试。")
+                return
+                
+            try:
+                decision = request.future.result()
+                if (decision == ALLOW_NEW
+                        and self.take_over_backend(client_socket, client_addr)):
+                    return
+                if decision == ALLOW_NEW:
+                    # 断开旧会话
+                    self.disconnect_current_session()
+                if decision in (ALLOW_NEW, ADMIT):
+                    # 创建新会话
+                    self.create_new_session(client_socket, client_addr)
+                    return
+            finally:
+                self.admission.release(request)
+                
+            # 拒绝新连接，并将新用户IP加入冷却列表
+            self.rejected_ips[client_ip] = time.time()
+            self.logger.info(f"新用户 {client_addr} 被拒绝，加入1分钟冷却列表")
+            self.send_refuse_and_close(client_socket, "服务器正被其他用户使用，请稍后再试。")
                 
         except Exception as e:
-            logger.error(f"处理客户端 {client_addr} 时出错: {e}")
+            self.logger.error(f"处理客户端 {client_addr} 时出错: {e}")
             try:
                 client_socket.close()
             except:
@@ -126,204 +597,341 @@ class SimpleVNCProxy:
                 
     def create_new_session(self, client_socket, client_addr):
         """创建新的VNC会话"""
+        if self.shared_view or self.keep_backend:
+            self.create_shared_session(client_socket, client_addr)
+            return
+            
         try:
             # 连接到VNC服务器
-            vnc_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            vnc_socket.connect((self.vnc_host, self.vnc_port))
+            conn = self.connect_backend()
+            vnc_socket = conn.sock
+            
+            # 预热连接已读取服务器版本串，先转交给客户端
+            if conn.greeting:
+                try:
+                    client_socket.sendall(conn.greeting)
+                except:
+                    vnc_socket.close()
+                    raise
             
             # 创建会话对象
-            session = {
-                'client_socket': client_socket,
-                'vnc_socket': vnc_socket,
-                'client_addr': client_addr,
-                'start_time': datetime.now(),
-                'active': True
-            }
+            session = self.new_session(client_socket, vnc_socket, client_addr)
             
             self.active_session = session
-            logger.info(f"为客户端 {client_addr} 创建新VNC会话")
+            self.logger.for_session(session).info(f"为客户端 {client_addr} 创建新VNC会话")
             
             # 启动数据转发
             self.start_forwarding(session)
             
         except Exception as e:
-            logger.error(f"创建VNC会话失败: {e}")
+            self.logger.error(f"创建VNC会话失败: {e}")
+            self.send_refuse_and_close(client_socket, "无法连接到VNC服务器，请稍后再试。")
+            
+    def create_shared_session(self, client_socket, client_addr):
+        """创建由代理终结握手的共享会话，客户端成为会话所有者"""
+        from shared_view import SharedBackend
+        
+        vnc_socket = None
+        try:
+            conn = self.connect_backend()
+            vnc_socket = conn.sock
+            backend = SharedBackend(self, vnc_socket)
+            backend.connect(conn.greeting)
+        except Exception as e:
+            self.logger.error(f"创建共享会话失败: {e}")
+            if vnc_socket:
+                vnc_socket.close()
             self.send_refuse_and_close(client_socket, "无法连接到VNC服务器，请稍后再试。")
+            return
             
+        # 先占用会话，所有者握手期间到达的客户端直接作为观察者加入
+        session = self.new_session(client_socket, vnc_socket, client_addr)
+        session.shared = backend
+        session.upstream.inputs = 0
+        backend.session = session
+        self.active_session = session
+        
+        try:
+            owner = backend.handshake_viewer(client_socket, client_addr, observer=False)
+        except Exception as e:
+            self.logger.info(f"客户端 {client_addr} 握手失败: {e}")
+            self.cleanup_session(session)
+            return
+            
+        self.logger.for_session(session).info(f"为客户端 {client_addr} 创建共享VNC会话")
+        backend.start(owner)
+        
+    def new_session(self, client_socket, vnc_socket, client_addr):
+        """创建会话对象，按设置开启两端连接的keepalive和用户超时"""
+        self.counters['sessions'] += 1
+        session = Session(client_socket, vnc_socket, client_addr)
+        if self.keepalive > 0 or self.user_timeout > 0:
+            for sock in (client_socket, vnc_socket):
+                error = liveness.configure_socket(sock, self.keepalive,
+                                                  self.user_timeout)
+                if error:
+                    self.logger.for_session(session).warning(
+                        f"设置TCP keepalive/用户超时失败: {error}",
+                        extra=dedup('keepalive', self.name))
+        return session
+        
     def start_forwarding(self, session):
         """启动数据转发"""
-        def forward_data(src, dst, direction):
+        path = relay.choose_path(self.relay_path,
+                                 session.client_socket, session.vnc_socket)
+        recording = self.start_recording(session)
+        if recording:
+            # 录制需要在Python中取得转发的数据
+            path = relay.PATH_BUFFER
+        session.relay_path = path
+        log = self.logger.for_session(session)
+        stream_filter = self.create_client_filter(session)
+        if stream_filter:
+            self.relay_path_counts[relay.PATH_FILTER] += 1
+            self.relay_path_counts[path] += 1
+            log.info(f"会话 {session.client_addr} 使用转发路径: {path}（客户端方向经过编码策略过滤）")
+        else:
+            self.relay_path_counts[path] += 2
+            log.info(f"会话 {session.client_addr} 使用转发路径: {path}")
+        
+        def forward_data(src, dst, stats, direction, stream_filter=None, tap=None):
             try:
-                while session['active']:
-                    data = src.recv(4096)
-                    if not data:
-                        logger.info(f"数据转发结束: {direction}")
-                        break
-                    dst.send(data)
+                if stream_filter:
+                    relay.pump_filtered(src, dst, session, stats, self.relay_latency,
+                                        stream_filter, path, tap)
+                else:
+                    relay.pump(path, src, dst, session, stats, self.relay_latency, tap)
+                log.info(f"数据转发结束: {direction}")
             except Exception as e:
-                logger.info(f"数据转发异常: {direction} - {e}")
+                if liveness.is_peer_timeout(e):
+                    self.note_peer_timeout(session, direction, e)
+                else:
+                    log.info(f"数据转发异常: {direction} - {e}")
             finally:
                 # 只有当前会话结束时才清理
-                if session == self.active_session:
-                    self.cleanup_session()
+                self.cleanup_session(session)
                     
         # 启动双向转发
         threading.Thread(
             target=forward_data,
-            args=(session['client_socket'], session['vnc_socket'], "客户端->VNC"),
+            args=(session.client_socket, session.vnc_socket, session.upstream,
+                  "客户端->VNC", stream_filter, recording.c2s if recording else None),
             daemon=True
         ).start()
         
         threading.Thread(
             target=forward_data,
-            args=(session['vnc_socket'], session['client_socket'], "VNC->客户端"),
+            args=(session.vnc_socket, session.client_socket, session.downstream,
+                  "VNC->客户端", None, recording.s2c if recording else None),
             daemon=True
         ).start()
         
+    def start_recording(self, session):
+        """启用录制时为会话创建录制文件，返回SessionRecording或None"""
+        if not self.recorder:
+            return None
+        try:
+            session.recording = self.recorder.open(session, self.name)
+        except Exception as e:
+            self.logger.for_session(session).error(
+                f"无法录制会话 {session.client_addr}: {e}")
+            return None
+        self.logger.for_session(session).info(
+            f"录制会话 {session.client_addr} 到 {session.recording.path}")
+        return session.recording
+        
+    def create_client_filter(self, session):
+        """配置了编码策略、更新速率限制、输入优先调度、指针合并或输入空闲检查时，为会话创建客户端数据流过滤器"""
+        if (not self.encoding_policy.enabled and self.max_update_rate <= 0
+                and not self.qos and not self.coalesce_pointer
+                and self.input_idle_minutes <= 0):
+            return None
+        addr = session.client_addr
+        log = self.logger.for_session(session)
+        rule = self.encoding_policy.rule_for(addr[0])
+        if self.max_update_rate > 0:
+            session.throttle = rfb.UpdateThrottle(self.max_update_rate)
+        if self.coalesce_pointer:
+            session.coalescer = PointerCoalescer()
+            relay.limit_unsent(session.vnc_socket)
+        if self.qos:
+            session.qos = InputQoS(self.qos_bulk_rate * 1024, self.input_latency,
+                                   coalescer=session.coalescer)
+        # 过滤器累加键盘/指针事件数，供输入空闲检查使用
+        session.upstream.inputs = 0
+        
+        def on_passthrough(reason):
+            session.upstream.inputs = None
+            log.warning(f"无法解析客户端 {addr} 的数据流（{reason}），"
+                        f"编码策略、更新节流、输入优先调度、指针合并和输入空闲检查不生效，改为透传")
+            
+        return ClientStreamFilter(build_rewriter(rule, log, addr, session),
+                                  on_passthrough, session.throttle, qos=session.qos,
+                                  coalescer=session.coalescer, stats=session.upstream)
+        
     def disconnect_current_session(self):
         """断开当前会话"""
         if self.active_session:
             session = self.active_session
-            client_ip = session['client_addr'][0]
+            client_ip = session.client_addr[0]
             
             # 添加到冷却列表
             self.rejected_ips[client_ip] = time.time()
             
-            logger.info(f"断开当前会话: {session['client_addr']}")
+            self.logger.for_session(session).info(f"断开当前会话: {session.client_addr}")
+            self.counters['takeovers'] += 1
             
-            # 标记为非活跃
-            session['active'] = False
-            
-            # 关闭连接
-            try:
-                session['client_socket'].close()
-                session['vnc_socket'].close()
-            except:
-                pass
+            # 标记为非活跃并关闭连接
+            self.close_session(session)
                 
             self.active_session = None
             
-    def cleanup_session(self):
-        """清理会话"""
-        if self.active_session:
-            logger.info(f"清理会话: {self.active_session['client_addr']}")
-            self.active_session['active'] = False
+    def take_over_backend(self, client_socket, client_addr):
+        """保留后端接管：新客户端与缓存的ServerInit握手后替换当前会话的客户端
+        
+        不适用（未启用或当前没有由代理终结握手的会话）时返回False，由调用方按重新连接处理。
+        """
+        session = self.active_session
+        if not (self.keep_backend and session and session.shared
+                and session.shared.active):
+            return False
+        backend = session.shared
+        started = time.perf_counter()
+        # 握手期间旧客户端照常使用会话，握手成功后才替换
+        try:
+            viewer = backend.handshake_viewer(client_socket, client_addr,
+                                              observer=False)
+        except Exception as e:
+            self.logger.info(f"客户端 {client_addr} 接管握手失败: {e}")
             try:
-                self.active_session['client_socket'].close()
-                self.active_session['vnc_socket'].close()
-            except:
+                client_socket.close()
+            except OSError:
                 pass
-            self.active_session = None
+            return True
             
-    def get_user_decision(self, new_client_addr):
-        """获取用户决策"""
-        if not self.root:
-            # 无GUI模式，默认拒绝
-            return "keep_current"
+        new_session = self.new_session(client_socket, session.vnc_socket, client_addr)
+        new_session.shared = backend
+        new_session.upstream.inputs = 0
+        with self.session_lock:
+            replaced = self.active_session is session
+            if replaced:
+                self.active_session = new_session
+        if not replaced or not backend.replace_owner(viewer, new_session):
+            # 握手期间会话已经结束，客户端已看到ServerInit，只能断开
+            self.logger.info(f"客户端 {client_addr} 接管时会话已结束")
+            viewer.close()
+            if replaced:
+                self.cleanup_session(new_session)
+            return True
             
-        # GUI模式，显示决策对话框
-        self.user_decision = None
-        self.root.after(0, lambda: self.show_decision_dialog(new_client_addr))
-        
-        # 等待用户决策，最多5秒
-        start_time = time.time()
-        while self.user_decision is None and (time.time() - start_time) < 5:
-            time.sleep(0.1)
+        # 旧会话计入累计统计，旧客户端进入冷却列表
+        self.rejected_ips[session.client_addr[0]] = time.time()
+        self.counters['takeovers'] += 1
+        session.active = False
+        self.account_session(session)
+        self.logger.for_session(new_session).info(
+            f"客户端 {client_addr} 接管会话，保留后端连接，"
+            f"用时 {(time.perf_counter() - started) * 1000:.1f}ms")
+        return True
+        
+    def reclaim_session(self, session, reason, idle):
+        """回收空闲会话（由空闲检查线程调用）
+        
+        输入空闲且处理方式为handover时，只在有客户端等待时结束会话，否则标记为空闲，
+        之后到达的客户端无需决策直接接管。
+        """
+        log = self.logger.for_session(session)
+        if (reason == liveness.REASON_INPUT_IDLE
+                and self.input_idle_action == liveness.IDLE_HANDOVER
+                and not self.admission.queue):
+            if not session.idle:
+                session.idle = True
+                log.info(f"会话 {session.client_addr} {liveness.describe(reason, idle)}，"
+                         f"新客户端到达时直接接管")
+            return
+        self.reclaimed[reason] += 1
+        log.warning(f"回收会话 {session.client_addr}: {liveness.describe(reason, idle)}")
+        self.cleanup_session(session)
+        
+    def idle_handover(self, client_addr):
+        """当前会话已标记为输入空闲时，新客户端无需决策直接接管（由接入调度器调用）"""
+        session = self.active_session
+        if session is None or not session.idle:
+            return False
+        self.reclaimed[liveness.REASON_INPUT_IDLE] += 1
+        self.logger.for_session(session).warning(
+            f"回收会话 {session.client_addr}: 长时间没有键盘/鼠标输入，交给新客户端 {client_addr}")
+        return True
+        
+    def note_peer_timeout(self, session, direction, error):
+        """转发因keepalive探测或用户超时失败而结束，会话随后被清理"""
+        if not session.active:
+            return
+        self.reclaimed[liveness.REASON_PEER_TIMEOUT] += 1
+        self.logger.for_session(session).warning(
+            f"回收会话 {session.client_addr}: {direction} 对端无响应（{error}）")
+        
+    def cleanup_session(self, session=None):
+        """清理会话；指定session时只在它仍是当前会话时清理"""
+        with self.session_lock:
+            current = self.active_session
+            if current is None or (session is not None and session is not current):
+                return
+            self.active_session = None
+        self.logger.for_session(current).info(f"清理会话: {current.client_addr}")
+        self.close_session(current)
+        # 排队的客户端可以接入
+        self.admission.on_session_end()
             
-        if self.user_decision is None:
-            # 超时，默认允许新用户
-            return "allow_new"
+    def close_session(self, session):
+        """标记会话为非活跃并关闭两端连接"""
+        if session.active:
+            session.active = False
+            self.account_session(session)
+        if session.shared:
+            # 共享会话由自己的线程管理，同时断开所有观察者
+            session.shared.close()
+            return
+        if self.engine and session.tasks:
+            # asyncio引擎需要先在事件循环中取消转发任务（WebSocket客户端的会话由线程转发）
+            self.engine.close_session(session)
+            return
+        for key in ('client_socket', 'vnc_socket'):
+            sock = getattr(session, key)
+            try:
+                # 先shutdown唤醒阻塞在recv/splice中的转发线程
+                sock.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
+            try:
+                sock.close()
+            except:
+                pass
             
-        return self.user_decision
+    def account_session(self, session):
+        """把结束的会话计入累计流量"""
+        self.traffic_totals[UPSTREAM].add(session.upstream)
+        self.traffic_totals[DOWNSTREAM].add(session.downstream)
+        self.session_seconds_total += session.duration()
+        self.counters['updates_suppressed'] += session.updates_suppressed()
+        if session.throttle is not None:
+            self.counters['updates_delayed'] += session.throttle.delayed
+        self.counters['pointer_coalesced'] += session.pointer_coalesced()
+        if session.recording is not None:
+            session.recording.close()
         
-    def show_decision_dialog(self, new_client_addr):
-        """显示决策对话框"""
+    def show_decision_dialog(self, new_client_addr, waiting=0):
+        """显示决策对话框（由接入调度器在Tk线程中调用）"""
         if self.decision_dialog:
             return
-            
-        self.decision_dialog = tk.Toplevel(self.root)
-        self.decision_dialog.title("新连接请求")
-        self.decision_dialog.geometry("500x300")
-        self.decision_dialog.resizable(False, False)
-        self.decision_dialog.attributes('-topmost', True)
-        self.decision_dialog.focus_force()
-        
-        # 主容器
-        main_container = tk.Frame(self.decision_dialog)
-        main_container.pack(fill=tk.BOTH, expand=True, padx=30, pady=30)
-        
-        # 消息标签
-        msg = f"新客户端 {new_client_addr} 请求连接\n\n您要断开当前连接让新用户使用吗？"
-        msg_label = tk.Label(main_container, text=msg, font=('Arial', 14),
-                           wraplength=400, justify='center')
-        msg_label.pack(pady=(0, 20))
-        
-        # 倒计时标签
-        self.countdown_var = tk.StringVar()
-        countdown_label = tk.Label(main_container, textvariable=self.countdown_var,
-                                 font=('Arial', 16, 'bold'), fg='red')
-        countdown_label.pack(pady=(0, 30))
-        
-        # 按钮容器
-        button_container = tk.Frame(main_container)
-        button_container.pack(pady=20)
-        
-        # 按钮样式
-        btn_style = {
-            'font': ('Arial', 12, 'bold'),
-            'width': 18,
-            'height': 3,
-            'relief': 'raised',
-            'bd': 3
-        }
+        from vnc_proxy_gui import DecisionDialog
         
-        # 继续使用按钮
-        continue_btn = tk.Button(
-            button_container,
-            text="我还要继续使用",
-            bg='#2E8B57', fg='white',
-            activebackground='#228B22',
-            command=lambda: self.make_decision("keep_current"),
-            **btn_style
-        )
-        continue_btn.pack(side=tk.LEFT, padx=20)
-        
-        # 让新用户连接按钮
-        new_user_btn = tk.Button(
-            button_container,
-            text="让新用户连接",
-            bg='#DC143C', fg='white',
-            activebackground='#B22222',
-            command=lambda: self.make_decision("allow_new"),
-            **btn_style
-        )
-        new_user_btn.pack(side=tk.LEFT, padx=20)
-        
-        # 启动倒计时
-        self.start_decision_countdown()
-        
-    def start_decision_countdown(self):
-        """启动决策倒计时"""
-        self.countdown_seconds = 5
-        self.update_decision_countdown()
-        
-    def update_decision_countdown(self):
-        """更新决策倒计时"""
-        if self.countdown_seconds > 0:
-            self.countdown_var.set(f"倒计时: {self.countdown_seconds} 秒")
-            self.countdown_seconds -= 1
-            if self.root:
-                self.root.after(1000, self.update_decision_countdown)
-        else:
-            self.countdown_var.set("时间到！自动让新用户连接")
-            if self.root:
-                self.root.after(1000, lambda: self.make_decision("allow_new"))
-            
-    def make_decision(self, decision):
-        """做出决策"""
-        self.user_decision = decision
+        self.decision_dialog = DecisionDialog(self, new_client_addr, waiting)
+        
+    def close_decision_dialog(self):
+        """关闭决策对话框"""
         if self.decision_dialog:
-            self.decision_dialog.destroy()
+            self.decision_dialog.close()
             self.decision_dialog = None
             
     def is_in_grace_period(self, client_ip):
@@ -332,206 +940,437 @@ class SimpleVNCProxy:
         if self.active_session is None:
             return False
             
-        if client_ip not in self.rejected_ips:
-            return False
-            
-        reject_time = self.rejected_ips[client_ip]
-        if time.time() - reject_time > self.grace_period:
-            del self.rejected_ips[client_ip]
-            return False
-            
-        return True
+        # 过期的条目由TTLTable自动清理
+        return client_ip in self.rejected_ips
         
     def send_refuse_and_close(self, client_socket, message):
-        """发送拒绝消息并关闭连接"""
-        try:
-            # 按照RFB协议3.3/3.7/3.8规范发送连接失败消息
-            
-            # 1. 发送RFB协议版本
-            rfb_version = b"RFB 003.008\n"
-            client_socket.send(rfb_version)
-            
-            # 2. 等待客户端发送版本回复
-            try:
-                client_version = client_socket.recv(12)
-                logger.info(f"客户端版本: {client_version}")
-            except:
-                pass
-            
-            # 3. 发送安全类型数量 (0 = 连接失败)
-            security_types = b"\x00"  # 0个安全类型表示连接失败
-            client_socket.send(security_types)
-            
-            # 4. 发送失败原因长度和内容
-            reason = "服务器正被其他用户使用，请稍后再试。"
-            reason_bytes = reason.encode('utf-8')  # 使用UTF-8编码中文
-            reason_length = len(reason_bytes).to_bytes(4, byteorder='big')
-            
-            client_socket.send(reason_length)
-            client_socket.send(reason_bytes)
-            
-            logger.info(f"已发送RFB拒绝消息: {reason}")
-            
-            # 延迟关闭，确保消息发送完成
-            time.sleep(0.3)
+        """发送RFB拒绝消息并关闭连接：交给共用的拒绝引擎，不阻塞当前线程"""
+        self.counters['refused'] += 1
+        timeout = self.refuse_timeout
+        
+        def on_done(result, version):
+            refusal.log_result(self.logger, message, result, version, timeout)
             
+        try:
+            refusal.get_engine().submit(client_socket, message, timeout, on_done)
         except Exception as e:
-            logger.error(f"发送拒绝消息失败: {e}")
-        finally:
+            self.logger.error(f"发送拒绝消息失败: {e}")
             try:
                 client_socket.close()
-            except:
+            except OSError:
                 pass
-
-    def create_tray_icon(self):
-        """创建系统托盘图标"""
-        # 创建简单的图标
-        image = Image.new('RGB', (64, 64), color='blue')
-        draw = ImageDraw.Draw(image)
-        draw.rectangle([16, 16, 48, 48], fill='white')
-        draw.text((20, 25), "VNC", fill='blue')
-        
-        # 创建托盘菜单
-        menu = pystray.Menu(
-            pystray.MenuItem("显示窗口", self.show_window),
-            pystray.MenuItem("隐藏窗口", self.hide_window),
-            pystray.Menu.SEPARATOR,
-            pystray.MenuItem("启动服务器", self.start_server_tray, enabled=lambda item: not self.is_running),
-            pystray.MenuItem("停止服务器", self.stop_server_tray, enabled=lambda item: self.is_running),
-            pystray.Menu.SEPARATOR,
-            pystray.MenuItem("退出", self.quit_application)
-        )
-        
-        self.tray_icon = pystray.Icon("VNC代理", image, "VNC代理服务器", menu)
-        
-    def show_window(self, icon=None, item=None):
-        """显示主窗口"""
-        if self.root:
-            self.root.deiconify()
-            self.root.lift()
-            self.root.attributes('-topmost', True)
-            self.root.after(100, lambda: self.root.attributes('-topmost', False))
-            
-    def hide_window(self, icon=None, item=None):
-        """隐藏主窗口到系统托盘"""
-        if self.root:
-            self.root.withdraw()
-            
-    def start_server_tray(self, icon=None, item=None):
-        """从系统托盘启动服务器"""
-        if not self.is_running:
-            threading.Thread(target=self.start_server, daemon=True).start()
-            
-    def stop_server_tray(self, icon=None, item=None):
-        """从系统托盘停止服务器"""
-        self.stop_server()
-        
-    def quit_application(self, icon=None, item=None):
-        """退出应用程序"""
-        self.stop_server()
-        if self.tray_icon:
-            self.tray_icon.stop()
-        if self.root:
-            self.root.quit()
-        sys.exit(0)
-        
-    def on_window_close(self):
-        """窗口关闭事件处理"""
-        # 最小化到系统托盘而不是退出
-        self.hide_window()
-
-    def start_gui(self):
-        """启动GUI"""
-        self.root = tk.Tk()
-        self.root.title("简化VNC代理服务器")
-        self.root.geometry("400x300")
-        
-        # 设置窗口关闭事件
-        self.root.protocol("WM_DELETE_WINDOW", self.on_window_close)
-        
-        # 主框架
-        frame = tk.Frame(self.root, padx=20, pady=20)
-        frame.pack(fill=tk.BOTH, expand=True)
-        
-        # 标题
-        tk.Label(frame, text="简化VNC代理服务器", 
-                font=('微软雅黑', 16, 'bold')).pack(pady=10)
-        
-        # 状态
-        self.status_var = tk.StringVar(value="服务器未启动")
-        tk.Label(frame, textvariable=self.status_var, 
-                font=('微软雅黑', 12)).pack(pady=10)
-        
-        # 连接信息
-        self.conn_var = tk.StringVar(value="无客户端连接")
-        tk.Label(frame, textvariable=self.conn_var,
-                font=('微软雅黑', 10)).pack(pady=5)
-        
-        # 按钮
-        btn_frame = tk.Frame(frame)
-        btn_frame.pack(pady=20)
-        
-        self.start_btn = tk.Button(btn_frame, text="启动服务器",
-                                  command=self.start_server_gui)
-        self.start_btn.pack(side=tk.LEFT, padx=5)
-        
-        self.stop_btn = tk.Button(btn_frame, text="停止服务器",
-                                 command=self.stop_server, state=tk.DISABLED)
-        self.stop_btn.pack(side=tk.LEFT, padx=5)
+                
+    def get_stats(self):
+        """获取运行统计：线程数与转发延迟分位数"""
+        latency = self.relay_latency.snapshot()
+        connect = self.backend_connect_latency.snapshot()
+        stats = {
+            'engine': self.engine_name,
+            'threads': threading.active_count(),
+            'relay_path': self.relay_path,
+            'relay_path_counts': dict(self.relay_path_counts),
+            'relay_samples': latency['count'],
+            'relay_latency_p50_ms': latency['p50_ms'],
+            'relay_latency_p99_ms': latency['p99_ms'],
+            'backend_connect_p50_ms': connect['p50_ms'],
+            'backend_connect_p99_ms': connect['p99_ms'],
+        }
+        if self.qos:
+            forward = self.input_latency.snapshot()
+            stats['input_forward_samples'] = forward['count']
+            stats['input_forward_p50_ms'] = forward['p50_ms']
+            stats['input_forward_p99_ms'] = forward['p99_ms']
+        if self.backend_pool:
+            stats['backend_pool'] = self.backend_pool.get_stats()
+        if self.tls:
+            stats['tls'] = self.tls.get_stats()
+        stats['admission'] = self.admission.get_stats()
+        stats['rate_limit'] = self.rate_limiter.get_stats()
+        stats['rejected_ips'] = len(self.rejected_ips)
+        if self.recorder:
+            stats['recorder'] = self.recorder.get_stats()
+        refusal_stats = refusal.get_stats()
+        if refusal_stats:
+            stats['refusal'] = refusal_stats
+        log_stats = proxy_logging.get_stats()
+        if log_stats:
+            stats['logging'] = log_stats
+        stats['counters'] = dict(self.counters)
+        stats['reclaimed'] = dict(self.reclaimed)
+        stats['traffic'] = {direction: self.traffic_total(direction).snapshot()
+                            for direction in (UPSTREAM, DOWNSTREAM)}
+        session = self.active_session
+        stats['session'] = session.snapshot() if session else None
+        shared = session.shared if session else None
+        if shared and shared.cache:
+            stats['fb_cache_bytes'] = shared.cache.memory_bytes()
+            stats['fb_cache_valid'] = shared.cache.valid
+            stats['fb_cache_hits'] = shared.cache_hits
+        return stats
         
-        # 托盘按钮
-        self.tray_btn = tk.Button(btn_frame, text="最小化到托盘",
-                                 command=self.hide_window)
-        self.tray_btn.pack(side=tk.LEFT, padx=5)
+    def traffic_bytes(self):
+        """(上行, 下行) 累计字节，供状态总线采样吞吐量"""
+        return self.traffic_total(UPSTREAM).bytes, self.traffic_total(DOWNSTREAM).bytes
         
-        # 创建系统托盘图标
-        self.create_tray_icon()
+    def traffic_total(self, direction):
+        """某方向的累计流量（已结束会话加当前会话）"""
+        total = DirectionStats()
+        total.add(self.traffic_totals[direction])
+        session = self.active_session
+        if session and session.active:
+            total.add(getattr(session, direction))
+        return total
         
-        # 在单独线程中运行托盘图标
-        threading.Thread(target=self.tray_icon.run, daemon=True).start()
+    def metric_samples(self):
+        """指标端点的样本：(名称, 类型, 说明, 标签, 值)"""
+        desktop = {'desktop': self.name or str(self.proxy_port)}
+        rate_limit = self.rate_limiter
+        session = self.active_session
+        duration = session.duration() if session else 0.0
+        samples = [
+            ('vnc_proxy_connections_accepted_total', 'counter', '通过速率限制的连接数',
+             desktop, self.counters['accepted']),
+            ('vnc_proxy_connections_rate_limited_total', 'counter', '因速率限制被丢弃的连接数',
+             desktop, rate_limit.limited_ip + rate_limit.limited_subnet),
+            ('vnc_proxy_connections_refused_total', 'counter', '发送RFB拒绝消息的连接数',
+             desktop, self.counters['refused']),
+            ('vnc_proxy_websocket_connections_total', 'counter', '完成WebSocket握手的连接数',
+             desktop, self.counters['websocket']),
+            ('vnc_proxy_websocket_handshake_failures_total', 'counter',
+             'WebSocket握手失败的连接数',
+             desktop, self.counters['websocket_failed']),
+            ('vnc_proxy_takeovers_total', 'counter', '新客户端接管并断开旧会话的次数',
+             desktop, self.counters['takeovers']),
+            ('vnc_proxy_sessions_total', 'counter', '建立的会话数',
+             desktop, self.counters['sessions']),
+            ('vnc_proxy_session_active', 'gauge', '是否有活跃会话',
+             desktop, 1 if session else 0),
+            ('vnc_proxy_session_duration_seconds', 'gauge', '当前会话已持续的秒数',
+             desktop, round(duration, 3)),
+            ('vnc_proxy_session_seconds_total', 'counter', '所有会话的累计时长',
+             desktop, round(self.session_seconds_total + duration, 3)),
+            ('vnc_proxy_admission_queue_depth', 'gauge', '等待接入的客户端数',
+             desktop, len(self.admission.queue)),
+            ('vnc_proxy_update_requests_suppressed_total', 'counter', '被节流或合并的更新请求数',
+             desktop, self.counters['updates_suppressed']
+             + (session.updates_suppressed() if session and session.active else 0)),
+            ('vnc_proxy_update_requests_delayed_total', 'counter', '因速率限制被推迟的更新请求数',
+             desktop, self.counters['updates_delayed']
+             + (session.throttle.delayed
+                if session and session.active and session.throttle else 0)),
+            ('vnc_proxy_pointer_events_coalesced_total', 'counter',
+             '服务器方向拥塞时被合并的指针移动事件数',
+             desktop, self.counters['pointer_coalesced']
+             + (session.pointer_coalesced() if session and session.active else 0)),
+        ]
+        if self.tls:
+            from proxy_tls import HANDSHAKE_FULL, HANDSHAKE_RESUMED
+            
+            for kind in (HANDSHAKE_FULL, HANDSHAKE_RESUMED):
+                labels = dict(desktop, resumed=str(kind == HANDSHAKE_RESUMED).lower())
+                samples.append(('vnc_proxy_tls_handshakes_total', 'counter',
+                                '完成的TLS握手数（resumed为会话恢复）',
+                                labels, self.tls.handshakes[kind]))
+                for quantile in (50, 99):
+                    seconds = self.tls.latency[kind].percentile(quantile)
+                    samples.append(('vnc_proxy_tls_handshake_seconds', 'gauge',
+                                    'TLS握手耗时的分位数',
+                                    dict(labels, quantile=str(quantile / 100)),
+                                    round(seconds, 6) if seconds is not None else None))
+            samples.append(('vnc_proxy_tls_handshake_failures_total', 'counter',
+                            'TLS握手失败的连接数',
+                            desktop, self.tls.failures))
+        for reason, count in self.reclaimed.items():
+            samples.append(('vnc_proxy_sessions_reclaimed_total', 'counter',
+                            '因失联或空闲被回收的会话数',
+                            dict(desktop, reason=reason), count))
+        for direction in (UPSTREAM, DOWNSTREAM):
+            total = self.traffic_total(direction)
+            labels = dict(desktop, direction=direction)
+            samples.append(('vnc_proxy_relay_bytes_total', 'counter', '转发的字节数',
+                            labels, total.bytes))
+            samples.append(('vnc_proxy_relay_chunks_total', 'counter', '转发的数据块数',
+                            labels, total.chunks))
+            samples.append(('vnc_proxy_relay_send_stalls_total', 'counter',
+                            '发送耗时超过阻塞阈值的次数', labels, total.stalls))
+        for quantile in (50, 99):
+            seconds = self.relay_latency.percentile(quantile)
+            samples.append(('vnc_proxy_relay_send_seconds', 'gauge', '单次转发发送耗时的分位数',
+                            dict(desktop, quantile=str(quantile / 100)),
+                            round(seconds, 6) if seconds is not None else None))
+            if self.qos:
+                seconds = self.input_latency.percentile(quantile)
+                samples.append(('vnc_proxy_input_forward_seconds', 'gauge',
+                                'QoS模式下输入事件从收到到写出耗时的分位数',
+                                dict(desktop, quantile=str(quantile / 100)),
+                                round(seconds, 6) if seconds is not None else None))
+        return samples
         
-        # 启动状态更新
-        self.update_gui_status()
+    def log_stats(self):
+        """输出运行统计日志"""
+        stats = self.get_stats()
+        self.logger.info(f"运行统计: 引擎 {stats['engine']}, 线程数 {stats['threads']}, "
+                    f"转发路径 {stats['relay_path_counts']}, "
+                    f"转发延迟 p50 {stats['relay_latency_p50_ms']} ms / "
+                    f"p99 {stats['relay_latency_p99_ms']} ms "
+                    f"(采样 {stats['relay_samples']}), "
+                    f"后端连接 p50 {stats['backend_connect_p50_ms']} ms / "
+                    f"p99 {stats['backend_connect_p99_ms']} ms"
+                    + (f", 连接池 {stats['backend_pool']}" if self.backend_pool else "")
+                    + (f", TLS握手 {stats['tls']['handshakes']} 次"
+                       f"（会话恢复 {stats['tls']['resumed']}，"
+                       f"失败 {stats['tls']['failures']}），"
+                       f"完整握手 p50 {stats['tls']['full_p50_ms']} ms / "
+                       f"会话恢复 p50 {stats['tls']['resumed_p50_ms']} ms"
+                       if self.tls else "")
+                    + (f", 输入转发 p50 {stats['input_forward_p50_ms']} ms / "
+                       f"p99 {stats['input_forward_p99_ms']} ms" if self.qos else "")
+                    + f", 等待队列 {stats['admission']['depth']} 人 "
+                    f"(等待 p50 {stats['admission']['wait_p50_ms']} ms / "
+                    f"p99 {stats['admission']['wait_p99_ms']} ms), "
+                    f"限流丢弃 IP {stats['rate_limit']['limited_ip']} / "
+                    f"子网 {stats['rate_limit']['limited_subnet']}, "
+                    f"回收会话 {stats['reclaimed']}, "
+                    f"冷却列表 {stats['rejected_ips']}")
         
-        self.root.mainloop()
+    def start_stats_reporter(self):
+        """启动定期统计日志线程"""
+        if self.stats_interval <= 0:
+            return
+            
+        def report():
+            while self.is_running:
+                time.sleep(self.stats_interval)
+                if self.is_running:
+                    self.log_stats()
+                    
+        threading.Thread(target=report, daemon=True).start()
+
+    def start_gui(self):
+        """启动GUI（窗口和系统托盘在vnc_proxy_gui中，按需导入）"""
+        from vnc_proxy_gui import ProxyWindow
         
-    def start_server_gui(self):
-        """从GUI启动服务器"""
-        threading.Thread(target=self.start_server, daemon=True).start()
-        self.start_btn.config(state=tk.DISABLED)
-        self.stop_btn.config(state=tk.NORMAL)
+        self.window = ProxyWindow(self)
+        self.window.run()
         
     def stop_server(self):
         """停止服务器"""
         self.is_running = False
-        if self.server_socket:
+        if self.engine:
+            # 由事件循环自行关闭监听套接字
+            self.engine.stop()
+        elif self.server_socket:
             try:
                 self.server_socket.close()
             except:
                 pass
+        if self.backend_pool:
+            self.backend_pool.stop()
+        if self.websocket:
+            self.websocket.stop()
+        self.admission.close()
         if self.active_session:
             self.cleanup_session()
-        if self.root:
-            self.start_btn.config(state=tk.NORMAL)
-            self.stop_btn.config(state=tk.DISABLED)
-        
-    def update_gui_status(self):
-        """更新GUI状态"""
-        if self.root:
-            if self.is_running:
-                self.status_var.set(f"服务器运行中 - 端口 {self.proxy_port}")
-            else:
-                self.status_var.set("服务器未启动")
-                
-            if self.active_session:
-                addr = self.active_session['client_addr']
-                start_time = self.active_session['start_time'].strftime('%H:%M:%S')
-                self.conn_var.set(f"客户端: {addr} (连接时间: {start_time})")
-            else:
-                self.conn_var.set("无客户端连接")
-                
-            self.root.after(1000, self.update_gui_status)
+        if self.recorder:
+            # 写完已结束会话的录制和索引
+            self.recorder.drain()
+
+def gui_available():
+    """GUI依赖（tkinter、pystray、PIL）能否加载，没有显示环境或依赖时返回False"""
+    try:
+        import vnc_proxy_gui  # noqa: F401
+    except Exception as e:
+        logger.warning(f"无法加载GUI（{e}），以无GUI模式运行")
+        return False
+    return True
+    
+def build_encoding_policy(source):
+    """编码策略：JSON文件路径或配置文件中内联的规则"""
+    if not source:
+        return None
+    return load_encoding_policy(source)
+    
+def build_tls(settings):
+    """配置了证书时创建TLS终结（proxy_tls，按需导入）"""
+    if not settings['tls_cert']:
+        return None
+    from proxy_tls import TLSTerminator
+    
+    return TLSTerminator(*(settings[key] for key in TLS_SETTINGS))
+    
+def build_recorder(args):
+    """按 --record-dir 创建会话录制器，所有桌面共用一个写入线程"""
+    if not args.record_dir:
+        return None
+    from recorder import Recorder
+    
+    return Recorder(args.record_dir, args.record_keyframe_interval,
+                    args.record_max_pending_mb)
+    
+def close_listener(server_socket):
+    """关闭监听套接字，先shutdown以唤醒阻塞在accept()中的线程"""
+    try:
+        server_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    server_socket.close()
+    
+# 可在配置文件中按桌面设置、未设置时取命令行参数的项
+DESKTOP_ARGS = ('fb_cache_mb', 'reconnect_linger', 'pool_size', 'pool_max_idle',
+                'pool_prefetch_version', 'queue_wait', 'max_queue', 'decision_timeout',
+                'ip_rate', 'ip_burst', 'subnet_rate', 'subnet_burst',
+                'headless_decision', 'encoding_policy', 'max_update_rate',
+                'takeover_mode', 'refuse_timeout', 'qos', 'qos_bulk_rate',
+                'coalesce_pointer', 'keepalive', 'user_timeout', 'client_idle_timeout',
+                'server_idle_timeout', 'input_idle_minutes', 'input_idle_action',
+                'ws_deflate') + TLS_SETTINGS
+    
+def resolve_desktop(args, desktop):
+    """配置文件中的一个桌面项 -> 完整的桌面设置，未设置的项取命令行参数"""
+    settings = {key: desktop.get(key, getattr(args, key)) for key in DESKTOP_ARGS}
+    settings.update(name=desktop.get('name'), proxy_port=desktop['proxy_port'],
+                    vnc_host=desktop['vnc_host'], vnc_port=desktop['vnc_port'],
+                    grace_period=desktop['grace_period'],
+                    shared_view=desktop['shared_view'] or args.shared_view,
+                    ws_port=desktop.get('ws_port', 0),
+                    record=desktop.get('record', True))
+    return settings
+    
+def load_desktops(args):
+    """读取所有桌面的完整设置：--config 多桌面配置，或命令行参数加 --settings 设置文件"""
+    if args.config:
+        from desktop_router import load_desktop_config
+        
+        return [resolve_desktop(args, desktop)
+                for desktop in load_desktop_config(args.config)]
+    desktop = {'proxy_port': args.proxy_port, 'vnc_host': args.vnc_host,
+               'vnc_port': args.vnc_port, 'grace_period': 60, 'shared_view': False,
+               'ws_port': args.ws_port}
+    if args.settings:
+        from desktop_router import load_desktop_settings
+        
+        desktop.update(load_desktop_settings(args.settings))
+    return [resolve_desktop(args, desktop)]
+    
+def build_proxy(args, settings, recorder, stats_interval=0):
+    """按完整的桌面设置创建代理对象"""
+    proxy = SimpleVNCProxy(settings['vnc_host'], settings['vnc_port'],
+                           settings['proxy_port'],
+                           engine=args.engine, stats_interval=stats_interval,
+                           relay_path=args.relay_path, name=settings['name'],
+                           shared_view=settings['shared_view'],
+                           fb_cache_mb=settings['fb_cache_mb'],
+                           reconnect_linger=settings['reconnect_linger'],
+                           pool_size=settings['pool_size'],
+                           pool_max_idle=settings['pool_max_idle'],
+                           pool_prefetch_version=settings['pool_prefetch_version'],
+                           queue_wait=settings['queue_wait'],
+                           max_queue=settings['max_queue'],
+                           ip_rate=settings['ip_rate'], ip_burst=settings['ip_burst'],
+                           subnet_rate=settings['subnet_rate'],
+                           subnet_burst=settings['subnet_burst'],
+                           backlog=args.backlog,
+                           headless_decision=settings['headless_decision'],
+                           encoding_policy=build_encoding_policy(
+                               settings['encoding_policy']),
+                           max_update_rate=settings['max_update_rate'],
+                           recorder=recorder if settings['record'] else None,
+                           takeover_mode=settings['takeover_mode'],
+                           refuse_timeout=settings['refuse_timeout'],
+                           decision_timeout=settings['decision_timeout'],
+                           qos=settings['qos'], qos_bulk_rate=settings['qos_bulk_rate'],
+                           coalesce_pointer=settings['coalesce_pointer'],
+                           keepalive=settings['keepalive'],
+                           user_timeout=settings['user_timeout'],
+                           client_idle_timeout=settings['client_idle_timeout'],
+                           server_idle_timeout=settings['server_idle_timeout'],
+                           input_idle_minutes=settings['input_idle_minutes'],
+                           input_idle_action=settings['input_idle_action'],
+                           ws_port=settings['ws_port'],
+                           ws_deflate=settings['ws_deflate'],
+                           tls=build_tls(settings))
+    proxy.grace_period = settings['grace_period']
+    proxy.settings = settings
+    return proxy
+    
+def build_desktop_proxies(args):
+    """按配置文件创建所有桌面的代理对象"""
+    recorder = build_recorder(args)
+    return [build_proxy(args, settings, recorder) for settings in load_desktops(args)]
+    
+def build_single_proxy(args):
+    """按命令行参数（和 --settings 设置文件）创建单桌面代理对象"""
+    return build_proxy(args, load_desktops(args)[0], build_recorder(args),
+                       args.stats_interval)
+    
+def start_reloader(args, proxies, owner):
+    """有配置文件时启用重新加载：SIGHUP 和托盘菜单/窗口按钮"""
+    if not (args.config or args.settings):
+        return None
+    from config_reload import ConfigReloader
+    
+    reloader = ConfigReloader(lambda: load_desktops(args), proxies)
+    reloader.install_signal()
+    owner.reloader = reloader
+    return reloader
+    
+def run_multi_desktop(args):
+    """多桌面模式：按配置文件创建所有桌面并共用一个引擎"""
+    from desktop_router import DesktopRouter
+    
+    proxies = build_desktop_proxies(args)
+    start_metrics_server(args, proxies)
+    router = DesktopRouter(proxies, engine=args.engine,
+                           stats_interval=args.stats_interval)
+    start_reloader(args, proxies, router)
+    
+    if args.no_gui:
+        try:
+            router.start_server()
+        except KeyboardInterrupt:
+            logger.info("收到中断信号，停止服务器...")
+            router.stop_server()
+    else:
+        router.start_gui()
 
+def start_metrics_server(args, proxies):
+    """按 --metrics-port 启动本地指标端点"""
+    if args.metrics_port <= 0:
+        return None
+    from metrics_server import MetricsServer
+    
+    server = MetricsServer(proxies, args.metrics_port, args.metrics_host)
+    try:
+        server.start()
+    except OSError as e:
+        logger.error(f"启动指标端点失败: {e}")
+        return None
+    return server
+    
+def run_workers(args):
+    """多进程模式，不可用时返回False并回到单进程"""
+    from workers import WorkerPool, workers_supported
+    
+    if not workers_supported():
+        logger.warning("当前系统不支持多进程模式，使用单进程运行")
+        return False
+    if not args.no_gui:
+        logger.warning("多进程模式需要 --no-gui，使用单进程运行")
+        return False
+    if args.engine != "thread":
+        logger.warning("多进程模式下工作进程使用线程引擎")
+        args.engine = "thread"
+        
+    if args.config:
+        build = lambda: build_desktop_proxies(args)
+    else:
+        build = lambda: [build_single_proxy(args)]
+    pool = WorkerPool(build, args.workers, args.accept_mode, args.backlog,
+                      args.stats_interval, args.metrics_port, args.metrics_host)
+    if not pool.run():
+        raise SystemExit(1)
+    return True
+    
 def main():
     """主函数"""
     import argparse
@@ -541,10 +1380,153 @@ def main():
     parser.add_argument('--vnc-port', type=int, default=5901, help='VNC服务器端口')
     parser.add_argument('--proxy-port', type=int, default=5900, help='代理服务器端口')
     parser.add_argument('--no-gui', action='store_true', help='不启动GUI界面')
+    parser.add_argument('--ws-port', type=int, default=0,
+                        help='WebSocket监听端口，浏览器客户端（noVNC）直接连接，不需要websockify（0为关闭）')
+    parser.add_argument('--ws-deflate', choices=list(websocket_listener.DEFLATE_MODES),
+                        default=websocket_listener.DEFLATE_AUTO,
+                        help='WebSocket的permessage-deflate：'
+                             'auto（默认，只对非局域网客户端协商）、on 或 off')
+    parser.add_argument('--tls-cert',
+                        help='TLS证书文件（PEM，可含私钥），'
+                             '设置后代理端口和WebSocket端口只接受TLS连接，到VNC服务器仍为明文')
+    parser.add_argument('--tls-key', help='TLS私钥文件（PEM，默认从证书文件中读取）')
+    parser.add_argument('--tls-ciphers',
+                        help='TLS 1.2的OpenSSL密码套件字符串，如 ECDHE+AESGCM（默认使用Python的安全默认值）')
+    parser.add_argument('--tls-min-version', choices=['1.2', '1.3'], default='1.2',
+                        help='接受的最低TLS版本（默认1.2）')
+    parser.add_argument('--tls-alpn', default='',
+                        help='服务端支持的ALPN协议，逗号分隔（默认不协商）；客户端提供的协议都不匹配时照常连接')
+    parser.add_argument('--tls-tickets', type=int, default=2,
+                        help='每次完整握手后签发的TLS 1.3会话票据数（默认2），重新连接的客户端凭票据跳过完整握手；'
+                             '0为不签发票据（同时关闭TLS 1.2的会话票据）')
+    parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread',
+                        help='转发引擎：thread（每方向一个线程）或 asyncio（单事件循环）')
+    parser.add_argument('--stats-interval', type=float, default=0,
+                        help='定期输出线程数和转发延迟统计的间隔秒数（0为关闭）')
+    parser.add_argument('--relay-path',
+                        choices=[relay.PATH_AUTO, relay.PATH_SPLICE, relay.PATH_BUFFER],
+                        default=relay.PATH_AUTO,
+                        help='转发路径：auto（Linux上优先splice）、splice 或 buffer（recv_into缓冲区）')
+    parser.add_argument('--config', help='多桌面配置文件（JSON），在一个进程中服务多个代理端口')
+    parser.add_argument('--settings',
+                        help='单桌面设置文件（JSON，键与多桌面配置中的桌面项相同），覆盖对应的命令行参数')
+    parser.add_argument('--shared-view', action='store_true',
+                        help='共享观看模式：后续客户端作为只读观察者共用一条后端连接（VNC服务器需无认证）')
+    parser.add_argument('--fb-cache-mb', type=float, default=0,
+                        help='共享观看模式下每个桌面的帧缓冲区缓存预算（MB，0为关闭），新客户端直接从缓存获得首帧')
+    parser.add_argument('--reconnect-linger', type=float, default=0,
+                        help='共享观看模式下所有者断开后保留后端连接等待重连的秒数（0为立即断开）')
+    parser.add_argument('--pool-size', type=int, default=0,
+                        help='预热后端连接池大小（0为关闭），新会话直接取用已建立的后端连接')
+    parser.add_argument('--pool-max-idle', type=float, default=30,
+                        help='预热连接最长空闲秒数，超过后关闭并重新建立（默认30）')
+    parser.add_argument('--pool-prefetch-version', action='store_true',
+                        help='预热连接预先读取VNC服务器的协议版本串')
+    parser.add_argument('--queue-wait', type=float, default=0,
+                        help='新客户端未获准接管时保持连接排队等待当前会话结束的秒数（0为立即拒绝）')
+    parser.add_argument('--max-queue', type=int, default=16,
+                        help='每个桌面最多排队的客户端数（默认16）')
+    parser.add_argument('--encoding-policy',
+                        help='编码策略文件（JSON），按客户端来源网络改写SetEncodings，'
+                             '如对非局域网客户端优先ZRLE/Tight')
+    parser.add_argument('--max-update-rate', type=float, default=0,
+                        help='每个会话每秒最多转发的增量更新请求数（0为不限制），多余请求合并为外接矩形')
+    parser.add_argument('--qos', action='store_true',
+                        help='输入优先调度：键盘/指针事件先于剪贴板、文件传输等大消息转发，并统计输入事件的转发耗时')
+    parser.add_argument('--qos-bulk-rate', type=float, default=0,
+                        help='输入优先调度下每个会话剪贴板/文件传输等大消息的限速（KB/秒，0为不限速）')
+    parser.add_argument('--coalesce-pointer', action='store_true',
+                        help='VNC服务器方向拥塞时合并按钮状态不变的连续指针移动，只转发最新位置')
+    parser.add_argument('--keepalive', type=int, default=0,
+                        help='会话两端连接空闲N秒后发送TCP keepalive探测，对端失联时约2N秒内断开（0为不启用）')
+    parser.add_argument('--user-timeout', type=float, default=0,
+                        help='TCP_USER_TIMEOUT秒数：已发送数据超过N秒未被确认时断开（仅Linux，0为系统默认）')
+    parser.add_argument('--client-idle-timeout', type=float, default=0,
+                        help='客户端方向N秒没有收到任何数据时回收会话（0为不检查）')
+    parser.add_argument('--server-idle-timeout', type=float, default=0,
+                        help='VNC服务器方向N秒没有收到任何数据时回收会话（0为不检查；画面静止时服务器可能不发送数据）')
+    parser.add_argument('--input-idle-minutes', type=float, default=0,
+                        help='N分钟没有键盘/鼠标输入时按 --input-idle-action 处理'
+                             '（0为不检查，需要解析客户端数据流）')
+    parser.add_argument('--input-idle-action',
+                        choices=[liveness.IDLE_HANDOVER, liveness.IDLE_FREE],
+                        default=liveness.IDLE_HANDOVER,
+                        help='输入空闲后的处理：handover（默认，有客户端等待或到达时直接交给它）或 free（立即结束会话）')
+    parser.add_argument('--takeover-mode',
+                        choices=[TAKEOVER_RECONNECT, TAKEOVER_KEEP_BACKEND],
+                        default=TAKEOVER_RECONNECT,
+                        help='新客户端接管方式：reconnect（断开后重新连接VNC服务器，默认）或 '
+                             'keep_backend（保留已握手的后端连接，只替换客户端；VNC服务器需无认证）')
+    parser.add_argument('--record-dir',
+                        help='会话录制目录，每个会话录制为一个 .vncrec 文件，可用 vnc_replay.py 回放')
+    parser.add_argument('--record-keyframe-interval', type=float, default=10,
+                        help='录制关键帧间隔秒数（默认10），回放可以从任意关键帧开始')
+    parser.add_argument('--record-max-pending-mb', type=float, default=64,
+                        help='录制写入积压上限（MB，默认64），超过时停止该会话的录制而不阻塞转发')
+    parser.add_argument('--headless-decision', choices=[KEEP_CURRENT, ALLOW_NEW],
+                        default=KEEP_CURRENT,
+                        help='无GUI时新客户端的默认决策：keep_current（保留当前会话，默认）'
+                             '或 allow_new（新客户端接管）')
+    parser.add_argument('--ip-rate', type=float, default=0,
+                        help='每个IP每秒允许的新连接数（令牌桶速率，默认0为不限制；同一NAT出口后的用户共用一个IP）')
+    parser.add_argument('--ip-burst', type=int, default=10,
+                        help='每个IP允许的突发连接数（默认10）')
+    parser.add_argument('--subnet-rate', type=float, default=0,
+                        help='每个子网（IPv4 /24、IPv6 /64）每秒允许的新连接数（默认0为不限制）')
+    parser.add_argument('--subnet-burst', type=int, default=30,
+                        help='每个子网允许的突发连接数（默认30）')
+    parser.add_argument('--backlog', type=int, default=128,
+                        help='监听队列长度（默认128）')
+    parser.add_argument('--decision-timeout', type=float, default=5,
+                        help='决策对话框的倒计时秒数（默认5），无人响应时新客户端接管')
+    parser.add_argument('--refuse-timeout', type=float, default=5,
+                        help='被拒绝的客户端发送版本串的最长等待时间（秒，默认5），超时直接关闭')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='工作进程数（仅类Unix系统、需--no-gui），各桌面按顺序分配给工作进程')
+    parser.add_argument('--accept-mode', choices=['handoff', 'reuseport'],
+                        default='handoff',
+                        help='多进程接受方式：handoff（主进程接受后转交）'
+                             '或 reuseport（各进程共享端口）')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='本地指标端点端口（0为关闭），提供 /metrics（Prometheus）和 /metrics.json；'
+                             '多进程模式下第N个工作进程使用该端口+N')
+    parser.add_argument('--metrics-host', default='127.0.0.1',
+                        help='指标端点监听地址（默认只监听本机）')
+    parser.add_argument('--log-file', default=proxy_logging.LOG_FILE,
+                        help=f'日志文件（UTF-8，默认 {proxy_logging.LOG_FILE}，空字符串为只输出到控制台）')
+    parser.add_argument('--log-format',
+                        choices=[proxy_logging.FORMAT_TEXT, proxy_logging.FORMAT_JSON],
+                        default=proxy_logging.FORMAT_TEXT,
+                        help='日志格式：text（默认）或 json（每行一个JSON对象，带桌面和会话ID）')
+    parser.add_argument('--log-max-mb', type=float, default=10,
+                        help='日志文件超过该大小（MB）时轮转（默认10，0为不按大小轮转）')
+    parser.add_argument('--log-rotate-hours', type=float, default=0,
+                        help='日志文件按时间轮转的间隔小时数（默认0，不按时间轮转）')
+    parser.add_argument('--log-backups', type=int, default=5,
+                        help='保留的轮转日志文件数（默认5）')
+    parser.add_argument('--log-dedup-window', type=float, default=60,
+                        help='同一IP重复事件（限流、冷却期拒绝等）的日志合并窗口秒数（默认60，0为不合并）')
     
     args = parser.parse_args()
+    proxy_logging.setup_logging(log_file=args.log_file, log_format=args.log_format,
+                                max_bytes=int(args.log_max_mb * 1024 * 1024),
+                                backup_count=args.log_backups,
+                                rotate_seconds=args.log_rotate_hours * 3600,
+                                dedup_window=args.log_dedup_window)
+    if not args.no_gui and not gui_available():
+        args.no_gui = True
+    
+    if args.workers > 1:
+        if run_workers(args):
+            return
+    
+    if args.config:
+        run_multi_desktop(args)
+        return
     
-    proxy = SimpleVNCProxy(args.vnc_host, args.vnc_port, args.proxy_port)
+    proxy = build_single_proxy(args)
+    start_metrics_server(args, [proxy])
+    start_reloader(args, [proxy], proxy)
     
     if args.no_gui:
         try:
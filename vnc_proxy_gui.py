@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+VNC代理的GUI和系统托盘
+只在不带 --no-gui 启动时由 vnc_proxy / desktop_router 按需导入，
+无GUI运行时不会加载 tkinter、pystray 和 PIL。
+窗口和托盘提示订阅代理的状态总线（status_bus），只在状态变化时重绘，
+不读取会话对象或套接字。
+"""
+
+import sys
+import threading
+import tkinter as tk
+
+import pystray
+from PIL import Image, ImageDraw
+
+from status_bus import HISTORY
+
+# 文本吞吐量曲线使用的字符
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+
+def format_rate(rate):
+    """字节/秒 -> 可读的速率"""
+    for unit in ('B/s', 'KB/s', 'MB/s'):
+        if rate < 1024 or unit == 'MB/s':
+            return f"{rate:.0f} {unit}" if unit == 'B/s' else f"{rate:.1f} {unit}"
+        rate /= 1024
+
+
+def spark_text(values, width=20):
+    """最近的采样 -> 文本曲线"""
+    values = values[-width:]
+    peak = max(values, default=0)
+    if not peak:
+        return ""
+    top = len(SPARK_CHARS) - 1
+    return "".join(SPARK_CHARS[min(top, int(v * len(SPARK_CHARS) / peak))]
+                   for v in values)
+
+
+def describe_client(status):
+    """当前客户端、观察者和等待队列的说明"""
+    if status.client is None:
+        text = "无客户端连接"
+    else:
+        text = f"客户端: {status.client} (连接时间: {status.since})"
+        if status.mode == "shared_view":
+            text += f"\n观察者: {status.observers} 人"
+        elif status.mode == "keep_backend":
+            text += "\n保留后端连接"
+        if status.owner_vacant:
+            text += "，所有者已断开，等待重连"
+    if status.queue_depth:
+        text += f"\n等待队列: {status.queue_depth} 人"
+    return text
+
+
+class DecisionDialog:
+    """新客户端请求接管时的决策对话框（在Tk线程中创建和关闭）"""
+
+    def __init__(self, proxy, new_client_addr, waiting=0):
+        self.proxy = proxy
+        self.root = proxy.root
+        self.countdown_job = None
+        self.countdown_seconds = proxy.admission.decision_timeout
+
+        self.window = tk.Toplevel(self.root)
+        self.window.title(f"新连接请求 - {proxy.name}" if proxy.name else "新连接请求")
+        self.window.geometry("500x300")
+        self.window.resizable(False, False)
+        self.window.attributes('-topmost', True)
+        self.window.focus_force()
+
+        # 主容器
+        main_container = tk.Frame(self.window)
+        main_container.pack(fill=tk.BOTH, expand=True, padx=30, pady=30)
+
+        # 消息标签
+        msg = f"新客户端 {new_client_addr} 请求连接\n\n您要断开当前连接让新用户使用吗？"
+        if waiting:
+            msg += f"\n（另有 {waiting} 个客户端在排队）"
+        msg_label = tk.Label(main_container, text=msg, font=('Arial', 14),
+                             wraplength=400, justify='center')
+        msg_label.pack(pady=(0, 20))
+
+        # 倒计时标签
+        self.countdown_var = tk.StringVar()
+        countdown_label = tk.Label(main_container, textvariable=self.countdown_var,
+                                   font=('Arial', 16, 'bold'), fg='red')
+        countdown_label.pack(pady=(0, 30))
+
+        # 按钮容器
+        button_container = tk.Frame(main_container)
+        button_container.pack(pady=20)
+
+        # 按钮样式
+        btn_style = {
+            'font': ('Arial', 12, 'bold'),
+            'width': 18,
+            'height': 3,
+            'relief': 'raised',
+            'bd': 3
+        }
+
+        # 继续使用按钮
+        continue_btn = tk.Button(
+            button_container,
+            text="我还要继续使用",
+            bg='#2E8B57', fg='white',
+            activebackground='#228B22',
+            command=lambda: self.make_decision("keep_current"),
+            **btn_style
+        )
+        continue_btn.pack(side=tk.LEFT, padx=20)
+
+        # 让新用户连接按钮
+        new_user_btn = tk.Button(
+            button_container,
+            text="让新用户连接",
+            bg='#DC143C', fg='white',
+            activebackground='#B22222',
+            command=lambda: self.make_decision("allow_new"),
+            **btn_style
+        )
+        new_user_btn.pack(side=tk.LEFT, padx=20)
+
+        # 启动倒计时（超时由接入调度器处理，这里只负责显示）
+        self.update_countdown()
+
+    def update_countdown(self):
+        """更新决策倒计时"""
+        self.countdown_job = None
+        if self.window is None:
+            return
+        if self.countdown_seconds > 0:
+            self.countdown_var.set(f"倒计时: {self.countdown_seconds} 秒")
+            self.countdown_seconds -= 1
+            self.countdown_job = self.root.after(1000, self.update_countdown)
+        else:
+            self.countdown_var.set("时间到！自动让新用户连接")
+
+    def make_decision(self, decision):
+        """做出决策"""
+        self.proxy.close_decision_dialog()
+        self.proxy.admission.decide(decision)
+
+    def close(self):
+        """关闭对话框"""
+        if self.countdown_job:
+            self.root.after_cancel(self.countdown_job)
+            self.countdown_job = None
+        if self.window is not None:
+            self.window.destroy()
+            self.window = None
+
+
+class StatusView:
+    """把状态总线的通知转交到Tk线程：连续的通知合并为一次重绘"""
+
+    def __init__(self, root, render):
+        self.root = root
+        self.render = render
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.scheduled = False
+
+    def subscribe(self, bus):
+        bus.subscribe(lambda event, status: self.on_status(bus, event, status))
+
+    def on_status(self, bus, event, status):
+        # 在发布方线程中执行，只记录最新状态并安排一次重绘
+        with self.lock:
+            self.pending[bus] = (event, status)
+            if self.scheduled:
+                return
+            self.scheduled = True
+        try:
+            self.root.after(0, self.flush)
+        except RuntimeError:
+            # Tk主循环已退出
+            pass
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.scheduled = False
+        for event, status in pending.values():
+            self.render(event, status)
+
+
+class Sparkline(tk.Canvas):
+    """最近一段时间的上行/下行吞吐量曲线"""
+
+    def __init__(self, master, width=360, height=60, **kwargs):
+        super().__init__(master, width=width, height=height, bg='white',
+                         highlightthickness=1, highlightbackground='#CCCCCC', **kwargs)
+        self.width = width
+        self.height = height
+
+    def draw(self, history, capacity):
+        self.delete('all')
+        if not history:
+            return
+        peak = max(max(up, down) for up, down in history) or 1
+        step = self.width / max(capacity - 1, 1)
+        offset = (capacity - len(history)) * step
+        for index, color in ((1, '#0066CC'), (0, '#2E8B57')):
+            points = []
+            for i, sample in enumerate(history):
+                points.append(offset + i * step)
+                points.append(self.height - 2
+                              - sample[index] * (self.height - 4) / peak)
+            if len(points) >= 4:
+                self.create_line(*points, fill=color, width=2)
+        self.create_text(4, 2, anchor='nw', text=f"峰值 {format_rate(peak)}",
+                         fill='#666666', font=('微软雅黑', 8))
+
+
+class ProxyWindow:
+    """单桌面模式的主窗口和系统托盘图标"""
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.root = None
+        self.tray_icon = None
+        self.status = proxy.status.snapshot()
+
+    def run(self):
+        """创建窗口并运行Tk主循环"""
+        proxy = self.proxy
+        self.root = proxy.root = tk.Tk()
+        self.root.title("简化VNC代理服务器")
+        self.root.geometry("420x400")
+
+        # 设置窗口关闭事件
+        self.root.protocol("WM_DELETE_WINDOW", self.on_window_close)
+
+        # 主框架
+        frame = tk.Frame(self.root, padx=20, pady=20)
+        frame.pack(fill=tk.BOTH, expand=True)
+
+        # 标题
+        tk.Label(frame, text="简化VNC代理服务器",
+                 font=('微软雅黑', 16, 'bold')).pack(pady=10)
+
+        # 状态
+        self.status_var = tk.StringVar(value="服务器未启动")
+        tk.Label(frame, textvariable=self.status_var,
+                 font=('微软雅黑', 12)).pack(pady=10)
+
+        # 连接信息
+        self.conn_var = tk.StringVar(value="无客户端连接")
+        tk.Label(frame, textvariable=self.conn_var,
+                 font=('微软雅黑', 10)).pack(pady=5)
+
+        # 吞吐量
+        self.rate_var = tk.StringVar(value="")
+        tk.Label(frame, textvariable=self.rate_var,
+                 font=('微软雅黑', 9)).pack()
+        self.sparkline = Sparkline(frame)
+        self.sparkline.pack(pady=5)
+
+        # 按钮
+        btn_frame = tk.Frame(frame)
+        btn_frame.pack(pady=15)
+
+        self.start_btn = tk.Button(btn_frame, text="启动服务器",
+                                   command=self.start_server)
+        self.start_btn.pack(side=tk.LEFT, padx=5)
+
+        self.stop_btn = tk.Button(btn_frame, text="停止服务器",
+                                  command=proxy.stop_server, state=tk.DISABLED)
+        self.stop_btn.pack(side=tk.LEFT, padx=5)
+
+        # 托盘按钮
+        self.tray_btn = tk.Button(btn_frame, text="最小化到托盘",
+                                  command=self.hide_window)
+        self.tray_btn.pack(side=tk.LEFT, padx=5)
+
+        # 创建系统托盘图标，在单独线程中运行
+        self.create_tray_icon()
+        threading.Thread(target=self.tray_icon.run, daemon=True).start()
+
+        # 订阅状态总线，状态变化时才重绘
+        StatusView(self.root, self.render).subscribe(proxy.status)
+
+        self.root.mainloop()
+
+    def create_tray_icon(self):
+        """创建系统托盘图标"""
+        # 创建简单的图标
+        image = Image.new('RGB', (64, 64), color='blue')
+        draw = ImageDraw.Draw(image)
+        draw.rectangle([16, 16, 48, 48], fill='white')
+        draw.text((20, 25), "VNC", fill='blue')
+
+        # 创建托盘菜单
+        menu = pystray.Menu(
+            pystray.MenuItem("显示窗口", self.show_window),
+            pystray.MenuItem("隐藏窗口", self.hide_window),
+            pystray.Menu.SEPARATOR,
+            pystray.MenuItem("启动服务器", self.start_server_tray,
+                             enabled=lambda item: not self.status.running),
+            pystray.MenuItem("停止服务器", self.stop_server_tray,
+                             enabled=lambda item: self.status.running),
+            pystray.MenuItem("重新加载配置", self.reload_config,
+                             enabled=lambda item: self.proxy.reloader is not None),
+            pystray.Menu.SEPARATOR,
+            pystray.MenuItem("退出", self.quit_application)
+        )
+
+        self.tray_icon = pystray.Icon("VNC代理", image, "VNC代理服务器", menu)
+
+    def show_window(self, icon=None, item=None):
+        """显示主窗口"""
+        if self.root:
+            self.root.deiconify()
+            self.root.lift()
+            self.root.attributes('-topmost', True)
+            self.root.after(100, lambda: self.root.attributes('-topmost', False))
+
+    def hide_window(self, icon=None, item=None):
+        """隐藏主窗口到系统托盘"""
+        if self.root:
+            self.root.withdraw()
+
+    def on_window_close(self):
+        """窗口关闭事件处理：最小化到系统托盘而不是退出"""
+        self.hide_window()
+
+    def start_server(self):
+        """从GUI启动服务器"""
+        threading.Thread(target=self.proxy.start_server, daemon=True).start()
+        self.start_btn.config(state=tk.DISABLED)
+        self.stop_btn.config(state=tk.NORMAL)
+
+    def start_server_tray(self, icon=None, item=None):
+        """从系统托盘启动服务器"""
+        if not self.status.running:
+            threading.Thread(target=self.proxy.start_server, daemon=True).start()
+
+    def stop_server_tray(self, icon=None, item=None):
+        """从系统托盘停止服务器"""
+        self.proxy.stop_server()
+
+    def reload_config(self, icon=None, item=None):
+        """从系统托盘重新加载配置文件，当前会话不中断"""
+        if self.proxy.reloader:
+            self.proxy.reloader.reload_async()
+
+    def quit_application(self, icon=None, item=None):
+        """退出应用程序"""
+        self.proxy.stop_server()
+        if self.tray_icon:
+            self.tray_icon.stop()
+        if self.root:
+            self.root.quit()
+        sys.exit(0)
+
+    def render(self, event, status):
+        """按新的状态快照重绘窗口和托盘提示（在Tk线程中执行）"""
+        self.status = status
+        if status.running:
+            self.status_var.set(f"服务器运行中 - 端口 {status.port} -> {status.backend}")
+        else:
+            self.status_var.set("服务器未启动")
+        self.start_btn.config(state=tk.DISABLED if status.running else tk.NORMAL)
+        self.stop_btn.config(state=tk.NORMAL if status.running else tk.DISABLED)
+        self.conn_var.set(describe_client(status))
+
+        if status.client is None:
+            self.rate_var.set("")
+        else:
+            self.rate_var.set(f"上行 {format_rate(status.rate_up)}    "
+                              f"下行 {format_rate(status.rate_down)}")
+        self.sparkline.draw(status.history, HISTORY)
+
+        if self.tray_icon:
+            tip = "VNC代理服务器"
+            if status.client is not None:
+                tip += f" - {status.client} ↓{format_rate(status.rate_down)}"
+            elif not status.running:
+                tip += "（未启动）"
+            if status.queue_depth:
+                tip += f"，排队 {status.queue_depth} 人"
+            self.tray_icon.title = tip
+
+
+class RouterWindow:
+    """多桌面模式的共享窗口，所有桌面的决策对话框共用同一个Tk根窗口"""
+
+    def __init__(self, router):
+        self.router = router
+        self.root = None
+        self.desktop_vars = {}
+
+    def run(self):
+        """创建窗口、在后台线程启动所有桌面并运行Tk主循环"""
+        router = self.router
+        self.root = tk.Tk()
+        self.root.title("简化VNC代理服务器 - 多桌面")
+        self.root.geometry("560x400")
+        self.root.protocol("WM_DELETE_WINDOW", self.quit_application)
+
+        frame = tk.Frame(self.root, padx=20, pady=20)
+        frame.pack(fill=tk.BOTH, expand=True)
+
+        tk.Label(frame, text=f"多桌面VNC代理（{len(router.proxies)} 个桌面）",
+                 font=('微软雅黑', 14, 'bold')).pack(pady=10)
+
+        view = StatusView(self.root, self.render)
+        for proxy in router.proxies:
+            proxy.root = self.root
+            var = tk.StringVar()
+            tk.Label(frame, textvariable=var, font=('微软雅黑', 10),
+                     anchor='w', justify='left').pack(fill=tk.X, pady=2)
+            self.desktop_vars[proxy.status.snapshot().name] = var
+            view.subscribe(proxy.status)
+
+        if router.reloader:
+            tk.Button(frame, text="重新加载配置",
+                      command=router.reloader.reload_async).pack(pady=10)
+
+        threading.Thread(target=router.start_server, daemon=True).start()
+        self.root.mainloop()
+
+    def render(self, event, status):
+        """更新一个桌面的状态行（在Tk线程中执行）"""
+        var = self.desktop_vars[status.name]
+        if status.client is None:
+            client = "无客户端连接"
+        else:
+            downstream = [down for _, down in status.history]
+            client = (f"{status.client} ({status.since})  "
+                      f"↓{format_rate(status.rate_down)} "
+                      f"{spark_text(downstream)}")
+        if status.queue_depth:
+            client += f"  排队 {status.queue_depth} 人"
+        var.set(f"{status.name} :{status.port} -> {status.backend}  {client}")
+
+    def quit_application(self):
+        """退出程序"""
+        self.router.stop_server()
+        self.root.quit()
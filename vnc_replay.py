@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+会话录制回放
+    python vnc_replay.py info 录制文件...
+    python vnc_replay.py replay --target 127.0.0.1:5900 --speed 10 --copies 4 录制文件...
+
+录制文件以mmap只读映射，按索引定位数据块，--start 从该时间之前最近的关键帧开始回放。
+回放按录制的时间间隔（除以倍速）把客户端方向的数据发往目标（代理或VNC服务器），
+服务器方向的数据只读取并计数；每个回放一个连接、一个线程，多个录制和副本并发执行，
+把真实会话变成可重复的负载测试。
+只有无认证的会话可以回放成功：VNC认证的挑战每次不同，录制的认证响应不会通过。
+"""
+
+import argparse
+import bisect
+import json
+import logging
+import mmap
+import socket
+import sys
+import threading
+import time
+import zlib
+
+from recorder import (MAGIC, BLOCK_MAGIC, INDEX_MAGIC, END_MAGIC, BLOCK_HEADER,
+                      RECORD_HEADER, INDEX_ENTRY, TRAILER, U32, BLOCK_KEYFRAME,
+                      DIR_C2S, DIR_S2C, DIR_KEYFRAME, DIR_HANDSHAKE)
+
+logger = logging.getLogger(__name__)
+
+MIN_SPEED = 1
+MAX_SPEED = 100
+DIRECTION_NAMES = {DIR_C2S: "c2s", DIR_S2C: "s2c", DIR_KEYFRAME: "keyframe",
+                   DIR_HANDSHAKE: "handshake"}
+
+
+class RecordingError(Exception):
+    """录制文件格式错误"""
+
+
+class Recording:
+    """只读映射的录制文件"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            try:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise RecordingError(f"空文件: {path}")
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise RecordingError(f"不是会话录制文件: {path}")
+        meta_size = U32.unpack_from(self.map, len(MAGIC))[0]
+        meta_start = len(MAGIC) + U32.size
+        self.meta = json.loads(
+            self.map[meta_start:meta_start + meta_size].decode('utf-8'))
+        self.data_start = meta_start + meta_size
+        # 数据块索引：(首条时间戳ns, 偏移, 标志)
+        self.indexed = self._load_index()
+        if not self.indexed:
+            self.blocks = self._scan_blocks()
+        self.keyframes = [i for i, (_, _, flags) in enumerate(self.blocks)
+                          if flags & BLOCK_KEYFRAME]
+        self.keyframe_times = [self.blocks[i][0] for i in self.keyframes]
+
+    def close(self):
+        self.map.close()
+
+    def _load_index(self):
+        size = len(self.map)
+        if size < self.data_start + TRAILER.size:
+            return False
+        index_offset, end = TRAILER.unpack_from(self.map, size - TRAILER.size)
+        if end != END_MAGIC or self.map[index_offset:index_offset + 4] != INDEX_MAGIC:
+            return False
+        count = U32.unpack_from(self.map, index_offset + 4)[0]
+        start = index_offset + 4 + U32.size
+        self.blocks = [INDEX_ENTRY.unpack_from(self.map, start + i * INDEX_ENTRY.size)
+                       for i in range(count)]
+        return True
+
+    def _scan_blocks(self):
+        """没有索引（录制中断）时按数据块头重建，丢弃末尾不完整的数据块"""
+        blocks = []
+        offset = self.data_start
+        size = len(self.map)
+        while offset + BLOCK_HEADER.size <= size:
+            magic, flags, _, comp_len, first_ts, _, _ = BLOCK_HEADER.unpack_from(
+                self.map, offset)
+            if magic != BLOCK_MAGIC or offset + BLOCK_HEADER.size + comp_len > size:
+                break
+            blocks.append((first_ts, offset, flags))
+            offset += BLOCK_HEADER.size + comp_len
+        return blocks
+
+    @property
+    def duration(self):
+        """录制时长（秒）"""
+        if not self.blocks:
+            return 0.0
+        last_ts = BLOCK_HEADER.unpack_from(self.map, self.blocks[-1][1])[5]
+        return last_ts / 1e9
+
+    def block_records(self, index):
+        """解压一个数据块，返回[(方向, 时间戳ns, 数据)]"""
+        offset = self.blocks[index][1]
+        _, _, raw_len, comp_len, _, _, count = BLOCK_HEADER.unpack_from(self.map,
+                                                                        offset)
+        start = offset + BLOCK_HEADER.size
+        raw = memoryview(zlib.decompress(self.map[start:start + comp_len],
+                                         bufsize=raw_len))
+        records = []
+        position = 0
+        for _ in range(count):
+            direction, timestamp, length = RECORD_HEADER.unpack_from(raw, position)
+            position += RECORD_HEADER.size
+            records.append((direction, timestamp, raw[position:position + length]))
+            position += length
+        return records
+
+    def records(self, first_block=0):
+        """从指定数据块开始逐条产生记录"""
+        for index in range(first_block, len(self.blocks)):
+            yield from self.block_records(index)
+
+    def handshake(self):
+        """客户端握手单元（从关键帧回放时先发送）"""
+        units = []
+        for direction, _, data in self.records():
+            if direction == DIR_HANDSHAKE:
+                units.append(bytes(data))
+            elif direction != DIR_S2C:
+                break
+        return units
+
+    def seek(self, seconds):
+        """不晚于指定时间的最近关键帧所在的数据块，没有关键帧时从头开始"""
+        if seconds <= 0:
+            return 0
+        position = bisect.bisect_right(self.keyframe_times, int(seconds * 1e9)) - 1
+        return self.keyframes[position] if position >= 0 else 0
+
+    def info(self):
+        """统计各方向的记录数和字节数"""
+        counts = {name: [0, 0] for name in DIRECTION_NAMES.values()}
+        for direction, _, data in self.records():
+            entry = counts[DIRECTION_NAMES.get(direction, str(direction))]
+            entry[0] += 1
+            entry[1] += len(data)
+        return {
+            'path': self.path,
+            'meta': self.meta,
+            'indexed': self.indexed,
+            'file_bytes': len(self.map),
+            'blocks': len(self.blocks),
+            'keyframes': len(self.keyframes),
+            'duration_seconds': round(self.duration, 3),
+            'records': {name: {'count': c, 'bytes': b}
+                        for name, (c, b) in counts.items()},
+        }
+
+
+def parse_target(value):
+    host, _, port = value.rpartition(':')
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError(f"目标格式应为 主机:端口: {value}")
+    return host.strip('[]'), int(port)
+
+
+def parse_speed(value):
+    speed = float(value)
+    if not MIN_SPEED <= speed <= MAX_SPEED:
+        raise argparse.ArgumentTypeError(f"倍速必须在{MIN_SPEED}~{MAX_SPEED}之间: {value}")
+    return speed
+
+
+class Replay:
+    """把一个录制回放到一个目标"""
+
+    def __init__(self, recording, target, speed=1.0, start=0.0, linger=1.0, timeout=10):
+        self.recording = recording
+        self.target = target
+        self.speed = speed
+        self.start = start
+        self.linger = linger
+        self.timeout = timeout
+        self.sent_bytes = 0
+        self.sent_records = 0
+        self.received_bytes = 0
+        self.max_lag = 0.0
+        self.elapsed = 0.0
+        self.error = None
+
+    def run(self):
+        started = time.perf_counter()
+        try:
+            sock = socket.create_connection(self.target, self.timeout)
+        except OSError as e:
+            self.error = f"连接失败: {e}"
+            return
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = threading.Thread(target=self._drain, args=(sock,), daemon=True)
+        reader.start()
+        try:
+            self._send(sock)
+            # 留出时间接收服务器对最后几条请求的回复
+            time.sleep(self.linger)
+        except OSError as e:
+            self.error = f"发送失败: {e}"
+        finally:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+            reader.join(self.timeout)
+            self.elapsed = time.perf_counter() - started
+
+    def _send(self, sock):
+        recording = self.recording
+        first_block = recording.seek(self.start)
+        from_keyframe = first_block > 0
+        if from_keyframe:
+            # 从关键帧开始：先完成握手，再由关键帧恢复像素格式、编码并请求全屏
+            for unit in recording.handshake():
+                sock.sendall(unit)
+                self.sent_bytes += len(unit)
+        base_ts = None
+        base_time = time.perf_counter()
+        speed = self.speed
+        for direction, timestamp, data in recording.records(first_block):
+            if direction == DIR_S2C:
+                continue
+            if direction == DIR_HANDSHAKE and from_keyframe:
+                continue
+            if direction == DIR_KEYFRAME:
+                if not from_keyframe:
+                    continue
+                # 只有起点的关键帧需要发送
+                from_keyframe = False
+            if base_ts is None:
+                base_ts = timestamp
+            delay = (base_time + (timestamp - base_ts) / 1e9 / speed
+                     - time.perf_counter())
+            if delay > 0:
+                time.sleep(delay)
+            elif -delay > self.max_lag:
+                self.max_lag = -delay
+            sock.sendall(data)
+            self.sent_bytes += len(data)
+            self.sent_records += 1
+
+    def _drain(self, sock):
+        buffer = bytearray(256 * 1024)
+        try:
+            while True:
+                n = sock.recv_into(buffer)
+                if not n:
+                    return
+                self.received_bytes += n
+        except OSError:
+            pass
+
+    def result(self):
+        return {
+            'recording': self.recording.path,
+            'target': f"{self.target[0]}:{self.target[1]}",
+            'sent_bytes': self.sent_bytes,
+            'sent_records': self.sent_records,
+            'received_bytes': self.received_bytes,
+            'max_lag_ms': round(self.max_lag * 1000, 3),
+            'elapsed_seconds': round(self.elapsed, 3),
+            'error': self.error,
+        }
+
+
+def run_replays(recordings, targets, speed, start=0.0, copies=1, stagger=0.0,
+                linger=1.0):
+    """并发回放所有录制（每个录制copies份），目标轮流分配，返回各回放的结果"""
+    replays = []
+    for copy in range(copies):
+        for recording in recordings:
+            target = targets[len(replays) % len(targets)]
+            replays.append(Replay(recording, target, speed, start, linger))
+    threads = []
+    for replay in replays:
+        thread = threading.Thread(target=replay.run, daemon=True)
+        thread.start()
+        threads.append(thread)
+        if stagger:
+            time.sleep(stagger)
+    for thread in threads:
+        thread.join()
+    return [replay.result() for replay in replays]
+
+
+def summarize(results):
+    failed = [r for r in results if r['error']]
+    return {
+        'replays': len(results),
+        'failed': len(failed),
+        'sent_bytes': sum(r['sent_bytes'] for r in results),
+        'received_bytes': sum(r['received_bytes'] for r in results),
+        'max_lag_ms': max((r['max_lag_ms'] for r in results), default=0.0),
+        'elapsed_seconds': max((r['elapsed_seconds'] for r in results), default=0.0),
+    }
+
+
+def command_info(args):
+    output = []
+    for path in args.recordings:
+        recording = Recording(path)
+        try:
+            output.append(recording.info())
+        finally:
+            recording.close()
+    if args.json:
+        print(json.dumps(output, ensure_ascii=False, indent=2))
+        return 0
+    for info in output:
+        print(f"{info['path']}")
+        print(f"  桌面: {info['meta'].get('desktop')}  "
+              f"客户端: {info['meta'].get('client_addr')}  "
+              f"开始: {info['meta'].get('start_time')}")
+        print(f"  时长: {info['duration_seconds']}s  数据块: {info['blocks']}  "
+              f"关键帧: {info['keyframes']}  "
+              f"索引: {'完整' if info['indexed'] else '已重建（录制未正常结束）'}")
+        for name, entry in info['records'].items():
+            print(f"  {name:<10} {entry['count']:>8} 条 {entry['bytes']:>12} 字节")
+    return 0
+
+
+def command_replay(args):
+    recordings = [Recording(path) for path in args.recordings]
+    try:
+        results = run_replays(recordings, args.target, args.speed, args.start,
+                              args.copies, args.stagger, args.linger)
+    finally:
+        for recording in recordings:
+            recording.close()
+    summary = summarize(results)
+    if args.json:
+        print(json.dumps({'summary': summary, 'replays': results}, ensure_ascii=False,
+                         indent=2))
+    else:
+        for result in results:
+            status = result['error'] or "完成"
+            print(f"{result['recording']} -> {result['target']}: "
+                  f"发送 {result['sent_bytes']} 字节，"
+                  f"接收 {result['received_bytes']} 字节，"
+                  f"最大滞后 {result['max_lag_ms']}ms，{status}")
+        print(f"共 {summary['replays']} 个回放，失败 {summary['failed']}，"
+              f"用时 {summary['elapsed_seconds']}s")
+    return 1 if summary['failed'] else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='VNC会话录制查看与回放')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    info = subparsers.add_parser('info', help='显示录制文件信息')
+    info.add_argument('recordings', nargs='+', help='录制文件（.vncrec）')
+    info.add_argument('--json', action='store_true', help='以JSON输出')
+    info.set_defaults(func=command_info)
+
+    replay = subparsers.add_parser('replay', help='把录制回放到代理或VNC服务器')
+    replay.add_argument('recordings', nargs='+', help='录制文件（.vncrec）')
+    replay.add_argument('--target', type=parse_target, action='append', required=True,
+                        help='回放目标 主机:端口，可重复指定，回放轮流分配')
+    replay.add_argument('--speed', type=parse_speed, default=1.0,
+                        help=f'回放倍速（{MIN_SPEED}~{MAX_SPEED}，默认1）')
+    replay.add_argument('--start', type=float, default=0,
+                        help='从该秒数之前最近的关键帧开始回放（默认从头）')
+    replay.add_argument('--copies', type=int, default=1,
+                        help='每个录制并发回放的份数（默认1）')
+    replay.add_argument('--stagger', type=float, default=0,
+                        help='相邻回放启动的间隔秒数（默认同时启动）')
+    replay.add_argument('--linger', type=float, default=1.0,
+                        help='发送完后继续接收服务器数据的秒数（默认1）')
+    replay.add_argument('--json', action='store_true', help='以JSON输出结果')
+    replay.set_defaults(func=command_replay)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        return args.func(args)
+    except (OSError, RecordingError) as e:
+        logger.error(str(e))
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,599 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+内置WebSocket监听（--ws-port）
+浏览器客户端（noVNC）不再经过单独的websockify进程和一次本机回环转发：
+代理在WebSocket端口上完成HTTP升级握手，把连接包装为类套接字对象（WebSocketSocket），
+之后与TCP客户端走同样的单用户、决策、排队和冷却期流程（SimpleVNCProxy.handle_new_client）。
+- 只转发二进制帧（noVNC的 binary 子协议），文本帧按不支持的数据关闭连接
+- 客户端提供 permessage-deflate 时按设置协商：服务器方向每条消息独立压缩（server_no_context_takeover），
+  小消息和压缩后没有明显变小的消息原样发出，连续压缩效果差时暂停尝试
+- 客户端帧的掩码一次转为大整数异或（int.from_bytes），不逐字节处理
+- 帧头和数据用 sendmsg 一起写出，不为拼接帧复制数据
+- WebSocketCodec只做帧编解码、不读写套接字，拒绝引擎（refusal）在非阻塞套接字上直接使用
+WebSocket连接的转发只能走缓冲区路径（不能splice），asyncio引擎下同样由线程转发。
+配置了TLS（--tls-cert）时先完成TLS握手再进行WebSocket握手（wss）。
+"""
+
+import base64
+import hashlib
+import socket
+import struct
+import threading
+import zlib
+
+from rfb_filters import client_ip
+
+GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# 操作码
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+# 关闭码
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_UNSUPPORTED_DATA = 1003
+CLOSE_TOO_BIG = 1009
+
+# 握手请求头的最大长度和等待时间（秒）
+MAX_REQUEST = 8192
+HANDSHAKE_TIMEOUT = 10.0
+# 单帧（解压后单条消息）的最大长度
+MAX_MESSAGE = 16 * 1024 * 1024
+# 每次从套接字读取的字节数
+RECV_SIZE = 256 * 1024
+
+# permessage-deflate：auto 只对非局域网客户端协商，on 总是协商，off 不协商
+DEFLATE_AUTO = "auto"
+DEFLATE_ON = "on"
+DEFLATE_OFF = "off"
+DEFLATE_MODES = (DEFLATE_AUTO, DEFLATE_ON, DEFLATE_OFF)
+# 小于该长度的消息不压缩
+DEFLATE_MIN_SIZE = 256
+# 压缩后超过原长度该比例时视为效果差，原样发出
+DEFLATE_MAX_RATIO = 0.9
+# 连续多少条消息压缩效果差后暂停尝试，暂停期间跳过的消息数
+DEFLATE_POOR_LIMIT = 8
+DEFLATE_BACKOFF = 64
+DEFLATE_LEVEL = 1
+DEFLATE_TAIL = b"\x00\x00\xff\xff"
+
+U16 = struct.Struct('>H')
+U64 = struct.Struct('>Q')
+
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+
+class WebSocketError(OSError):
+    """WebSocket握手或帧格式错误，按连接错误处理；code为应发送的关闭码"""
+
+    def __init__(self, message, code=CLOSE_PROTOCOL_ERROR):
+        super().__init__(message)
+        self.code = code
+
+
+def unmask(data, mask):
+    """用4字节掩码异或数据：整段转为大整数一次异或，不逐字节循环"""
+    n = len(data)
+    if not n:
+        return b""
+    key = (bytes(mask) * ((n + 3) // 4))[:n]
+    value = int.from_bytes(data, 'little') ^ int.from_bytes(key, 'little')
+    return value.to_bytes(n, 'little')
+
+
+def frame_header(opcode, length, rsv1=False):
+    """服务器帧（不加掩码）的帧头"""
+    first = 0x80 | (0x40 if rsv1 else 0) | opcode
+    if length < 126:
+        return bytes((first, length))
+    if length < 65536:
+        return bytes((first, 126)) + U16.pack(length)
+    return bytes((first, 127)) + U64.pack(length)
+
+
+def close_frame(code=CLOSE_NORMAL, reason=""):
+    payload = U16.pack(code) + reason.encode('utf-8')[:123]
+    return frame_header(OP_CLOSE, len(payload)) + payload
+
+
+def accept_key(key):
+    """Sec-WebSocket-Key -> Sec-WebSocket-Accept"""
+    digest = hashlib.sha1(key.encode('ascii') + GUID).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+
+def deflate_wanted(mode, address):
+    """按设置和客户端地址决定是否协商permessage-deflate（局域网内压缩只增加CPU开销）"""
+    if mode == DEFLATE_ON:
+        return True
+    if mode != DEFLATE_AUTO:
+        return False
+    try:
+        ip = client_ip(address)
+    except ValueError:
+        return True
+    return not (ip.is_private or ip.is_loopback or ip.is_link_local)
+
+
+def parse_extensions(header):
+    """Sec-WebSocket-Extensions -> [(扩展名, {参数: 值或None})]"""
+    offers = []
+    for offer in header.split(','):
+        parts = [part.strip() for part in offer.split(';')]
+        if not parts[0]:
+            continue
+        params = {}
+        for part in parts[1:]:
+            if not part:
+                continue
+            key, _, value = part.partition('=')
+            params[key.strip().lower()] = value.strip().strip('"') or None
+        offers.append((parts[0].lower(), params))
+    return offers
+
+
+def negotiate_deflate(header):
+    """从客户端的扩展提议中选择可接受的permessage-deflate，返回(压缩窗口位数, 响应头)，没有时返回None"""
+    known = {'server_no_context_takeover', 'client_no_context_takeover',
+             'server_max_window_bits', 'client_max_window_bits'}
+    for name, params in parse_extensions(header):
+        if name != 'permessage-deflate' or set(params) - known:
+            continue
+        wbits = 15
+        response = "permessage-deflate; server_no_context_takeover"
+        if 'server_max_window_bits' in params:
+            value = params['server_max_window_bits']
+            # zlib的原始deflate不支持8位窗口
+            if not value or not value.isdigit() or not 9 <= int(value) <= 15:
+                continue
+            wbits = int(value)
+            response += f"; server_max_window_bits={wbits}"
+        return wbits, response
+    return None
+
+
+class DeflateSender:
+    """服务器方向的permessage-deflate：每条消息独立压缩，效果差时原样发出"""
+
+    def __init__(self, wbits=15, level=DEFLATE_LEVEL):
+        self.wbits = wbits
+        self.level = level
+        self.poor = 0
+        self.skip = 0
+        self.messages = 0    # 压缩发出的消息数
+        self.bytes_in = 0    # 压缩前字节数
+        self.bytes_out = 0   # 压缩后字节数
+
+    def compress(self, data):
+        """压缩一条消息，不值得压缩时返回None"""
+        size = len(data)
+        if size < DEFLATE_MIN_SIZE:
+            return None
+        if self.skip:
+            self.skip -= 1
+            return None
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -self.wbits)
+        out = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if out.endswith(DEFLATE_TAIL):
+            out = out[:-len(DEFLATE_TAIL)]
+        if len(out) > size * DEFLATE_MAX_RATIO:
+            self.poor += 1
+            if self.poor >= DEFLATE_POOR_LIMIT:
+                # 数据本身已经压缩过（Tight/ZRLE等编码），暂停一段时间再试
+                self.poor = 0
+                self.skip = DEFLATE_BACKOFF
+            return None
+        self.poor = 0
+        self.messages += 1
+        self.bytes_in += size
+        self.bytes_out += len(out)
+        return out
+
+    def get_stats(self):
+        return {'deflate_messages': self.messages, 'deflate_bytes_in': self.bytes_in,
+                'deflate_bytes_out': self.bytes_out}
+
+
+class WebSocketCodec:
+    """服务器端的WebSocket帧编解码，不读写套接字
+
+    feed(收到的数据) 返回其中二进制消息的数据，ping/close等控制帧的回复放在 outgoing 中，
+    由调用方取出写出；收到close帧后 closed 为True。frame(数据) 返回待写出的 (帧头, 数据)。
+    """
+
+    def __init__(self, deflate=None):
+        # deflate为DeflateSender，协商了permessage-deflate时才有
+        self.deflate = deflate
+        self.decompressor = zlib.decompressobj(-15) if deflate is not None else None
+        self.buffer = bytearray()   # 不完整的帧
+        self.outgoing = bytearray()  # 待写出的控制帧
+        self.closed = False
+        self.close_sent = False
+        self.message = None     # 正在接收的分片消息的操作码
+        self.compressed = False  # 正在接收的消息是否压缩
+
+    def feed(self, data):
+        """输入收到的原始数据，返回解出的消息数据（可能为空）"""
+        if self.buffer:
+            self.buffer += data
+            data = self.buffer
+        out = []
+        offset = 0
+        size = len(data)
+        while not self.closed and size - offset >= 2:
+            first, second = data[offset], data[offset + 1]
+            if not second & 0x80:
+                raise WebSocketError("客户端帧没有掩码")
+            length = second & 0x7f
+            header = 2
+            if length == 126:
+                header = 4
+                if size - offset < header:
+                    break
+                length = U16.unpack_from(data, offset + 2)[0]
+            elif length == 127:
+                header = 10
+                if size - offset < header:
+                    break
+                length = U64.unpack_from(data, offset + 2)[0]
+            if length > MAX_MESSAGE:
+                raise WebSocketError(f"帧过大: {length} 字节", CLOSE_TOO_BIG)
+            end = offset + header + 4 + length
+            if size < end:
+                break
+            mask = data[offset + header:offset + header + 4]
+            payload = unmask(data[offset + header + 4:end], mask)
+            offset = end
+            payload = self._frame(first, payload)
+            if payload:
+                out.append(payload)
+        if data is self.buffer:
+            del self.buffer[:offset]
+        elif offset < size:
+            self.buffer += data[offset:]
+        if len(out) == 1:
+            return out[0]
+        return b"".join(out)
+
+    def _frame(self, first, payload):
+        """处理一个完整的帧，返回其中的消息数据"""
+        fin = first & 0x80
+        rsv1 = first & 0x40
+        opcode = first & 0x0f
+        if first & 0x30:
+            raise WebSocketError("未协商的扩展位")
+        if opcode >= OP_CLOSE:
+            if not fin or len(payload) > 125 or rsv1:
+                raise WebSocketError("控制帧格式错误")
+            if opcode == OP_PING:
+                self.outgoing += frame_header(OP_PONG, len(payload)) + payload
+            elif opcode == OP_CLOSE:
+                self.closed = True
+                if not self.close_sent:
+                    code = (U16.unpack_from(payload)[0] if len(payload) >= 2
+                            else CLOSE_NORMAL)
+                    self.outgoing += close_frame(code)
+                    self.close_sent = True
+            elif opcode != OP_PONG:
+                raise WebSocketError(f"未知的控制帧 {opcode}")
+            return b""
+        if opcode == OP_CONTINUATION:
+            if self.message is None or rsv1:
+                raise WebSocketError("意外的后续分片")
+        else:
+            if self.message is not None:
+                raise WebSocketError("上一条分片消息尚未结束")
+            if opcode == OP_TEXT:
+                raise WebSocketError("只支持二进制帧", CLOSE_UNSUPPORTED_DATA)
+            if opcode != OP_BINARY:
+                raise WebSocketError(f"未知的操作码 {opcode}")
+            if rsv1 and self.decompressor is None:
+                raise WebSocketError("未协商压缩的压缩帧")
+            self.message = opcode
+            self.compressed = bool(rsv1)
+        if fin:
+            self.message = None
+        if not self.compressed:
+            return payload
+        decompressor = self.decompressor
+        data = decompressor.decompress(payload, MAX_MESSAGE)
+        if fin and not decompressor.unconsumed_tail:
+            # max_length为0表示不限制，已到上限时再多取1字节用于判断是否超出
+            data += decompressor.decompress(DEFLATE_TAIL,
+                                            max(1, MAX_MESSAGE - len(data)))
+        if decompressor.unconsumed_tail or len(data) > MAX_MESSAGE:
+            raise WebSocketError("解压后的消息过大", CLOSE_TOO_BIG)
+        return data
+
+    def frame(self, data):
+        """一条二进制消息 -> (帧头, 数据)"""
+        if self.deflate is not None:
+            compressed = self.deflate.compress(data)
+            if compressed is not None:
+                return frame_header(OP_BINARY, len(compressed), rsv1=True), compressed
+        return frame_header(OP_BINARY, len(data)), data
+
+    def encode(self, data):
+        """一条二进制消息 -> 完整的帧"""
+        header, payload = self.frame(data)
+        return header + bytes(payload)
+
+    def close(self, code=CLOSE_NORMAL):
+        """主动关闭时的close帧，已发送过时返回空"""
+        if self.close_sent:
+            return b""
+        self.close_sent = True
+        return close_frame(code)
+
+    def take_outgoing(self):
+        """取出待写出的控制帧"""
+        data = bytes(self.outgoing)
+        self.outgoing.clear()
+        return data
+
+
+def send_parts(sock, header, payload):
+    """写出帧头和数据；有sendmsg时一起写出，不拼接复制（TLS连接没有sendmsg，拼接后写出）"""
+    if not HAS_SENDMSG or type(sock) is not socket.socket:
+        sock.sendall(header + bytes(payload))
+        return
+    parts = [memoryview(header), memoryview(payload)]
+    while parts:
+        sent = sock.sendmsg(parts)
+        while parts and sent >= len(parts[0]):
+            sent -= len(parts[0])
+            parts.pop(0)
+        if parts and sent:
+            parts[0] = parts[0][sent:]
+
+
+class WebSocketSocket:
+    """WebSocket连接的类套接字包装：recv_into/sendall 收发的是RFB字节流
+
+    供转发线程、RFB握手（共享观看、保留后端接管）和排队检查使用；一个线程读、一个线程写，
+    读到ping时回复的pong与写出的数据帧之间用锁保证不交错。
+    """
+
+    def __init__(self, sock, codec, protocol=None, leftover=b""):
+        self.sock = sock
+        self.codec = codec
+        self.protocol = protocol
+        self.write_lock = threading.Lock()
+        self.scratch = bytearray(RECV_SIZE)
+        # 已解出、尚未交给调用方的数据
+        self.data = memoryview(b"")
+        self.eof = False
+        if leftover:
+            self.data = memoryview(codec.feed(leftover))
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def pending(self):
+        """已解出、尚未读取的字节数（等待可读之前需要先检查），wss连接加上TLS层已解密的字节数"""
+        buffered = getattr(self.sock, 'pending', None)
+        return len(self.data) + (buffered() if buffered is not None else 0)
+
+    def _fill(self):
+        """读取并解码，直到有数据或连接结束"""
+        view = memoryview(self.scratch)
+        while not self.data and not self.eof:
+            if self.codec.closed:
+                self.eof = True
+                break
+            n = self.sock.recv_into(view)
+            if not n:
+                self.eof = True
+                break
+            try:
+                self.data = memoryview(self.codec.feed(view[:n]))
+            except WebSocketError as e:
+                self._send_raw(self.codec.close(e.code))
+                raise
+            if self.codec.outgoing:
+                self._send_raw(self.codec.take_outgoing())
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        if flags:
+            raise ValueError("WebSocket连接不支持recv标志")
+        self._fill()
+        data = self.data
+        n = min(nbytes or len(buffer), len(data))
+        buffer[:n] = data[:n]
+        self.data = data[n:]
+        return n
+
+    def recv(self, bufsize, flags=0):
+        if flags:
+            # 排队检查（admission.client_alive）只探测原始连接是否仍然打开，wss连接越过TLS层
+            return socket.socket.recv(self.sock, bufsize, flags)
+        self._fill()
+        data = self.data[:bufsize]
+        self.data = self.data[len(data):]
+        return bytes(data)
+
+    def sendall(self, data):
+        header, payload = self.codec.frame(data)
+        with self.write_lock:
+            send_parts(self.sock, header, payload)
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def _send_raw(self, data):
+        if data:
+            with self.write_lock:
+                self.sock.sendall(data)
+
+    def shutdown(self, how):
+        """关闭前尽量发出close帧；写锁被阻塞中的写出占用时直接关闭"""
+        if how != socket.SHUT_RD and self.write_lock.acquire(blocking=False):
+            try:
+                frame = self.codec.close()
+                if frame:
+                    self.sock.send(frame, getattr(socket, 'MSG_DONTWAIT', 0))
+            except (OSError, ValueError):
+                # wss连接（ssl.SSLSocket）不支持发送标志，不发close帧
+                pass
+            finally:
+                self.write_lock.release()
+        self.sock.shutdown(how)
+
+    def close(self):
+        self.sock.close()
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def gettimeout(self):
+        return self.sock.gettimeout()
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def getblocking(self):
+        return self.sock.getblocking()
+
+    def setsockopt(self, *args):
+        self.sock.setsockopt(*args)
+
+    def getsockopt(self, *args):
+        return self.sock.getsockopt(*args)
+
+    def getpeername(self):
+        return self.sock.getpeername()
+
+    def getsockname(self):
+        return self.sock.getsockname()
+
+
+def read_request(sock):
+    """读取HTTP请求头，返回(请求行, {小写头名: 值}, 请求头之后已读到的数据)"""
+    data = b""
+    while b"\r\n\r\n" not in data:
+        if len(data) >= MAX_REQUEST:
+            raise WebSocketError("请求头过长")
+        chunk = sock.recv(MAX_REQUEST)
+        if not chunk:
+            raise WebSocketError("握手完成前连接已关闭")
+        data += chunk
+    head, _, rest = data.partition(b"\r\n\r\n")
+    lines = head.decode('latin-1').split("\r\n")
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise WebSocketError("请求头格式错误")
+        name = name.strip().lower()
+        value = value.strip()
+        # 重复的头按逗号合并
+        headers[name] = f"{headers[name]}, {value}" if name in headers else value
+    return lines[0], headers, rest
+
+
+def reject(sock, status, extra=""):
+    """握手失败时回复HTTP错误"""
+    try:
+        sock.sendall(f"HTTP/1.1 {status}\r\nConnection: close\r\n{extra}"
+                     f"Content-Length: 0\r\n\r\n".encode('latin-1'))
+    except OSError:
+        pass
+
+
+def handshake(sock, deflate=False):
+    """在阻塞套接字上完成服务器端握手，返回WebSocketSocket；deflate为是否允许permessage-deflate"""
+    request_line, headers, rest = read_request(sock)
+    parts = request_line.split()
+    if len(parts) != 3 or parts[0] != "GET" or not parts[2].startswith("HTTP/1.1"):
+        reject(sock, "400 Bad Request")
+        raise WebSocketError(f"不是WebSocket请求: {request_line[:80]}")
+
+    def tokens(name):
+        return {token.strip().lower() for token in headers.get(name, "").split(',')}
+
+    if 'websocket' not in tokens('upgrade') or 'upgrade' not in tokens('connection'):
+        reject(sock, "426 Upgrade Required", "Upgrade: websocket\r\n")
+        raise WebSocketError("缺少 Upgrade: websocket")
+    if headers.get('sec-websocket-version') != "13":
+        reject(sock, "426 Upgrade Required", "Sec-WebSocket-Version: 13\r\n")
+        raise WebSocketError(f"不支持的WebSocket版本: {headers.get('sec-websocket-version')}")
+    key = headers.get('sec-websocket-key', "")
+    try:
+        valid = len(base64.b64decode(key, validate=True)) == 16
+    except ValueError:
+        valid = False
+    if not valid:
+        reject(sock, "400 Bad Request")
+        raise WebSocketError("Sec-WebSocket-Key 无效")
+
+    response = ["HTTP/1.1 101 Switching Protocols", "Upgrade: websocket",
+                "Connection: Upgrade", f"Sec-WebSocket-Accept: {accept_key(key)}"]
+    protocol = None
+    if 'binary' in tokens('sec-websocket-protocol'):
+        protocol = 'binary'
+        response.append("Sec-WebSocket-Protocol: binary")
+    sender = None
+    if deflate:
+        negotiated = negotiate_deflate(headers.get('sec-websocket-extensions', ""))
+        if negotiated:
+            wbits, extension = negotiated
+            sender = DeflateSender(wbits)
+            response.append(f"Sec-WebSocket-Extensions: {extension}")
+    sock.sendall(("\r\n".join(response) + "\r\n\r\n").encode('latin-1'))
+    return WebSocketSocket(sock, WebSocketCodec(sender), protocol, rest)
+
+
+class WebSocketListener:
+    """一个桌面的WebSocket监听端口：接受连接的线程把连接交给 proxy.dispatch_websocket()"""
+
+    def __init__(self, proxy, port, backlog=128):
+        self.proxy = proxy
+        self.port = port
+        self.backlog = backlog
+        self.sock = None
+        self.running = False
+
+    def start(self):
+        """绑定端口并启动接受连接的线程，端口被占用时抛出OSError"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind(('0.0.0.0', self.port))
+            sock.listen(self.backlog)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        self.running = True
+        threading.Thread(target=self.run, name=f"websocket-{self.port}",
+                         daemon=True).start()
+
+    def run(self):
+        sock = self.sock
+        while self.running:
+            try:
+                client_socket, client_addr = sock.accept()
+            except OSError as e:
+                if self.running:
+                    self.proxy.logger.error(f"接受WebSocket连接错误: {e}")
+                    continue
+                return
+            self.proxy.dispatch_websocket(client_socket, client_addr)
+
+    def stop(self):
+        """停止监听，先shutdown以唤醒阻塞在accept()中的线程"""
+        self.running = False
+        if self.sock is None:
+            return
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多进程接受连接
+N个工作进程分担各桌面的会话，绕开单进程GIL的限制（仅支持Linux等类Unix系统）：
+- handoff：主进程监听所有端口并接受连接，通过SCM_RIGHTS把套接字交给工作进程
+- reuseport：每个工作进程都以SO_REUSEPORT监听所有端口，由内核分配连接
+
+每个桌面固定归一个工作进程所有（按配置顺序轮流分配），该桌面的会话、排队和冷却状态
+只存在于这个进程中，单用户规则因此在多进程下依然成立。
+reuseport模式下收到不属于自己的桌面的连接时，同样通过SCM_RIGHTS转交给所有者进程。
+转交通道不阻塞：所有者进程处理不过来、通道已满时断开该客户端，不影响其他桌面的接受连接。
+主进程定期检查工作进程，异常退出的进程按原序号重新启动（接手通道中积压的连接），
+短时间内反复退出时停止全部进程并报错。多进程模式不支持重新加载配置。
+"""
+
+import array
+import json
+import logging
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import threading
+import time
+
+import proxy_logging
+
+logger = logging.getLogger(__name__)
+
+ACCEPT_HANDOFF = "handoff"
+ACCEPT_REUSEPORT = "reuseport"
+
+# 转交消息中附带的客户端信息的最大长度
+HANDOFF_MESSAGE_SIZE = 512
+
+# 工作进程在该时间窗口（秒）内异常退出超过 MAX_RESTARTS 次时不再重启
+RESTART_WINDOW = 60.0
+MAX_RESTARTS = 5
+
+
+def workers_supported():
+    """当前平台是否支持多进程模式"""
+    return (hasattr(socket, 'AF_UNIX') and hasattr(socket, 'SCM_RIGHTS')
+            and hasattr(os, 'fork'))
+
+
+def bind_listen(port, backlog, reuse_port=False):
+    """创建监听套接字"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('0.0.0.0', port))
+    sock.listen(backlog)
+    return sock
+
+
+def send_client(channel, client_socket, client_addr, port):
+    """通过SCM_RIGHTS把已接受的客户端套接字交给另一个进程"""
+    payload = json.dumps([port, client_addr[0], client_addr[1]]).encode('utf-8')
+    fds = array.array('i', [client_socket.fileno()])
+    channel.sendmsg([payload], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+
+
+def recv_client(channel):
+    """接收转交的客户端套接字，返回(socket, client_addr, port)"""
+    fds = array.array('i')
+    payload, ancdata, _, _ = channel.recvmsg(HANDOFF_MESSAGE_SIZE,
+                                             socket.CMSG_LEN(fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    if not fds:
+        raise OSError("转交消息中没有文件描述符")
+    port, host, client_port = json.loads(payload.decode('utf-8'))
+    return socket.socket(fileno=fds[0]), (host, client_port), port
+
+
+class WorkerPool:
+    """主进程：创建工作进程，handoff模式下负责接受连接并分发"""
+
+    def __init__(self, build_proxies, workers, accept_mode=ACCEPT_HANDOFF, backlog=128,
+                 stats_interval=0, metrics_port=0, metrics_host='127.0.0.1'):
+        # build_proxies在每个工作进程中调用，返回按配置顺序排列的代理对象列表
+        self.build_proxies = build_proxies
+        self.workers = workers
+        self.accept_mode = accept_mode
+        self.backlog = backlog
+        self.stats_interval = stats_interval
+        # 第N个工作进程的指标端点使用 metrics_port + N
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.ports = []
+        self.channels = []
+        self.processes = []
+        self.listeners = []
+        # 每个序号最近的重启时间（time.monotonic）
+        self.restarts = {}
+        self.failed = False
+        self.is_running = False
+
+    def owner_of(self, port):
+        """端口对应桌面的所有者进程序号"""
+        return self.ports.index(port) % self.workers
+
+    def run(self):
+        """启动工作进程并运行到中断，工作进程无法维持运行时返回False"""
+        self.ports = [proxy.proxy_port for proxy in self.build_proxies()]
+        if self.workers > len(self.ports):
+            logger.warning(f"只有 {len(self.ports)} 个桌面，"
+                           f"{self.workers - len(self.ports)} 个工作进程将没有会话")
+
+        listeners = []
+        if self.accept_mode == ACCEPT_HANDOFF:
+            # 在创建工作进程之前绑定，端口被占用时直接失败
+            listeners = [bind_listen(port, self.backlog) for port in self.ports]
+
+        self.listeners = listeners
+        self.channels = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+                         for _ in range(self.workers)]
+        for sender, _ in self.channels:
+            # 发送端（主进程和reuseport模式下各工作进程共用）不阻塞，通道满时丢弃该连接
+            sender.setblocking(False)
+        self.install_reload_signal()
+        self.processes = [self.spawn(index) for index in range(self.workers)]
+        logger.info(f"已启动 {self.workers} 个工作进程"
+                    f"（{self.accept_mode} 模式，backlog {self.backlog}）")
+
+        self.is_running = True
+        try:
+            if listeners:
+                self.accept_loop(listeners)
+            else:
+                while self.is_running:
+                    self.check_workers()
+                    time.sleep(1.0)
+        except KeyboardInterrupt:
+            logger.info("收到中断信号，停止工作进程...")
+        finally:
+            self.stop()
+            for sock in listeners:
+                sock.close()
+        return not self.failed
+
+    def spawn(self, index):
+        """启动第index个工作进程"""
+        context = multiprocessing.get_context('fork')
+        process = context.Process(target=self.worker_main, args=(index, self.listeners),
+                                  name=f"vnc-proxy-worker-{index}", daemon=True)
+        process.start()
+        return process
+
+    def check_workers(self):
+        """重新启动异常退出的工作进程，短时间内反复退出时停止运行"""
+        for index, process in enumerate(self.processes):
+            if process.exitcode is None:
+                continue
+            now = time.monotonic()
+            recent = [t for t in self.restarts.get(index, [])
+                      if now - t < RESTART_WINDOW]
+            if len(recent) >= MAX_RESTARTS:
+                logger.error(f"工作进程 {index} 在 {RESTART_WINDOW:.0f} 秒内"
+                             f"退出了 {len(recent) + 1} 次"
+                             f"（退出码 {process.exitcode}），停止所有工作进程")
+                self.failed = True
+                self.is_running = False
+                return
+            recent.append(now)
+            self.restarts[index] = recent
+            logger.error(f"工作进程 {index} (pid {process.pid}) 异常退出，"
+                         f"退出码 {process.exitcode}，重新启动")
+            self.processes[index] = self.spawn(index)
+
+    def install_reload_signal(self):
+        """多进程模式不支持重新加载配置：收到SIGHUP时只记录日志（工作进程忽略该信号）"""
+        if not hasattr(signal, 'SIGHUP'):
+            return
+        signal.signal(signal.SIGHUP, lambda signum, frame: logger.warning(
+            "多进程模式（--workers）不支持重新加载配置，修改的配置需要重启后生效"))
+
+    def stop(self):
+        """停止所有工作进程"""
+        self.is_running = False
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join(timeout=5)
+
+    def accept_loop(self, listeners):
+        """handoff模式：主进程接受连接并按桌面所有者转交"""
+        selector = selectors.DefaultSelector()
+        for sock in listeners:
+            sock.setblocking(False)
+            selector.register(sock, selectors.EVENT_READ, sock.getsockname()[1])
+        try:
+            while self.is_running:
+                self.check_workers()
+                for key, _ in selector.select(timeout=1.0):
+                    try:
+                        client_socket, client_addr = key.fileobj.accept()
+                    except (BlockingIOError, InterruptedError):
+                        continue
+                    except OSError as e:
+                        logger.error(f"接受连接错误: {e}")
+                        continue
+                    self.hand_off(client_socket, client_addr, key.data)
+        finally:
+            selector.close()
+
+    def hand_off(self, client_socket, client_addr, port):
+        """把连接交给桌面的所有者进程，本进程的副本随即关闭"""
+        owner = self.owner_of(port)
+        try:
+            send_client(self.channels[owner][0], client_socket, client_addr, port)
+        except BlockingIOError:
+            logger.error(f"工作进程 {owner} 的转交通道已满（进程无响应或处理不过来），断开客户端 {client_addr}")
+        except OSError as e:
+            logger.error(f"转交客户端 {client_addr} 到工作进程 {owner} 失败: {e}")
+        finally:
+            client_socket.close()
+
+    def worker_main(self, index, listeners):
+        """工作进程入口"""
+        # 由主进程统一处理Ctrl+C和SIGHUP
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        # 日志管道的后台线程不会随fork复制
+        proxy_logging.restart_in_worker(index)
+        for sock in listeners:
+            sock.close()
+
+        proxies = self.build_proxies()
+        owned = {}
+        for position, proxy in enumerate(proxies):
+            if position % self.workers == index:
+                owned[proxy.proxy_port] = proxy
+        logger.info(f"工作进程 {index} (pid {os.getpid()}) 负责桌面: "
+                    f"{[proxy.name or proxy.proxy_port for proxy in owned.values()]}")
+
+        selector = selectors.DefaultSelector()
+        channel = self.channels[index][1]
+        selector.register(channel, selectors.EVENT_READ, None)
+        if self.accept_mode == ACCEPT_REUSEPORT:
+            for port in self.ports:
+                sock = bind_listen(port, self.backlog, reuse_port=True)
+                sock.setblocking(False)
+                selector.register(sock, selectors.EVENT_READ, port)
+
+        for proxy in owned.values():
+            proxy.is_running = True
+            proxy.start_backend_pool()
+            proxy.start_websocket()
+        self.start_stats_reporter(list(owned.values()))
+        self.start_metrics_server(index, list(owned.values()))
+
+        while True:
+            for key, _ in selector.select():
+                if key.data is None:
+                    try:
+                        client_socket, client_addr, port = recv_client(channel)
+                    except OSError as e:
+                        logger.error(f"接收转交的客户端失败: {e}")
+                        continue
+                else:
+                    port = key.data
+                    try:
+                        client_socket, client_addr = key.fileobj.accept()
+                    except (BlockingIOError, InterruptedError):
+                        continue
+                    except OSError as e:
+                        logger.error(f"接受连接错误: {e}")
+                        continue
+                    if port not in owned:
+                        self.hand_off(client_socket, client_addr, port)
+                        continue
+                try:
+                    client_socket.setblocking(True)
+                    owned[port].dispatch_client(client_socket, client_addr)
+                except Exception as e:
+                    # 一个客户端出错不能让整个工作进程退出
+                    logger.error(f"处理客户端 {client_addr} 时出错: {e}")
+                    try:
+                        client_socket.close()
+                    except OSError:
+                        pass
+
+    def start_metrics_server(self, index, proxies):
+        """工作进程内的指标端点"""
+        if self.metrics_port <= 0 or not proxies:
+            return
+        from metrics_server import MetricsServer
+
+        try:
+            MetricsServer(proxies, self.metrics_port + index, self.metrics_host).start()
+        except OSError as e:
+            logger.error(f"工作进程 {index} 启动指标端点失败: {e}")
+
+    def start_stats_reporter(self, proxies):
+        """工作进程内的定期统计日志"""
+        if self.stats_interval <= 0 or not proxies:
+            return
+
+        def report():
+            while True:
+                time.sleep(self.stats_interval)
+                for proxy in proxies:
+                    proxy.log_stats()
+
+        threading.Thread(target=report, daemon=True).start()